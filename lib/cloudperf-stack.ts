@@ -8,6 +8,8 @@ import * as iam from 'aws-cdk-lib/aws-iam';
 import * as rds from 'aws-cdk-lib/aws-rds';
 import * as elasticache from 'aws-cdk-lib/aws-elasticache';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as events from 'aws-cdk-lib/aws-events';
+import * as eventstargets from 'aws-cdk-lib/aws-events-targets';
 import * as cr from 'aws-cdk-lib/custom-resources';
 import * as elbv2 from 'aws-cdk-lib/aws-elasticloadbalancingv2';
 import * as targets from 'aws-cdk-lib/aws-elasticloadbalancingv2-targets';
@@ -178,6 +180,28 @@ export class CloudperfStack extends cdk.Stack {
       architecture: lambda.Architecture.ARM_64,
     });
 
+    // 异步写入任务结果，api 设置 INGEST_MODE=stream 时从 Redis stream 批量写入数据库
+    const lambdaRoleIngest = new iam.Role(this, 'role-ingest', {
+      assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+    });
+    const ingestLambda = new lambda.Function(this, 'ingest', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      code: lambda.Code.fromAsset('src/ingest'),
+      handler: 'lambda_function.lambda_handler',
+      vpc: vpc,
+      vpcSubnets: { subnets: vpc.privateSubnets },
+      role: lambdaRoleIngest,
+      timeout: cdk.Duration.minutes(5),
+      layers: [pythonLayer, dataLayer],
+      environment: environments,
+      securityGroups: [sg],
+      architecture: lambda.Architecture.ARM_64,
+    });
+    new events.Rule(this, stackPrefix + 'ingest-schedule', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
+      targets: [new eventstargets.LambdaFunction(ingestLambda)],
+    });
+
     // 对外 api 服务
     const alb = new elbv2.ApplicationLoadBalancer(this, stackPrefix + 'api-alb', {
       vpc,
@@ -230,6 +254,10 @@ export class CloudperfStack extends cdk.Stack {
     lambdaRoleAdmin.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("AmazonS3FullAccess"));
     lambdaRoleAdmin.attachInlinePolicy(secretsManagerPolicy);
 
+    lambdaRoleIngest.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("service-role/AWSLambdaBasicExecutionRole"));
+    lambdaRoleIngest.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("service-role/AWSLambdaVPCAccessExecutionRole"));
+    lambdaRoleIngest.attachInlinePolicy(secretsManagerPolicy);
+
     lambdaRoleWeb.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("service-role/AWSLambdaBasicExecutionRole"));
 
     // 数据处理流程
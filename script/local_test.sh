@@ -7,6 +7,7 @@
 # ./local_test.sh api job POST '/job' 'a=b&c=d' 'body'
 # ./local_test.sh admin '{"action":"get_city_id","param":"3.13.0.254"}'
 # ./local_test.sh admin '{"action":"create_user","param":"admin"}'
+# ./local_test.sh ingest '{}'
 
 DB_WRITE_HOST=127.0.0.1
 DB_READ_HOST=127.0.0.1
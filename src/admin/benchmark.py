@@ -0,0 +1,601 @@
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import data_layer
+import http_compress
+import cache_codec
+import latency_sketch
+import fping_parser
+import liveness_bitmap
+import ipaddress
+
+# 性能测试，通过 admin lambda 调用，如：
+# ./admin_exec.sh benchmark_iprange_index 1000
+# ./local_test.sh admin '{"action":"benchmark_iprange_index","param":"1000"}'
+
+def timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return ret, time.perf_counter() - start
+
+def per_call_us(elapsed:float, count:int):
+    return round(elapsed * 1000000 / max(count, 1), 2)
+
+def benchmark_iprange_index(count = 1000):
+    # 对比 iprange 进程内索引与原 SQL 查询（不经过缓存）的单次查询耗时
+    count = int(count)
+    index = data_layer.IPRangeIndex(data_layer.mysql_connection)
+    loaded, load_time = timeit(index.load)
+    if loaded == 0:
+        return {'status': 404, 'msg': 'iprange is empty'}
+    # 一半命中已知范围内的随机ip，一半为全空间随机ip
+    ips = []
+    for i in range(count):
+        if i % 2 == 0:
+            pos = random.randrange(loaded)
+            ips.append(random.randint(index.starts[pos], index.ends[pos]))
+        else:
+            ips.append(random.randint(0, 0xFFFFFFFF))
+
+    def index_lookup():
+        return [index.lookup(ip) for ip in ips]
+
+    def sql_lookup():
+        results = []
+        with data_layer.mysql_connection() as conn:
+            with conn.cursor() as cursor:
+                for ip in ips:
+                    cursor.execute('select city_id from iprange where start_ip<=%s and end_ip>=%s limit 1', (ip, ip))
+                    row = cursor.fetchone()
+                    results.append(row[0] if row else 0)
+        return results
+
+    index_results, index_time = timeit(index_lookup)
+    sql_results, sql_time = timeit(sql_lookup)
+    # 嵌套范围时两者可能命中不同的范围，这里只统计不一致的数量供参考
+    mismatch = sum(1 for a, b in zip(index_results, sql_results) if (a[2] if a else 0) != b)
+    return {
+        'status': 200,
+        'msg': {
+            'ranges': loaded,
+            'load_ms': round(load_time * 1000, 1),
+            'memory_bytes': index.get_metrics()['bytes'],
+            'lookups': count,
+            'index_us_per_lookup': per_call_us(index_time, count),
+            'sql_us_per_lookup': per_call_us(sql_time, count),
+            'speedup': round(sql_time / max(index_time, 1e-9), 1),
+            'mismatch': mismatch,
+        }
+    }
+
+# 压测使用的 city_id 区间，避免和真实数据冲突，测试结束后清理
+BENCH_CITY_BASE = 0xFFFF0000
+
+def summary_ms(times:list):
+    # 返回整体和首尾 10% 轮次的平均耗时，用于观察写入耗时是否随数据量增长
+    n = len(times)
+    tenth = max(n // 10, 1)
+    ordered = sorted(times)
+    return {
+        'rounds': n,
+        'avg_ms': round(sum(times) * 1000 / n, 2),
+        'p50_ms': round(ordered[n // 2] * 1000, 2),
+        'p95_ms': round(ordered[min(int(n * 0.95), n - 1)] * 1000, 2),
+        'first10_ms': round(sum(times[:tenth]) * 1000 / tenth, 2),
+        'last10_ms': round(sum(times[-tenth:]) * 1000 / tenth, 2),
+    }
+
+def table_rows(tables:list):
+    rows = data_layer.mysql_select('select table_name as name,table_rows as count from information_schema.tables where table_schema=%s and table_name in %s',
+        (data_layer.settings.DB_DATABASE, tables))
+    return {row['name']: row['count'] for row in rows}
+
+def benchmark_statistics_insert(param = '200,100'):
+    # param = 轮数,城市对数量；每轮模拟一个 /job 请求写入 10 条数据，分别测试 table 和 ring 两种存储方式
+    rounds, pairs = [int(x) for x in str(param).split(',')]
+    limit = data_layer.settings.MAX_RECORDS_PER_CITYID
+    writers = {
+        'table': data_layer.write_statistics_table,
+        'ring': data_layer.write_statistics_ring,
+    }
+    results = {'before': table_rows(['statistics', 'statistics_ring'])}
+    try:
+        for mode, writer in writers.items():
+            times = []
+            for r in range(rounds):
+                datas = []
+                for i in range(10):
+                    pair = random.randrange(pairs)
+                    datas.append({
+                        'src_city_id': BENCH_CITY_BASE + pair % 10,
+                        'dist_city_id': BENCH_CITY_BASE + pair,
+                        'samples': 1100,
+                        **{col: random.randint(1000, 300000) for col in data_layer.STATISTICS_COLUMNS[1:]},
+                        'latency_hist': None,
+                    })
+                pair_list = sorted({(data['src_city_id'], data['dist_city_id']) for data in datas})
+                start = time.perf_counter()
+                with data_layer.mysql_connection(True) as conn:
+                    with conn.cursor() as cursor:
+                        writer(cursor, datas, pair_list, limit)
+                    conn.commit()
+                times.append(time.perf_counter() - start)
+            results[mode] = summary_ms(times)
+    finally:
+        for table in ('statistics', 'statistics_ring', 'statistics_counter'):
+            data_layer.mysql_execute(f'delete from `{table}` where src_city_id >= %s', (BENCH_CITY_BASE,))
+    return {
+        'status': 200,
+        'msg': results
+    }
+
+def sample_payloads():
+    # 典型的查询结果：国家列表、asn 列表、性能原始数据
+    pair = data_layer.mysql_select(f'select src_city_id,dist_city_id from {data_layer.STATISTICS_TABLE} limit 1', fetchObject=False)
+    return {
+        'country': data_layer.get_countrys(),
+        'asn': data_layer.get_asns_by_country('US'),
+        'performance': data_layer.get_latency_rawdata_cross_city(str(pair[0][0]), str(pair[0][1]), 2000) if pair else [],
+    }
+
+def benchmark_compression(rounds = 5):
+    # 对比 gzip 不同压缩级别和 brotli 对典型 api 响应的压缩率和耗时
+    rounds = int(rounds)
+    payloads = sample_payloads()
+    levels = [('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if http_compress.brotli:
+        levels += [('br', 1), ('br', 5), ('br', 11)]
+    results = {}
+    for name, payload in payloads.items():
+        body = json.dumps(payload).encode('utf-8')
+        result = {'bytes': len(body)}
+        for encoding, level in levels:
+            start = time.perf_counter()
+            for i in range(rounds):
+                data = http_compress.compress(body, encoding, level)
+            elapsed = time.perf_counter() - start
+            result[f'{encoding}{level}'] = {
+                'bytes': len(data),
+                'ratio': round(len(body) / max(len(data), 1), 1),
+                'ms': round(elapsed * 1000 / rounds, 2),
+            }
+        results[name] = result
+    return {
+        'status': 200,
+        'msg': results
+    }
+
+def benchmark_cache_codec(rounds = 20):
+    # 对比 Redis 缓存值各编码方式的编码/解码耗时和占用字节数，legacy 为旧版本的 json 文本
+    rounds = int(rounds)
+    codecs = {
+        'legacy': (lambda v: json.dumps(v).encode('utf-8'), json.loads),
+        'json': (lambda v: cache_codec.encode(v, False, 1 << 62)[0], cache_codec.decode),
+        'json+zlib': (lambda v: cache_codec.encode(v, False, 0)[0], cache_codec.decode),
+    }
+    if cache_codec.msgpack:
+        codecs['msgpack'] = (lambda v: cache_codec.encode(v, True, 1 << 62)[0], cache_codec.decode)
+        codecs['msgpack+zlib'] = (lambda v: cache_codec.encode(v, True, 0)[0], cache_codec.decode)
+    results = {}
+    for name, payload in sample_payloads().items():
+        result = {'rows': len(payload) if payload else 0}
+        for codec, (encoder, decoder) in codecs.items():
+            data, encode_time = timeit(lambda: [encoder(payload) for i in range(rounds)])
+            data = data[0]
+            decoded, decode_time = timeit(lambda: [decoder(data) for i in range(rounds)])
+            result[codec] = {
+                'bytes': len(data),
+                'encode_us': per_call_us(encode_time, rounds),
+                'decode_us': per_call_us(decode_time, rounds),
+            }
+        results[name] = result
+    return {
+        'status': 200,
+        'msg': results
+    }
+
+def benchmark_cache_stampede(param = '20,200'):
+    # param = 并发数,查询耗时毫秒；多个线程同时读取一个不存在的缓存 key，验证只有一个线程查询数据库
+    workers, delay_ms = [int(x) for x in str(param).split(',')]
+    key = data_layer.settings.CACHEKEY_SQL + 'bench_' + str(time.time())
+    calls = []
+    calls_lock = threading.Lock()
+    barrier = threading.Barrier(workers)
+
+    def loader():
+        with calls_lock:
+            calls.append(time.time())
+        return data_layer.mysql_select('select sleep(%s) as s, count(1) as n from country', (delay_ms / 1000,))
+
+    def worker():
+        barrier.wait()
+        return timeit(data_layer.two_tier_cache_get, key, loader, 60)
+
+    stats_before = dict(data_layer.redis_cache_stats)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda i: worker(), range(workers)))
+    finally:
+        data_layer.cache_delete(key)
+    times = [elapsed for ret, elapsed in results]
+    # 查询耗时超过 CACHE_LOCK_WAIT_MS 时，等待的请求会超时后自己查询数据库
+    single = delay_ms < data_layer.settings.CACHE_LOCK_WAIT_MS
+    return {
+        'status': 200 if len(calls) == 1 or not single else 500,
+        'msg': {
+            'workers': workers,
+            'db_queries': len(calls),
+            'empty_results': sum(1 for ret, elapsed in results if not ret),
+            'latency': summary_ms(times),
+            'cache_stats': {k: v - stats_before.get(k, 0) for k, v in data_layer.redis_cache_stats.items()},
+        }
+    }
+
+def benchmark_latency_sketch(param = '2000,1100'):
+    # param = 直方图条数,每条样本数；模拟不同城市对的延迟分布，对比合并直方图与按样本数加权平均分位数的误差
+    count, samples = [int(x) for x in str(param).split(',')]
+    blobs = []
+    all_samples = []
+    weighted = {p: 0.0 for p in (50, 90, 95)}
+    for i in range(count):
+        base = random.uniform(5, 300)
+        data = sorted(base * random.lognormvariate(0, 0.3) for j in range(samples))
+        for p in weighted:
+            weighted[p] += data_layer.np_percentile(data, p) * samples
+        all_samples.extend(data)
+        blobs.append(latency_sketch.encode(latency_sketch.from_samples(data)))
+    all_samples.sort()
+    counts, merge_time = timeit(latency_sketch.merge, blobs)
+    pcts, pct_time = timeit(latency_sketch.percentiles, counts, tuple(weighted))
+    errors = {}
+    for p in weighted:
+        exact = data_layer.np_percentile(all_samples, p)
+        errors[f'p{p}'] = {
+            'exact_ms': round(exact, 2),
+            'sketch_err_pct': round(abs(pcts[p] - exact) * 100 / exact, 2),
+            'weighted_avg_err_pct': round(abs(weighted[p] / (count * samples) - exact) * 100 / exact, 2),
+        }
+    return {
+        'status': 200,
+        'msg': {
+            'sketches': count,
+            'avg_bytes': round(sum(len(blob) for blob in blobs) / count, 1),
+            'merge_ms': round(merge_time * 1000, 2),
+            'merge_us_per_sketch': per_call_us(merge_time, count),
+            'percentile_us': per_call_us(pct_time, 1),
+            'errors': errors,
+        }
+    }
+
+def fping_sample_output(ips:int, samples:int):
+    # 模拟 fping 的输出：data 任务 stderr（含丢包、重复包和调试信息）和 ping 任务 stdout
+    data_lines = ['[DEBUG] CPU time used: 0.083289 sec']
+    ping_lines = ['[DEBUG] CPU time used: 0.012345 sec']
+    for i in range(ips):
+        ip = f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+        base = random.uniform(1, 300)
+        values = [('-' if random.random() < 0.02 else f'{base * random.uniform(1, 1.1):.1f}') for j in range(samples)]
+        data_lines.append(f'{ip} : ' + ' '.join(values))
+        if i % 20 == 0:
+            data_lines.append(f'{ip} : duplicate for [0], 64 bytes, {base:.1f} ms')
+        ping_lines.append(ip)
+    return '\n'.join(data_lines), '\n'.join(ping_lines)
+
+def legacy_parse_data(stderr:str):
+    samples = []
+    for line in stderr.split('\n'):
+        if line.find('duplicate') != -1:
+            continue
+        for data in line.split(' '):
+            try:
+                samples.append(float(data))
+            except ValueError:
+                pass
+    return sorted(samples)
+
+def legacy_parse_ping(stdout:str):
+    ips = []
+    for out in stdout.split('\n'):
+        if out == '' or out.startswith('[DEBUG]'):
+            continue
+        try:
+            ipaddress.ip_address(out)
+            ips.append(out)
+        except ValueError:
+            pass
+    return ips
+
+def benchmark_fping_parser(param = '10,100,11,20'):
+    # param = 每次 POST 的任务数,每个任务的 ip 数,每个 ip 的样本数,轮数；对比原解析方式与 fping_parser 的耗时
+    jobs, ips, samples, rounds = [int(x) for x in str(param).split(',')]
+    outputs = [fping_sample_output(ips, samples) for i in range(jobs)]
+
+    def run(parse_data, parse_ping):
+        for i in range(rounds):
+            for stderr, stdout in outputs:
+                parse_data(stderr)
+                parse_ping(stdout)
+
+    legacy, legacy_time = timeit(run, legacy_parse_data, legacy_parse_ping)
+    parser, parser_time = timeit(run, lambda text: fping_parser.merge_samples(fping_parser.parse_data_output(text)), fping_parser.parse_ping_output)
+    stderr, stdout = outputs[0]
+    per_ip = fping_parser.parse_data_output(stderr)
+    return {
+        'status': 200,
+        'msg': {
+            'bytes_per_post': sum(len(a) + len(b) for a, b in outputs),
+            'legacy_ms_per_post': round(legacy_time * 1000 / rounds, 3),
+            'parser_ms_per_post': round(parser_time * 1000 / rounds, 3),
+            'speedup': round(legacy_time / max(parser_time, 1e-9), 2),
+            # 原解析方式会把 [DEBUG] 行中的数字也当作样本，所以样本数会多 1
+            'samples': [len(legacy_parse_data(stderr)), len(fping_parser.merge_samples(per_ip))],
+            'ips': [len(legacy_parse_ping(stdout)), len(fping_parser.parse_ping_output(stdout)), len(per_ip)],
+        }
+    }
+
+# 压测使用的 ip 区间（240.0.0.0/8 保留地址），每个范围一个 /18
+BENCH_IP_BASE = 0xF0000000
+BENCH_RANGE_SIZE = 16384
+
+def benchmark_liveness_bitmap(param = '20,2000'):
+    # param = 范围数,每个范围每轮可ping的 ip 数；模拟 4 轮扫描（写入后老化），对比 pingable 表与位图存储的耗时，并核对两者的计数
+    count, ips = [int(x) for x in str(param).split(',')]
+    generations = data_layer.settings.LIVENESS_GENERATIONS
+    ranges = [(BENCH_CITY_BASE + i, BENCH_IP_BASE + i * BENCH_RANGE_SIZE, BENCH_IP_BASE + (i + 1) * BENCH_RANGE_SIZE - 1) for i in range(count)]
+    rounds = [{r: sorted(random.sample(range(r[1], r[2] + 1), ips)) for r in ranges} for i in range(generations)]
+    liveness = data_layer.liveness
+    times = {'table': {'mark': 0, 'age': 0}, 'bitmap': {'mark': 0, 'age': 0}}
+    try:
+        for i, jobs in enumerate(rounds):
+            # 最后一轮只写入不老化，三种计数都不为 0
+            start = time.perf_counter()
+            data_layer.update_pingable_table({city_id: [str(ipaddress.IPv4Address(ip)) for ip in iplist] for (city_id, s, e), iplist in jobs.items()})
+            times['table']['mark'] += time.perf_counter() - start
+            start = time.perf_counter()
+            liveness.mark(jobs)
+            times['bitmap']['mark'] += time.perf_counter() - start
+            if i == len(rounds) - 1:
+                break
+            start = time.perf_counter()
+            data_layer.age_pingable_table(ranges)
+            times['table']['age'] += time.perf_counter() - start
+            start = time.perf_counter()
+            liveness.age_ranges(ranges)
+            times['bitmap']['age'] += time.perf_counter() - start
+        sql = 'select sum(lastresult>=' + data_layer.settings.STABLE_PINGABLE_IP + '),sum(lastresult>=' + data_layer.settings.NEW_PINGABLE_IP + \
+            '),sum(lastresult<=' + data_layer.settings.LOSS_PINGABLE_IP + ') from pingable where city_id>=%s'
+        table_counts, times['table']['count'] = timeit(data_layer.mysql_select, sql, (BENCH_CITY_BASE,), False)
+        table_counts = [int(x or 0) for x in table_counts[0]]
+        fields = [liveness_bitmap.range_field(*r) for r in ranges]
+        bitmap_counts, times['bitmap']['count'] = timeit(liveness.redis.hmget, liveness.counts_key(), fields)
+        bitmap_counts = [sum(int(x.split(b',')[i]) for x in bitmap_counts if x) for i in range(3)]
+        city_id = ranges[0][0]
+        start = time.perf_counter()
+        for i in range(10):
+            data_layer.mysql_select('SELECT ip FROM pingable where city_id=%s and lastresult>=' + data_layer.settings.NEW_PINGABLE_IP + ' order by RAND() LIMIT 100', (city_id,), False)
+        times['table']['sample'] = (time.perf_counter() - start) / 10
+        start = time.perf_counter()
+        for i in range(10):
+            liveness.sample(city_id, 100)
+        times['bitmap']['sample'] = (time.perf_counter() - start) / 10
+    finally:
+        data_layer.mysql_execute('delete from pingable where city_id >= %s', (BENCH_CITY_BASE,))
+        for r in ranges:
+            liveness.delete(*r)
+    return {
+        'status': 200 if table_counts == bitmap_counts else 500,
+        'msg': {
+            'ranges': count,
+            'ips_per_round': count * ips,
+            'counts': {'table': table_counts, 'bitmap': bitmap_counts},
+            **{mode: {k: round(v * 1000, 2) for k, v in t.items()} for mode, t in times.items()},
+        }
+    }
+
+def benchmark_job_dispatch(param = '50,20,5000'):
+    # param = 并发客户端数,每次请求的任务数,任务总数；在独立的测试队列上对比逐个 LPOP 与批量租约派发的吞吐量
+    # 批量派发时约 10% 的租约不确认（模拟客户端崩溃），最后回收并检查这些任务被放回队列
+    workers, count, total = [int(x) for x in str(param).split(',')]
+    jobs = [{'type': 'pingable', 'start_ip': BENCH_IP_BASE + i * 256, 'end_ip': BENCH_IP_BASE + i * 256 + 255, 'city_id': BENCH_CITY_BASE} for i in range(total)]
+    queue = data_layer.JobLeaseQueue(data_layer.redis_pool, data_layer.settings.CACHEKEY_PINGABLE + 'bench', 60, 2)
+    results = {}
+    try:
+        # 返回 (取到的任务, 未确认的任务数, Redis 往返次数)
+        def legacy_worker(i):
+            got = []
+            calls = 0
+            while True:
+                batch = []
+                for n in range(count):
+                    obj = data_layer.cache_pop(queue.queue_key)
+                    calls += 1
+                    if not obj:
+                        break
+                    batch.append(obj)
+                got.extend(batch)
+                if len(batch) < count:
+                    return got, 0, calls
+
+        def lease_worker(i):
+            got = []
+            unacked = 0
+            calls = 0
+            while True:
+                lease_id, batch = queue.dispatch(count)
+                calls += 1
+                if not batch:
+                    return got, unacked, calls
+                got.extend(batch)
+                if random.random() < 0.1:
+                    unacked += len(batch)
+                else:
+                    queue.ack(lease_id)
+                    calls += 1
+
+        for mode, worker in (('lpop', legacy_worker), ('lease', lease_worker)):
+            queue.clear()
+            queue.push(jobs)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                outs = list(executor.map(worker, range(workers)))
+            elapsed = time.perf_counter() - start
+            got = [job['start_ip'] for out, unacked, calls in outs for job in out]
+            results[mode] = {
+                'jobs': len(got),
+                'duplicates': len(got) - len(set(got)),
+                'elapsed_ms': round(elapsed * 1000, 1),
+                'jobs_per_sec': round(len(got) / max(elapsed, 1e-9)),
+                'round_trips': sum(calls for out, unacked, calls in outs),
+            }
+            if mode == 'lease':
+                unacked = sum(unacked for out, unacked, calls in outs)
+                # 模拟租约全部到期
+                leases, requeued, dropped = queue.reap(time.time() + 3600)
+                results[mode].update({
+                    'unacked_jobs': unacked,
+                    'reaped_leases': leases,
+                    'requeued_jobs': requeued,
+                    'metrics': queue.get_metrics(),
+                })
+    finally:
+        queue.clear()
+    lease = results.get('lease', {})
+    ok = all(r['jobs'] == total and r['duplicates'] == 0 for r in results.values()) and lease.get('requeued_jobs') == lease.get('unacked_jobs')
+    return {
+        'status': 200 if ok else 500,
+        'msg': results
+    }
+
+def count_round_trips(func, *args):
+    # 统计 func 执行期间的 Redis 往返（每条命令或每个 pipeline 发送一次）和 MySQL 查询次数，返回 (结果, 耗时, 次数)
+    conn_class = getattr(data_layer.redis.connection, 'AbstractConnection', data_layer.redis.connection.Connection)
+    send = conn_class.send_packed_command
+    select = data_layer.mysql_select
+    counts = {'redis': 0, 'mysql': 0}
+
+    def counted_send(self, *a, **k):
+        counts['redis'] += 1
+        return send(self, *a, **k)
+
+    def counted_select(*a, **k):
+        counts['mysql'] += 1
+        return select(*a, **k)
+
+    conn_class.send_packed_command = counted_send
+    data_layer.mysql_select = counted_select
+    try:
+        ret, elapsed = timeit(func, *args)
+    finally:
+        conn_class.send_packed_command = send
+        data_layer.mysql_select = select
+    return ret, elapsed, counts
+
+def legacy_enrich_clients(online_ips:list, with_pairs:bool):
+    # 原来的实现：每个客户端查询一次 city_id，data 客户端每个再读取一次城市对数量
+    client_city_ids = {ip: data_layer.get_cityid_by_ip(ip) for ip, timestamp in online_ips}
+    citys = data_layer.get_cityobjects_by_ids(set(client_city_ids.values()) - {0})
+    clients = []
+    for ip, timestamp in online_ips:
+        city = citys.get(client_city_ids[ip])
+        if city:
+            msg = data_layer.friendly_intval(time.time() - timestamp)
+            if with_pairs:
+                msg += ', Pairs: ' + str(data_layer.pair_scheduler.sizes([city['cityId']])[city['cityId']])
+            clients.append({'ip': ip, 'region': data_layer.friendly_cityandasnno(city), 'status': msg})
+    return clients
+
+def benchmark_client_enrichment(param = '10,100,500'):
+    # param = 逗号分隔的客户端数量；对比逐个查询与批量补充 data-clients 列表的往返次数，批量补充的往返次数不应随客户端数量增加
+    sizes = [int(x) for x in str(param).split(',')]
+    index = data_layer.get_iprange_index()
+    now = time.time()
+    results = {}
+    for size in sizes:
+        # 客户端 ip 取自已知范围，使其能找到城市；没有索引时使用随机 ip（走 SQL 查询）
+        ips = []
+        for i in range(size):
+            if index != None:
+                pos = random.randrange(len(index))
+                ips.append(str(ipaddress.IPv4Address(random.randint(index.starts[pos], index.ends[pos]))))
+            else:
+                ips.append(str(ipaddress.IPv4Address(random.randint(0x01000000, 0xDFFFFFFF))))
+        online_ips = [(ip, now - random.randint(0, 600)) for ip in ips]
+        # 预热城市对象缓存，只比较稳定状态下的往返次数
+        data_layer.enrich_online_clients(online_ips, True)
+        legacy, legacy_time, legacy_counts = count_round_trips(legacy_enrich_clients, online_ips, True)
+        batch, batch_time, batch_counts = count_round_trips(data_layer.enrich_online_clients, online_ips, True)
+        results[size] = {
+            'clients': len(batch),
+            # 状态中的时间按各自的读取时间计算，只比较客户端和城市
+            'same_result': [(c['ip'], c['region']) for c in legacy] == [(c['ip'], c['region']) for c in batch],
+            'legacy_ms': round(legacy_time * 1000, 2),
+            'batch_ms': round(batch_time * 1000, 2),
+            'legacy_round_trips': legacy_counts,
+            'batch_round_trips': batch_counts,
+        }
+    batch_counts = [r['batch_round_trips'] for r in results.values()]
+    ok = all(counts == batch_counts[0] for counts in batch_counts) and all(r['same_result'] for r in results.values())
+    return {
+        'status': 200 if ok else 500,
+        'msg': results
+    }
+
+def benchmark_speed_counter(updates = 1000):
+    # 对比原来每分钟一个 key 的计数（INCR 后首次写入再 EXPIRE，读取时 MGET 60 个 key）与多精度 hash 计数的往返次数和耗时
+    # 更新 updates 次后读取 4 个计数，并核对合计
+    updates = int(updates)
+    r = data_layer.redis.StrictRedis(connection_pool=data_layer.redis_pool)
+    names = [f'{data_layer.settings.CACHEKEY_RECENT_TASKS}bench-{i}' for i in range(4)]
+    legacy_keys = ['{' + name + '}:' + str(i) for name in names for i in range(60)]
+    counts = [random.randint(1, 100) for i in range(updates)]
+
+    def legacy_update():
+        for i, count in enumerate(counts):
+            key = '{' + names[i % len(names)] + '}:' + str(int(time.time() / 60) % 60)
+            if r.incr(key, count) == count:
+                r.expire(key, 3600)
+
+    def legacy_read():
+        return [sum(int(x) for x in r.mget(legacy_keys[i * 60:(i + 1) * 60]) if x is not None) for i in range(len(names))]
+
+    counters = [data_layer.SpeedCounter(data_layer.redis_pool, name) for name in names]
+
+    def counter_update():
+        for i, count in enumerate(counts):
+            counters[i % len(counters)].update_count(count)
+
+    def counter_read():
+        stats = data_layer.read_speed_counters(counters)
+        return [stats[counter.key]['hour'] for counter in counters]
+
+    def cleanup():
+        # 各 key 不在同一个 slot，一次 DELETE 多个 key 在集群模式下会报 CROSSSLOT，逐个删除并在一个 pipeline 中发送
+        pipe = r.pipeline(transaction=False)
+        for key in legacy_keys + names:
+            pipe.delete(key)
+        pipe.execute()
+
+    expected = [sum(counts[i::len(names)]) for i in range(len(names))]
+    results = {}
+    try:
+        cleanup()
+        for mode, update, read in (('legacy', legacy_update, legacy_read), ('hash', counter_update, counter_read)):
+            ret, update_time, update_counts = count_round_trips(update)
+            totals, read_time, read_counts = count_round_trips(read)
+            results[mode] = {
+                'update_us': per_call_us(update_time, updates),
+                'update_round_trips': round(update_counts['redis'] / updates, 2),
+                'read_ms': round(read_time * 1000, 2),
+                'read_round_trips': read_counts['redis'],
+                # 跨分钟时旧的计数方式可能写入同一个 key 的不同周期，只作参考
+                'totals_match': totals == expected,
+            }
+        results['hash']['stats'] = counters[0].get_stats()
+    finally:
+        cleanup()
+    return {
+        'status': 200 if results['hash']['totals_match'] else 500,
+        'msg': results
+    }
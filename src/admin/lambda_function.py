@@ -9,6 +9,7 @@ import boto3
 from boto3.s3.transfer import TransferConfig
 from urllib.parse import urlparse
 import data_layer
+import benchmark
 from datetime import datetime
 import settings
 import secrets
@@ -130,6 +131,23 @@ def get_city_id(ip:str):
     cityid = data_layer.get_cityid_by_ip(ip)
     return cityid
 
+def migrate_statistics_ring(limit = None):
+    if limit:
+        return data_layer.migrate_statistics_ring(int(limit))
+    return data_layer.migrate_statistics_ring()
+
+def migrate_pingable_bitmap():
+    return data_layer.migrate_pingable_bitmap()
+
+def reconcile_statistics_counters():
+    return data_layer.reconcile_statistics_counters()
+
+def rebuild_statistics_summary():
+    return data_layer.rebuild_statistics_summary()
+
+def check_statistics_summary(limit = 100):
+    return data_layer.check_statistics_summary(int(limit))
+
 def exec_sql(sql):
     if sql == 'init_db':
         return data_layer.mysql_create_database()
@@ -229,6 +247,22 @@ def create_user(username):
 # event = {"action":"exec_sql","param":"select * from asn;"}
 # event = {"action":"create_user","param":"myuser"}
 # event = {"action":"mysql_dump","param":"country,city,asn,iprange,cityset"}
+# event = {"action":"migrate_statistics_ring"}
+# event = {"action":"rebuild_statistics_summary"}
+# event = {"action":"migrate_pingable_bitmap"}
+# event = {"action":"reconcile_statistics_counters"}
+# event = {"action":"check_statistics_summary","param":"100"}
+# event = {"action":"benchmark_iprange_index","param":"1000"}
+# event = {"action":"benchmark_statistics_insert","param":"200,100"}
+# event = {"action":"benchmark_compression","param":"5"}
+# event = {"action":"benchmark_cache_codec","param":"20"}
+# event = {"action":"benchmark_cache_stampede","param":"20,200"}
+# event = {"action":"benchmark_latency_sketch","param":"2000,1100"}
+# event = {"action":"benchmark_fping_parser","param":"10,100,11,20"}
+# event = {"action":"benchmark_liveness_bitmap","param":"20,2000"}
+# event = {"action":"benchmark_job_dispatch","param":"50,20,5000"}
+# event = {"action":"benchmark_client_enrichment","param":"10,100,500"}
+# event = {"action":"benchmark_speed_counter","param":"1000"}
 # or s3 notify message
 def lambda_handler(event, context):
     try:
@@ -250,6 +284,8 @@ def lambda_handler(event, context):
 
         # Get the function from current module's globals
         func = globals().get(action)
+        if not func and action.startswith('benchmark_'):
+            func = getattr(benchmark, action, None)
         if not func or not callable(func):
             return {"status": 404, "msg": f"Action '{action}' not found or not callable"}
 
@@ -1,6 +1,9 @@
 import json
+import base64
 import settings
 import data_layer
+import http_compress
+import latency_sketch
 import ipaddress
 from urllib.parse import unquote_plus
 from datetime import datetime, timedelta
@@ -27,12 +30,199 @@ def webapi_statistics(requests):
             query = 'all-country,all-city,all-asn,cityid-all,ping-stable,ping-new,ping-loss,cidr-ready,cidr-outdated,cidr-queue'
         elif querykey == 'clients':
             query = 'ping-clients,data-clients,speed-ping-get,speed-ping-set,speed-data-get,speed-data-set'
+        elif querykey == 'cache':
+            # 当前容器各级缓存的命中统计
+            return {
+                'statusCode': 200,
+                'result': data_layer.get_cache_metrics()
+            }
+        elif querykey == 'schedule':
+            # 城市对的测量覆盖时间
+            return {
+                'statusCode': 200,
+                'result': data_layer.get_schedule_metrics()
+            }
+        elif querykey == 'refill':
+            # ping 任务队列的补充延迟和吞吐量
+            return {
+                'statusCode': 200,
+                'result': data_layer.get_refill_metrics()
+            }
+        elif querykey == 'speed':
+            # 各类任务最近一分钟、一小时、一天的处理数量和每秒速率
+            return {
+                'statusCode': 200,
+                'result': data_layer.get_speed_metrics()
+            }
+        elif querykey == 'ingest':
+            # 异步写入 stream 的积压情况
+            return {
+                'statusCode': 200,
+                'result': data_layer.get_ingest_status()
+            }
     data = data_layer.query_statistics_data(query)
     return {
         'statusCode': 200,
         'result': data
     }
 
+# rawData 中城市相关的字符串，每页每个 city_id 只生成一次
+def rawdata_decorate(city_id, cityobj):
+    return (
+        data_layer.friendly_cityname(cityobj) + " - " + str(city_id),
+        data_layer.friendly_cityasn(cityobj),
+        f"{cityobj['startIp']} - {cityobj['endIp']}"
+    )
+
+def rawdata_row(item, cityobjs, decorates):
+    if item['src'] not in cityobjs or item['dist'] not in cityobjs:
+        return None
+    for city_id in (item['src'], item['dist']):
+        if city_id not in decorates:
+            decorates[city_id] = rawdata_decorate(city_id, cityobjs[city_id])
+    srcdec = decorates[item['src']]
+    distdec = decorates[item['dist']]
+    return {
+        'sC': srcdec[0],
+        'sA': srcdec[1],
+        'sIP': srcdec[2],
+        'dC': distdec[0],
+        'dA': distdec[1],
+        'dIP': distdec[2],
+        'sm': int(item['samples']),
+        'min': round(item['min']/1000, 2),
+        'max': round(item['max']/1000, 2),
+        'avg': round(item['avg']/1000, 2),
+        'p50': round(item['p50']/1000, 2),
+        'p70': round(item['p70']/1000, 2),
+        'p90': round(item['p90']/1000, 2),
+        'p95': round(item['p95']/1000, 2),
+        'ti': item['update_time']
+    }
+
+# format=columnar 时的紧凑返回格式：城市信息按 city_id 放在 cities 字典中，测量数据按列放在并行数组中，
+# 延迟值为整数，实际毫秒数 = 值 / scale
+LATENCY_KEYS = ('min','max','avg','p50','p70','p90','p95')
+# rawData 保留两位小数，latencyData 保留一位小数，与普通格式精度一致
+RAWDATA_SCALE = 100
+LATENCY_SCALE = 10
+
+def columnar_new(raw:bool):
+    keys = ('s','d','sm') + LATENCY_KEYS + (('ti',) if raw else ())
+    return {key: [] for key in keys}
+
+def columnar_city(city_id, cityobj, raw:bool):
+    if raw:
+        name, asn, iprange = rawdata_decorate(city_id, cityobj)
+        return {'C': name, 'A': asn, 'IP': iprange}
+    return {
+        'C': data_layer.friendly_cityname(cityobj),
+        'A': data_layer.friendly_cityshortasn(cityobj),
+        'La': cityobj['latitude'],
+        'Lo': cityobj['longitude'],
+    }
+
+# 追加一行数据，返回增加的序列化字节数估算值，城市信息缺失时返回 None
+def columnar_append(columns, cities, item, cityobjs, scale:int, raw:bool):
+    if item['src'] not in cityobjs or item['dist'] not in cityobjs:
+        return None
+    size = 0
+    for city_id in (item['src'], item['dist']):
+        if city_id not in cities:
+            cities[city_id] = columnar_city(city_id, cityobjs[city_id], raw)
+            size += len(json.dumps(cities[city_id])) + len(str(city_id)) + 4
+    values = [item['src'], item['dist'], int(item['samples'])]
+    values += [int(round(item[key] * scale / 1000)) for key in LATENCY_KEYS]
+    if raw:
+        values.append(item['update_time'])
+    for key, value in zip(columns, values):
+        columns[key].append(value)
+    return size + sum(len(str(value)) + 2 for value in values)
+
+# 游标为 update_time,src,dist,rid 的 urlsafe base64 编码，对客户端不透明
+def encode_cursor(item):
+    return base64.urlsafe_b64encode(f"{item['update_time']},{item['src']},{item['dist']},{item['rid']}".encode()).decode()
+
+def decode_cursor(cursor:str):
+    if cursor == '':
+        return None
+    after = [int(x) for x in base64.urlsafe_b64decode(cursor.encode()).decode().split(',')]
+    if len(after) == 3:
+        # 旧版本的游标没有 rid，与原来一样跳过同一时间的同一城市对
+        after.append(0)
+    if len(after) != 4:
+        raise ValueError('invalid cursor')
+    return after
+
+# rawData 分页：按序列化后的字节数控制每页大小，返回 {rawData: [...], cursor: 下一页游标，没有更多数据时为空}
+def performance_rawdata_page(src, dist, cursor, cityobjs, columnar:bool = False, budget:int = settings.RAWDATA_PAGE_BYTES):
+    try:
+        after = decode_cursor(unquote_plus(cursor))
+    except (ValueError, UnicodeDecodeError):
+        return {'statusCode': 400, 'result': 'param cursor invalid!'}
+    outdata = columnar_new(True) if columnar else []
+    cities = {}
+    decorates = {}
+    size = 0
+    next_cursor = ''
+    while True:
+        rawData = data_layer.get_latency_rawdata_page(src, dist, after, settings.RAWDATA_FETCH_ROWS)
+        if rawData == None:
+            return {'statusCode': 400, 'result': 'param src and dist invalid!'}
+        full = False
+        for item in rawData:
+            if columnar:
+                # 列存格式在追加后才知道大小，因此预留一行的余量
+                if size + 512 > budget:
+                    full = True
+                    break
+                rowsize = columnar_append(outdata, cities, item, cityobjs, RAWDATA_SCALE, True)
+                size += rowsize or 0
+            else:
+                row = rawdata_row(item, cityobjs, decorates)
+                if row:
+                    rowsize = len(json.dumps(row)) + 2
+                    if size + rowsize > budget:
+                        full = True
+                        break
+                    size += rowsize
+                    outdata.append(row)
+            after = (item['update_time'], item['src'], item['dist'], item['rid'])
+        if full:
+            next_cursor = encode_cursor({'update_time': after[0], 'src': after[1], 'dist': after[2], 'rid': after[3]})
+            break
+        if len(rawData) < settings.RAWDATA_FETCH_ROWS:
+            break
+    result = {
+        'rawData': outdata,
+        'cursor': next_cursor
+    }
+    if columnar:
+        result.update({'format': 'columnar', 'scale': RAWDATA_SCALE, 'cities': cities})
+    return {
+        'statusCode': 200,
+        'result': result
+    }
+
+LATENCY_PERCENTILES = (50, 70, 90, 95)
+
+# 合并后的直方图计算出的分位数，单位与数据库一致为 us
+def sketch_percentiles(counts):
+    return {f'p{p}': v * 1000 for p, v in latency_sketch.percentiles(counts, LATENCY_PERCENTILES).items()}
+
+# 按分组合并直方图，hists[group] = [合并后的直方图, 有直方图的样本数]
+def sketch_add(hists, group, indices, values, samples):
+    if group not in hists:
+        hists[group] = [latency_sketch.new_counts(), 0]
+    latency_sketch.add(hists[group][0], indices, values)
+    hists[group][1] += samples
+
+# 分组内所有记录都有直方图时，用合并后的真实分位数代替按样本数加权平均的分位数
+def sketch_override(hists, group, samples, datas:dict, scale:float):
+    if group in hists and hists[group][1] == samples:
+        for key, value in sketch_percentiles(hists[group][0]).items():
+            datas[key] = round(value / scale, 1)
+
 # //fixme，由于相同asn在同一个城市有多个asn号码，会造成选择cityid时少了，如：RU,Moscow,PJSC Rostelecom
 def webapi_performance(requests):
     if 'src' not in requests['query'] or 'dist' not in requests['query']:
@@ -42,43 +232,31 @@ def webapi_performance(requests):
     srclist = src.split(',')
     distlist = dist.split(',')
     # 找到所有相关的city_id对应对象
-    cityobjs = {}
-    for city_id in chain(srclist, distlist):
-        city_id = int(city_id)
-        city_obj = data_layer.get_cityobject_by_id(city_id)
-        # print(city_id, city_obj)
-        if city_obj and len(city_obj) > 0:
-            cityobjs[city_id] = city_obj[0]
+    cityobjs = data_layer.get_cityobjects_by_ids(chain(srclist, distlist))
 
+    columnar = requests['query'].get('format') == 'columnar'
     if 'rawData' in requests['query']:
+        if 'cursor' in requests['query'] or columnar:
+            # 响应会被压缩时，每页可以返回更多数据
+            cursor = requests['query'].get('cursor', '')
+            if http_compress.choose_encoding(requests.get('acceptencoding', '')):
+                ret = performance_rawdata_page(src, dist, cursor, cityobjs, columnar, settings.RAWDATA_PAGE_BYTES_COMPRESSED)
+                # 压缩率不够时由 lambda_handler 调用，按不压缩也不超过限制的页大小重新分页
+                ret['fallback'] = lambda: performance_rawdata_page(src, dist, cursor, cityobjs, columnar, settings.RAWDATA_PAGE_BYTES)
+                return ret
+            return performance_rawdata_page(src, dist, cursor, cityobjs, columnar, settings.RAWDATA_PAGE_BYTES)
         # 由于 alb 调用 Lambda 有 1MB 限制，所以把数据进行了拆分，原始数据和延迟数据分别给出
-        # 1000 条记录大概 330KB 2000条记录大概 670KB
+        # 1000 条记录大概 330KB 2000条记录大概 670KB，需要更多数据时使用 cursor 参数分页获取
         rawData = data_layer.get_latency_rawdata_cross_city(src, dist, 2000)
         if rawData == None:
             return {'statusCode': 400, 'result': 'param src and dist invalid!'}
         outdata = []
+        decorates = {}
         # 原始数据处理
         for item in rawData:
-            if item['src'] in cityobjs and item['dist'] in cityobjs:
-                srcobj = cityobjs[item['src']]
-                distobj = cityobjs[item['dist']]
-                outdata.append({
-                    'sC': data_layer.friendly_cityname(srcobj) + " - " + str(item['src']),
-                    'sA': data_layer.friendly_cityasn(srcobj),
-                    'sIP': f"{srcobj['startIp']} - {srcobj['endIp']}",
-                    'dC': data_layer.friendly_cityname(distobj) + " - " + str(item['dist']),
-                    'dA': data_layer.friendly_cityasn(distobj),
-                    'dIP': f"{distobj['startIp']} - {distobj['endIp']}",
-                    'sm': int(item['samples']),
-                    'min': round(item['min']/1000, 2),
-                    'max': round(item['max']/1000, 2),
-                    'avg': round(item['avg']/1000, 2),
-                    'p50': round(item['p50']/1000, 2),
-                    'p70': round(item['p70']/1000, 2),
-                    'p90': round(item['p90']/1000, 2),
-                    'p95': round(item['p95']/1000, 2),
-                    'ti': item['update_time']
-                })
+            row = rawdata_row(item, cityobjs, decorates)
+            if row:
+                outdata.append(row)
     else:
         latencyData = data_layer.get_latency_data_cross_city(src, dist)
         # print(latencyData)
@@ -92,13 +270,26 @@ def webapi_performance(requests):
             "distCityIds": len(distlist),
             "asnData": [],
             "cityData": [],
-            "latencyData": [],
+            "latencyData": columnar_new(False) if columnar else [],
         }
+        cities = {}
+        if columnar:
+            outdata.update({'format': 'columnar', 'scale': LATENCY_SCALE, 'cities': cities})
         data = {
             'asn': {},
             'city': {}
         }
+        hists = {}
         for item in latencyData:
+            indices = None
+            if item.get('hist'):
+                # 城市对的直方图，同时合并到整体和各 asn/city 分组中
+                indices, values = latency_sketch.decode(base64.b64decode(item['hist']))
+                counts = latency_sketch.new_counts()
+                latency_sketch.add(counts, indices, values)
+                # 缓存中的对象是共享的，不能原地修改
+                item = {**item, **sketch_percentiles(counts)}
+                sketch_add(hists, 'all', indices, values, item['samples'])
             # samples数据汇总
             outdata['sm'] += item['samples']
             # 各种Latency数据汇总
@@ -111,25 +302,28 @@ def webapi_performance(requests):
                 srcobj = cityobjs[item['src']]
                 distobj = cityobjs[item['dist']]
                 # 分cityid的延迟数据分列
-                outdata['latencyData'].append({
-                    # 压缩返回数据体积
-                    'sC': data_layer.friendly_cityname(srcobj), # srcCity
-                    'sA': data_layer.friendly_cityshortasn(srcobj), #srcAsn
-                    'sLa': srcobj['latitude'], #srcLat
-                    'sLo': srcobj['longitude'], #srcLon
-                    'dC': data_layer.friendly_cityname(distobj),
-                    'dA': data_layer.friendly_cityshortasn(distobj),
-                    'dLa': distobj['latitude'],
-                    'dLo': distobj['longitude'],
-                    'sm': int(item['samples']),
-                    'min': round(item['min']/1000, 1),
-                    'max': round(item['max']/1000, 1),
-                    'avg': round(item['avg']/1000, 1),
-                    'p50': round(item['p50']/1000, 1),
-                    'p70': round(item['p70']/1000, 1),
-                    'p90': round(item['p90']/1000, 1),
-                    'p95': round(item['p95']/1000, 1)
-                })
+                if columnar:
+                    columnar_append(outdata['latencyData'], cities, item, cityobjs, LATENCY_SCALE, False)
+                else:
+                    outdata['latencyData'].append({
+                        # 压缩返回数据体积
+                        'sC': data_layer.friendly_cityname(srcobj), # srcCity
+                        'sA': data_layer.friendly_cityshortasn(srcobj), #srcAsn
+                        'sLa': srcobj['latitude'], #srcLat
+                        'sLo': srcobj['longitude'], #srcLon
+                        'dC': data_layer.friendly_cityname(distobj),
+                        'dA': data_layer.friendly_cityshortasn(distobj),
+                        'dLa': distobj['latitude'],
+                        'dLo': distobj['longitude'],
+                        'sm': int(item['samples']),
+                        'min': round(item['min']/1000, 1),
+                        'max': round(item['max']/1000, 1),
+                        'avg': round(item['avg']/1000, 1),
+                        'p50': round(item['p50']/1000, 1),
+                        'p70': round(item['p70']/1000, 1),
+                        'p90': round(item['p90']/1000, 1),
+                        'p95': round(item['p95']/1000, 1)
+                    })
                 # 分asn/city的延迟数据汇总，取p70
                 for key in ('asn','city'):
                     if key == 'asn':
@@ -146,6 +340,8 @@ def webapi_performance(requests):
                         data[key][subkey]['sm'] += item['samples']
                         for datakey in ('min','max','avg','p50','p70','p90','p95'):
                             data[key][subkey][datakey] += item[datakey] * item['samples']
+                        if indices != None:
+                            sketch_add(hists, (key, subkey), indices, values, item['samples'])
         latencyData = None
 
         # 各种Latency数据汇总
@@ -155,6 +351,7 @@ def webapi_performance(requests):
                 outdata[key] = round(outdata[key]['data'] / outdata[key]['sm'] / 1000, 1)
             else:
                 outdata[key] = 0
+        sketch_override(hists, 'all', outdata['sm'], outdata, 1000)
 
         # 分asn/city的延迟数据汇总，取延时情况
         for key in ('asn','city'):
@@ -165,8 +362,10 @@ def webapi_performance(requests):
                 }
                 for datakey in ('min','max','avg','p50','p70','p90','p95'):
                     datas[datakey] = round(data[key][k][datakey] / data[key][k]['sm'] / 1000, 1)
+                sketch_override(hists, (key, k), data[key][k]['sm'], datas, 1000)
                 outdata[key+'Data'].append(datas)
         data = None
+        hists = None
 
     return {
         'statusCode': 200,
@@ -289,7 +488,8 @@ def webapi_city(requests):
         cityset = int(requests['query']['cityset'])
     if 'country' in requests['query'] and len(requests['query']['country']) >= 2:
         result = data_layer.get_citys_by_country_code(requests['query']['country'], cityset)
-    result.insert(0, {"id": "A", "name": "(All)", "latitude": 0.0, "longitude": 0.0})
+    # 查询结果来自进程内缓存，是共享对象，不能原地修改
+    result = [{"id": "A", "name": "(All)", "latitude": 0.0, "longitude": 0.0}] + result
     return {
         'statusCode': 200,
         'result': result
@@ -390,13 +590,6 @@ def webapi_asninfo(requests):
         'result': citys
     }
 
-def is_ip_address(ip_string):
-    try:
-        ipaddress.ip_address(ip_string)
-        return True
-    except ValueError:
-        return False
-
 '''
 requests: {
     version: "apigw-httpapi2.0",
@@ -417,66 +610,15 @@ def fping_logic(requests):
             next = requests['query']['next']
         else:
             next = ''
+        if next.startswith('ping.'):
+            # ping 任务的租约 id 通过 next 参数带回，收到结果即确认，租约到期后不再放回队列
+            data_layer.ack_ping_jobs(next[5:])
         # print(f"receive {len(jobResult)} job")
-        for obj in jobResult:
-            jobtype = obj['jobid'][:4]
-            jobid = int(obj['jobid'][4:])
-            if jobtype == 'ping':
-                # obj['status'] = 0 success 256 partial success or not found any pingable ip
-                # obj['stderr'] -> 1.6.81.7 : duplicate for [0], 64 bytes, 468 ms
-                stdout = obj['stdout'].split('\n')
-                ips = []
-                for out in stdout:
-                    # Enough hosts reachable (required: 100, reachable: 100)
-                    if out == '' or out.startswith('[DEBUG]'):
-                        continue
-                    if is_ip_address(out):
-                        ips.append(out)
-                #print(f"pingjob: {jobid} status: {obj['status']} ips: {len(ips)}")
-                # print(ips)
-                if len(ips) > 0:
-                    data_layer.update_pingable_ip(jobid, ips)
-                    data_layer.update_speed_status(jobtype, len(ips), False)
-            elif jobtype == 'data':
-                #print(f"datajob: {jobid} status: {obj['status']}")
-                #print(obj['stdout'])
-                #print(obj['stderr'])
-                # stdout:
-                # [DEBUG] CPU time used: 0.083289 sec
-                # stderr:
-                # 2.17.168.71 : 370 370 370 370 373 370 370 370 370 370 370
-                # 2.17.168.93 : 358 358 358 358 363 358 358 358 358 358 358
-                # 2.17.168.76 : 358 358 358 358 358 359 358 358 358 358 358
-                # 38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
-                samples = []
-                for stderr in obj['stderr'].split('\n'):
-                    if stderr.find('duplicate') != -1:
-                        continue
-                    for data in stderr.split(' '):
-                        try:
-                            samples.append(float(data))
-                        except ValueError:
-                            pass
-                n = len(samples)
-                if len(samples)>0:
-                    # numpy 库太大了，这里简单实现一下
-                    # arr = np.array(samples)
-                    sorted_data = sorted(samples)
-                    datas = {
-                        'src_city_id': city_id,
-                        'dist_city_id': jobid,
-                        'samples': n,
-                        'latency_min': int(sorted_data[0] * 1000), #min(samples), #np.min(arr),
-                        'latency_max': int(sorted_data[n-1] * 1000), #max(samples), #np.max(arr),
-                        'latency_avg': int(sum(sorted_data) * 1000 / n), #np.mean(arr),
-                        'latency_p50': int(data_layer.np_percentile(sorted_data, 50) * 1000), #np.percentile(arr, 50),
-                        'latency_p70': int(data_layer.np_percentile(sorted_data, 70) * 1000), #np.percentile(arr, 70),
-                        'latency_p90': int(data_layer.np_percentile(sorted_data, 90) * 1000), #np.percentile(arr, 90),
-                        'latency_p95': int(data_layer.np_percentile(sorted_data, 95) * 1000), #np.percentile(arr, 95),
-                    }
-                    data_layer.update_statistics_data(datas)
-                    data_layer.delete_oldest_statistics_data(city_id, jobid)
-                    data_layer.update_speed_status(jobtype, len(samples), False)
+        if settings.INGEST_MODE == 'stream':
+            # 只把原始结果写入 Redis stream 后立即返回，由 ingest 函数批量写入数据库
+            data_layer.enqueue_job_results(city_id, requests['body'])
+        else:
+            data_layer.write_job_results(*data_layer.parse_job_results(city_id, jobResult))
 
     if requests['useragent'].startswith('fping-pingable'):
         ttl = data_layer.update_client_status(requests['srcip'], 'ping')
@@ -486,23 +628,21 @@ def fping_logic(requests):
         else:
             # get ping job here, ensure buffer data enough
             data_layer.refresh_iprange_check()
-            for i in range(0, 20):
-                obj = data_layer.cache_pop(settings.CACHEKEY_PINGABLE)
-                if obj:
-                    stip = ipaddress.IPv4Address(obj['start_ip'])
-                    etip = ipaddress.IPv4Address(obj['end_ip'])
-                    #print(f"fetch ping job: {stip} {etip} {obj['city_id']}")
-                    ret["job"].append({
-                        "jobid": 'ping' + str(obj['city_id']),
-                        # disable stderr log here with 2> /dev/null , but it will cause error
-                        # only found 100 max pingable ip to save time
-                        "command": f"fping -g {stip} {etip} -r 2 -a -q -X 100",
-                    })
-                else:
-                    break
+            # 一次往返取出最多 20 个任务，并作为一个租约等待客户端提交结果
+            lease_id, objs = data_layer.dispatch_ping_jobs(20)
+            for obj in objs:
+                stip = ipaddress.IPv4Address(obj['start_ip'])
+                etip = ipaddress.IPv4Address(obj['end_ip'])
+                #print(f"fetch ping job: {stip} {etip} {obj['city_id']}")
+                ret["job"].append({
+                    "jobid": 'ping' + str(obj['city_id']),
+                    # disable stderr log here with 2> /dev/null , but it will cause error
+                    # only found 100 max pingable ip to save time
+                    "command": f"fping -g {stip} {etip} -r 2 -a -q -X 100",
+                })
             # print(f"fetch {len(ret['job'])} ping job")
             if len(ret["job"]) > 0:
-                ret["next"] = 'ping'
+                ret["next"] = 'ping.' + lease_id
                 ret["interval"] = 1
                 data_layer.update_speed_status('ping', len(ret["job"]), True)
     else:
@@ -511,18 +651,13 @@ def fping_logic(requests):
         if isinstance(ttl, str):
             ret["interval"] = int(ttl)
         else:
-            for i in range(0, 10):
-                job = data_layer.get_pingjob_by_cityid(city_id)
-                #print(job)
-                if job != None:
-                    ips = [str(ipaddress.IPv4Address(x)) for x in job['ips']]
-                    #print(f"fetch data job: {job['city_id']} {len(ips)}")
-                    ret["job"].append({
-                        "jobid": 'data' + str(job['city_id']),
-                        "command": "fping -a -q -C 11 " + ' '.join(ips),
-                    })
-                else:
-                    break
+            for job in data_layer.get_pingjobs_by_cityid(city_id, 10):
+                ips = [str(ipaddress.IPv4Address(x)) for x in job['ips']]
+                #print(f"fetch data job: {job['city_id']} {len(ips)}")
+                ret["job"].append({
+                    "jobid": 'data' + str(job['city_id']),
+                    "command": "fping -a -q -C 11 " + ' '.join(ips),
+                })
             # print(f"fetch {len(ret['job'])} data job")
             if len(ret['job']) > 0:
                 ret["next"] = "data"
@@ -550,6 +685,7 @@ def lambda_handler(event, context):
                 'path': event['requestContext']['http']['path'],
                 'query': event['queryStringParameters'],
                 'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+                'acceptencoding': event['headers'].get('accept-encoding', event['headers'].get('Accept-Encoding', '')),
             }
         elif event['version'] == '1.0':
             requests = {
@@ -562,6 +698,7 @@ def lambda_handler(event, context):
                 'path': event['requestContext']['path'],
                 'query': event['queryStringParameters'],
                 'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+                'acceptencoding': event['headers'].get('accept-encoding', event['headers'].get('Accept-Encoding', '')),
             }
     else:
         # 兼容 ALB
@@ -580,6 +717,7 @@ def lambda_handler(event, context):
             'path': event['path'],
             'query': event['queryStringParameters'],
             'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+            'acceptencoding': event['headers'].get('accept-encoding', ''),
         }
     requests['next'] = requests['query']['next'] if 'next' in requests['query'] else ''
     apimapping = {
@@ -621,6 +759,21 @@ def lambda_handler(event, context):
     #ret['result']['requests'] = requests;
     headers = ret['headers'] if 'headers' in ret else {"Content-Type": "application/json"}
     body = json.dumps(ret['result']) if headers['Content-Type'] == 'application/json' else ret['result']
+    # 按 Accept-Encoding 压缩响应体，压缩后以 base64 返回，同时减少 alb 1MB 响应限制的占用
+    compressed, encoding = http_compress.compress_body(body, requests.get('acceptencoding', ''), settings.COMPRESS_MIN_SIZE)
+    if compressed != None and len(compressed) > settings.RESPONSE_MAX_BYTES and 'fallback' in ret:
+        print(f'compressed response {len(compressed)} bytes exceeds limit, repage.')
+        ret = ret['fallback']()
+        body = json.dumps(ret['result'])
+        compressed, encoding = http_compress.compress_body(body, requests.get('acceptencoding', ''), settings.COMPRESS_MIN_SIZE)
+    if compressed != None:
+        headers = {**headers, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+        return {
+            'statusCode': ret['statusCode'],
+            "headers": headers,
+            'body': compressed,
+            'isBase64Encoded': True
+        }
     return {
         'statusCode': ret['statusCode'],
         "headers": headers,
@@ -53,6 +53,7 @@ CREATE TABLE IF NOT EXISTS `pingable` (
 ) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '可ping ip列表';
 
 CREATE TABLE IF NOT EXISTS `statistics` (
+    `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY COMMENT '行id，用于分页游标',
     `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
     `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
     `samples` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '样本数',
@@ -63,6 +64,7 @@ CREATE TABLE IF NOT EXISTS `statistics` (
     `latency_p70` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p70延时us',
     `latency_p90` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p90延时us',
     `latency_p95` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p95延时us',
+    `latency_hist` VARBINARY(1024) DEFAULT NULL COMMENT '延迟直方图，latency_sketch 编码',
     `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
     KEY `src_city_id` (`src_city_id`),
     KEY `dist_city_id` (`dist_city_id`),
@@ -70,6 +72,51 @@ CREATE TABLE IF NOT EXISTS `statistics` (
     INDEX `idx_src_dist_city` (`src_city_id`, `dist_city_id`)
 ) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据';
 
+CREATE TABLE IF NOT EXISTS `statistics_ring` (
+    `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
+    `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
+    `slot` SMALLINT UNSIGNED NOT NULL COMMENT '环形缓冲槽位 = seq % MAX_RECORDS_PER_CITYID',
+    `samples` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '样本数',
+    `latency_min` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最小延时us',
+    `latency_max` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最大延时us',
+    `latency_avg` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '平均延时us',
+    `latency_p50` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p50延时us',
+    `latency_p70` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p70延时us',
+    `latency_p90` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p90延时us',
+    `latency_p95` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p95延时us',
+    `latency_hist` VARBINARY(1024) DEFAULT NULL COMMENT '延迟直方图，latency_sketch 编码',
+    `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (`src_city_id`, `dist_city_id`, `slot`),
+    KEY `dist_city_id` (`dist_city_id`),
+    KEY `update_time` (`update_time`)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据（环形缓冲存储）';
+
+CREATE TABLE IF NOT EXISTS `statistics_counter` (
+    `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
+    `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
+    `seq` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '已写入的记录序号',
+    `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (`src_city_id`, `dist_city_id`)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据环形缓冲序号';
+
+CREATE TABLE IF NOT EXISTS `statistics_summary` (
+    `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
+    `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
+    `records` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '汇总的记录条数',
+    `samples` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '样本数',
+    `latency_min` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最小延时us',
+    `latency_max` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最大延时us',
+    `latency_avg` DOUBLE NOT NULL DEFAULT 0 COMMENT '平均延时us',
+    `latency_p50` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p50延时us',
+    `latency_p70` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p70延时us',
+    `latency_p90` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p90延时us',
+    `latency_p95` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p95延时us',
+    `latency_hist` VARBINARY(1024) DEFAULT NULL COMMENT '所有记录合并后的延迟直方图',
+    `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (`src_city_id`, `dist_city_id`),
+    KEY `dist_city_id` (`dist_city_id`)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据按城市对汇总';
+
 CREATE TABLE IF NOT EXISTS `cityset` (
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY COMMENT 'id',
     `name` varchar(32) NOT NULL COMMENT '集合名字',
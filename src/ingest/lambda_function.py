@@ -0,0 +1,58 @@
+import json
+import os
+import time
+import socket
+import data_layer
+
+# 异步写入任务结果（INGEST_MODE=stream 时使用），每分钟由 EventBridge 定时触发
+# 通过消费组从 Redis stream 批量读取 /job POST 的原始结果，合并后写入 pingable 和 statistics 表
+# 同时定期把状态页计数与数据库对账
+# 也可以作为常驻进程运行：python3 lambda_function.py '{"loop":true}'
+
+# 距离函数超时还有多少毫秒时停止读取新消息
+STOP_MARGIN_MS = 30000
+
+def consumer_name(context):
+    # 每个函数实例（或进程）使用不同的消费者名称，未确认的消息可以被其他实例认领
+    if context:
+        return context.log_stream_name.split(']')[-1] or context.aws_request_id
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def lambda_handler(event, context):
+    consumer = consumer_name(context)
+    if context:
+        deadline = time.time() + (context.get_remaining_time_in_millis() - STOP_MARGIN_MS) / 1000
+    else:
+        deadline = time.time() + 60
+    start = time.time()
+    messages, statistics = data_layer.consume_job_results(consumer, deadline)
+    # 定时触发时顺便对账状态页计数，租约保证每 STATISTICS_RECONCILE_INTERVAL 秒最多一次
+    reconciled = data_layer.maybe_reconcile_statistics_counters()
+    ret = {
+        'status': 200,
+        'msg': {
+            'consumer': consumer,
+            'messages': messages,
+            'statistics': statistics,
+            'reconciled': reconciled,
+            'elapsed': round(time.time() - start, 3),
+            'stream': data_layer.get_ingest_status(),
+        }
+    }
+    print(ret)
+    return ret
+
+# local test
+if __name__ == "__main__":
+    import sys
+    event = json.loads(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] else {}
+    if event.get('loop'):
+        # 常驻进程模式，stream 为空时阻塞等待新消息
+        while True:
+            try:
+                data_layer.consume_job_results(consumer_name(None), time.time() + 3600, block_ms=5000)
+            except Exception as e:
+                print('ingest failed.', repr(e))
+                time.sleep(5)
+    else:
+        print(lambda_handler(event, None))
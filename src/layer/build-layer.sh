@@ -2,7 +2,7 @@
 
 VERSION="3.12"
 # 需要分别在 x86_64 和 arm64 机器上运行docker，得到两个库
-PYTHON_LIB="PyMysql redis requests"
+PYTHON_LIB="PyMysql redis requests msgpack"
 ARCHS="x86_64 arm64"
 
 TMP_PATH=$(mktemp -d)
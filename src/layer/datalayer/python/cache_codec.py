@@ -0,0 +1,72 @@
+import json
+import zlib
+
+# msgpack 不在默认的 pythonlib 层中，安装后自动启用，编码和解码速度比 json 快
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Redis 缓存值的编解码，值的第一个字节为格式头：
+# 0x01 json，0x02 json+zlib，0x03 msgpack，0x04 msgpack+zlib
+# 旧版本直接写入的 json 文本第一个字节都是可见字符（>= 0x20），读取时按 json 处理，不需要迁移
+FORMAT_JSON = 1
+FORMAT_JSON_ZLIB = 2
+FORMAT_MSGPACK = 3
+FORMAT_MSGPACK_ZLIB = 4
+
+# 超过该字节数的值使用 zlib 压缩
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 1
+
+class CacheCodecError(ValueError):
+    pass
+
+def encode(value, use_msgpack:bool = True, compress_min_size:int = COMPRESS_MIN_SIZE):
+    # 返回 (编码后的 bytes, 压缩前的字节数)，后者用于估算进程内缓存的内存占用
+    fmt = FORMAT_JSON
+    data = None
+    if use_msgpack and msgpack:
+        try:
+            data = msgpack.packb(value, use_bin_type=True)
+            fmt = FORMAT_MSGPACK
+        except (TypeError, ValueError, OverflowError):
+            data = None
+    if data == None:
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    size = len(data)
+    if size >= compress_min_size:
+        data = zlib.compress(data, COMPRESS_LEVEL)
+        fmt += 1
+    return bytes((fmt,)) + data, size
+
+def decode(data):
+    # 返回 (值, 压缩前的字节数)，无法识别的格式抛出 CacheCodecError
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if len(data) == 0:
+        raise CacheCodecError('empty value')
+    fmt = data[0]
+    if fmt >= 0x20:
+        return json.loads(data), len(data)
+    payload = data[1:]
+    if fmt in (FORMAT_JSON_ZLIB, FORMAT_MSGPACK_ZLIB):
+        payload = zlib.decompress(payload)
+        fmt -= 1
+    if fmt == FORMAT_JSON:
+        return json.loads(payload), len(payload)
+    if fmt == FORMAT_MSGPACK:
+        if msgpack == None:
+            raise CacheCodecError('msgpack not installed')
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False), len(payload)
+    raise CacheCodecError(f'unknown cache format {fmt}')
+
+def format_name(data):
+    if not data:
+        return None
+    return {
+        FORMAT_JSON: 'json',
+        FORMAT_JSON_ZLIB: 'json+zlib',
+        FORMAT_MSGPACK: 'msgpack',
+        FORMAT_MSGPACK_ZLIB: 'msgpack+zlib',
+    }.get(data[0], 'legacy-json' if data[0] >= 0x20 else 'unknown')
@@ -5,13 +5,27 @@ import re
 import json
 import time
 import hashlib
+import math
+import random
+import os
 import settings
 import boto3
 from onlineip_tracker import OnlineIPTracker
 from typing import List, Dict, Any
 from botocore.exceptions import ClientError
 from password_validator import EnhancedPasswordValidator
-from speed_counter import SpeedCounter
+from speed_counter import SpeedCounter, read_speed_counters
+from iprange_index import IPRangeIndex
+from mysql_pool import MySQLPool
+from local_cache import LocalCache
+from pingable_targets import PingableTargets
+from liveness_bitmap import LivenessBitmap
+from pair_scheduler import PairScheduler
+from job_lease import JobLeaseQueue
+from stat_counters import StatCounters
+import latency_sketch
+import fping_parser
+import cache_codec
 
 import pymysql
 from pymysql.constants import FIELD_TYPE
@@ -32,6 +46,14 @@ redis_pool = redis.ConnectionPool(
     connection_class=redis.SSLConnection,
     socket_timeout=5,
     socket_connect_timeout=5)
+# 缓存值经过 cache_codec 编码后是二进制数据，需要使用不解码响应的连接池
+redis_binary_pool = redis.ConnectionPool(
+    host=settings.CACHE_HOST,
+    port=settings.CACHE_PORT,
+    decode_responses=False,
+    connection_class=redis.SSLConnection,
+    socket_timeout=5,
+    socket_connect_timeout=5)
 
 def myhash(text):
     if not isinstance(text, str):
@@ -40,10 +62,31 @@ def myhash(text):
     sha256_hash = hashlib.sha256(text_bytes)
     return sha256_hash.hexdigest()[:32]
 
-def get_mysql_connect(need_write = False, need_multi = False, db = settings.DB_DATABASE):
+def get_mysql_connect(need_write = False, need_multi = False, db = settings.DB_DATABASE, autocommit = False):
     host = settings.DB_WRITE_HOST if need_write else settings.DB_READ_HOST
     client_flag = pymysql.constants.CLIENT.MULTI_STATEMENTS if need_multi else 0
-    return pymysql.connect(host=host, user=settings.DB_USER, passwd=settings.DB_PASS, db=db, charset='utf8mb4', port=settings.DB_PORT, client_flag=client_flag, conv=conv)
+    return pymysql.connect(host=host, user=settings.DB_USER, passwd=settings.DB_PASS, db=db, charset='utf8mb4', port=settings.DB_PORT, client_flag=client_flag, conv=conv, autocommit=autocommit)
+
+# 读写分离的连接池，容器热启动期间复用
+# 读连接使用 autocommit，避免长连接停留在同一个一致性快照中读到旧数据
+mysql_pools = {
+    False: MySQLPool(lambda: get_mysql_connect(False, autocommit=True), settings.DB_POOL_READ_SIZE,
+        settings.DB_POOL_MAX_IDLE, settings.DB_POOL_CHECK_INTERVAL),
+    True: MySQLPool(lambda: get_mysql_connect(True), settings.DB_POOL_WRITE_SIZE,
+        settings.DB_POOL_MAX_IDLE, settings.DB_POOL_CHECK_INTERVAL),
+}
+
+# with mysql_connection(True) as conn: 从连接池借出连接，结束后自动归还，异常时丢弃
+def mysql_connection(need_write = False):
+    return mysql_pools[need_write].connection()
+
+# 连接断开类错误，读操作可以换一个新连接重试
+MYSQL_RECONNECT_ERRORS = {2006, 2013, 2055}
+
+def is_mysql_disconnect(e:Exception):
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    return isinstance(e, pymysql.err.OperationalError) and len(e.args) > 0 and e.args[0] in MYSQL_RECONNECT_ERRORS
 
 def mysql_create_database(database:str = None):
     if database == None:
@@ -85,25 +128,28 @@ def fetch_all_to_dict(cursor: pymysql.cursors.Cursor) -> List[Dict[str, Any]]:
 # 执行写
 def mysql_execute(sql:str, obj = None):
     #pymysql.connections.DEBUG = True
-    conn = get_mysql_connect(True)
-    cursor = conn.cursor()
-    cursor.execute(sql, obj)
-    results = cursor.fetchall()
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, obj)
+            results = cursor.fetchall()
+        conn.commit()
     return results
 
-def mysql_select(sql:str, obj = None, fetchObject = True):
-    conn = get_mysql_connect(False)
-    cursor = conn.cursor()
-    cursor.execute(sql, obj)
-    if fetchObject:
-        results = fetch_all_to_dict(cursor)
-    else:
-        results = cursor.fetchall()
-    cursor.close()
-    conn.close()
+def mysql_select(sql:str, obj = None, fetchObject = True, retry = 1):
+    try:
+        with mysql_connection(False) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, obj)
+                if fetchObject:
+                    results = fetch_all_to_dict(cursor)
+                else:
+                    results = cursor.fetchall()
+    except Exception as e:
+        # 复用的连接可能已被断开，换新连接重试
+        if retry > 0 and is_mysql_disconnect(e):
+            print('mysql select reconnect.', repr(e))
+            return mysql_select(sql, obj, fetchObject, retry - 1)
+        raise
     return results
 
 # 会打印结果
@@ -156,6 +202,10 @@ def mysql_batch_execute(sql: str):
                 conn.commit()
         if affected_rows > 0:
             print(f"共影响行数: {affected_rows}")
+        if any(result['type'] == 'update' for result in results):
+            # 批量执行（如导入数据）可能修改任意表，所有查询缓存失效，状态页计数重新对账
+            bump_cache_generation()
+            clear_statistics_counters()
 
     except Exception as e:
         print(f"{sql}\n错误: {str(e)}")
@@ -172,12 +222,27 @@ def mysql_select_onevalue(sql:str, obj = None, default = 0):
         return default
     return row[0][0]
 
+# 两级缓存：进程内 LRU -> Redis -> MySQL，本地缓存保存反序列化后的对象，返回值不能被修改
+local_cache = LocalCache(settings.LOCAL_CACHE_MAX_BYTES, settings.LOCAL_CACHE_MAX_TTL)
+redis_cache_stats = {'hit': 0, 'miss': 0, 'stale': 0, 'refresh': 0, 'wait': 0}
+
+def cache_encode(value):
+    return cache_codec.encode(value, settings.CACHE_CODEC_MSGPACK, settings.CACHE_COMPRESS_MIN_SIZE)
+
+def cache_decode(raw):
+    # 返回 (值, 压缩前的字节数)，无法解码（如其他版本写入的格式）时按未命中处理
+    try:
+        return cache_codec.decode(raw)
+    except Exception as e:
+        print('cache decode failed.', repr(e))
+        return None, 0
+
 def cache_get(key:str):
     try:
-        r = redis.StrictRedis(connection_pool=redis_pool)
+        r = redis.StrictRedis(connection_pool=redis_binary_pool)
         ret = r.get(key)
         if ret:
-            ret = json.loads(ret)
+            ret = cache_decode(ret)[0]
         return ret
     except Exception as e:
         print('cache get failed.', repr(e))
@@ -185,16 +250,18 @@ def cache_get(key:str):
 
 def cache_set(key:str, value, ttl:int = settings.CACHE_BASE_TTL):
     try:
-        r = redis.StrictRedis(connection_pool=redis_pool)
+        local_cache.delete(key)
+        r = redis.StrictRedis(connection_pool=redis_binary_pool)
         if ttl == 0:
-            return r.set(key, json.dumps(value))
-        return r.setex(key, ttl, json.dumps(value))
+            return r.set(key, cache_encode(value)[0])
+        return r.setex(key, ttl, cache_encode(value)[0])
     except Exception as e:
         print('cache set failed.', repr(e) , key, ttl, value)
         return None
 
 def cache_delete(key:str):
     try:
+        local_cache.delete(key)
         r = redis.StrictRedis(connection_pool=redis_pool)
         return r.delete(key)
     except Exception as e:
@@ -246,7 +313,11 @@ def cache_dump(key:str):
             'ttl': r.ttl(key)
         }
         if key_type == 'string':
-            details['value'] = r.get(key)
+            # 缓存值可能是 cache_codec 编码的二进制数据，解码后返回
+            raw = redis.StrictRedis(connection_pool=redis_binary_pool).get(key)
+            details['format'] = cache_codec.format_name(raw)
+            details['bytes'] = len(raw) if raw else 0
+            details['value'] = cache_decode(raw)[0] if raw else raw
         elif key_type == 'list':
             details['length'] = r.llen(key)
             details['value'] = r.lrange(key, 0, -1)
@@ -264,102 +335,368 @@ def cache_dump(key:str):
         print('cache dump failed.', repr(e), key)
         return None
 
-def cache_mysql_get_onevalue(sql:str, default = 0, ttl:int = settings.CACHE_BASE_TTL):
-    key = settings.CACHEKEY_SQL + 'ov_' + myhash(sql)
-    val = cache_get(key)
-    if val != None:
-        return val
-    ret = mysql_select_onevalue(sql, default = default)
-    cache_set(key, ret, ttl)
-    return ret
+# 缓存值外层包装逻辑过期时间：{'v': 值, 'e': 逻辑过期时间戳（0 为不过期）, 'd': 上次加载耗时}
+# Redis 中的实际过期时间比逻辑过期时间多 CACHE_STALE_TTL 秒，这段时间内的旧值可以在其他请求刷新时继续使用
+CACHE_UNLOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+def cache_envelope_encode(val, ttl:int, delta:float):
+    expire = time.time() + ttl if ttl > 0 else 0
+    return cache_encode({'v': val, 'e': expire, 'd': delta})
+
+def cache_envelope_set(r, key:str, val, ttl:int, delta:float):
+    raw, size = cache_envelope_encode(val, ttl, delta)
+    if ttl == 0:
+        r.set(key, raw)
+    else:
+        r.setex(key, ttl + settings.CACHE_STALE_TTL, raw)
+    return size
+
+def cache_envelope_decode(raw):
+    # 返回 (值, 逻辑过期时间, 加载耗时, 字节数)，不是有效的包装格式时返回值为 None
+    env, size = cache_decode(raw) if raw else (None, 0)
+    if not isinstance(env, dict) or 'v' not in env:
+        return None, 0, 0, 0
+    return env['v'], env['e'], env['d'], size
+
+def cache_should_refresh(expire:float, delta:float, now:float):
+    # 概率提前刷新（XFetch）：越接近过期、加载越慢，越可能提前刷新，避免热点 key 在同一时刻集中过期
+    if expire == 0:
+        return False
+    if now >= expire:
+        return True
+    beta = settings.CACHE_EARLY_REFRESH_BETA
+    return beta > 0 and now - delta * beta * math.log(1.0 - random.random()) >= expire
 
-def delete_mysql_select_cache(sql:str, obj = None, fetchObject = True):
-    key = settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject))
-    return cache_delete(key)
+def cache_lock(r, key:str):
+    token = os.urandom(8).hex()
+    try:
+        if r.set(key + ':lock', token, nx=True, px=settings.CACHE_LOCK_MS):
+            return token
+    except Exception as e:
+        print('cache lock failed.', repr(e), key)
+        # Redis 不可用时直接查询数据库
+        return ''
+    return None
+
+def cache_unlock(r, key:str, token:str):
+    if not token:
+        return
+    try:
+        r.eval(CACHE_UNLOCK_SCRIPT, 1, key + ':lock', token)
+    except Exception as e:
+        print('cache unlock failed.', repr(e), key)
 
-def cache_mysql_select(sql:str, obj = None, fetchObject = True, ttl:int = settings.CACHE_BASE_TTL):
-    key = settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject))
-    val = cache_get(key)
+def two_tier_cache_get(key:str, loader, ttl:int = settings.CACHE_BASE_TTL):
+    val = local_cache.get(key)
     if val != None:
         return val
-    ret = mysql_select(sql, obj, fetchObject)
-    cache_set(key, ret, ttl)
-    return ret
+    r = redis.StrictRedis(connection_pool=redis_binary_pool)
+    raw = None
+    try:
+        raw = r.get(key)
+    except Exception as e:
+        print('cache get failed.', repr(e))
+    val, expire, delta, size = cache_envelope_decode(raw)
+    now = time.time()
+    if val != None and not cache_should_refresh(expire, delta, now):
+        redis_cache_stats['hit'] += 1
+        local_cache.set(key, val, max(int(expire - now), 1) if expire else ttl, size)
+        return val
+    # 未命中、已过期或被选中提前刷新：只有拿到锁的请求查询数据库
+    token = cache_lock(r, key)
+    if token == None:
+        if val != None:
+            # 其他请求正在刷新，先返回旧值
+            redis_cache_stats['stale' if now >= expire else 'hit'] += 1
+            return val
+        # 没有旧值时短暂轮询等待拿到锁的请求写入结果，最多 CACHE_LOCK_WAIT_MS，超时后直接查询数据库，避免 API 请求长时间阻塞
+        redis_cache_stats['wait'] += 1
+        deadline = now + settings.CACHE_LOCK_WAIT_MS / 1000
+        while time.time() < deadline:
+            time.sleep(settings.CACHE_LOCK_POLL_MS / 1000)
+            try:
+                val, expire, delta, size = cache_envelope_decode(r.get(key))
+            except Exception as e:
+                print('cache get failed.', repr(e))
+                break
+            if val != None:
+                redis_cache_stats['hit'] += 1
+                local_cache.set(key, val, ttl, size)
+                return val
+    redis_cache_stats['miss' if val == None else 'refresh'] += 1
+    try:
+        start = time.time()
+        val = loader()
+        if val == None:
+            return None
+        try:
+            size = cache_envelope_set(r, key, val, ttl, time.time() - start)
+        except Exception as e:
+            print('cache set failed.', repr(e), key, ttl)
+            size = cache_encode(val)[1]
+    finally:
+        cache_unlock(r, key, token)
+    local_cache.set(key, val, ttl, size)
+    return val
+
+def get_cache_metrics():
+    return {
+        'local': local_cache.get_metrics(),
+        'redis': redis_cache_stats,
+        'mysql_pool': {'read': mysql_pools[False].get_metrics(), 'write': mysql_pools[True].get_metrics()},
+    }
+
+def cache_mysql_get_onevalue(sql:str, default = 0, ttl:int = settings.CACHE_BASE_TTL, tables = ()):
+    key = settings.CACHEKEY_SQL + 'ov_' + myhash(sql + sql_cache_generation(tables))
+    return two_tier_cache_get(key, lambda: mysql_select_onevalue(sql, default = default), ttl)
+
+# 目录类表的缓存代数，保存在一个 Redis hash 中，调用方通过 tables 参数声明查询依赖的表，缓存 key 包含这些表的代数
+# 写入时递增对应表的代数，依赖该表的所有缓存 key 随之改变，旧 key 等待过期，因此读缓存可以使用较长的过期时间
+# 统计数据每次上报都会写入，不使用代数（否则全部统计查询缓存不断失效），读取统计表的查询使用较短的 STATISTICS_QUERY_TTL
+CACHE_GENERATION_TABLES = ('cityset', 'city', 'asn', 'iprange', 'country', 'pingable')
+cache_generations = {'values': {}, 'time': 0}
+
+def get_cache_generations():
+    # 代数在进程内缓存 CACHE_GENERATION_TTL 秒，其他容器的写入最多延迟这么久生效
+    now = time.time()
+    if now - cache_generations['time'] >= settings.CACHE_GENERATION_TTL:
+        try:
+            r = redis.StrictRedis(connection_pool=redis_pool)
+            cache_generations['values'] = {k: int(v) for k, v in r.hgetall(settings.CACHEKEY_GENERATION).items()}
+            cache_generations['time'] = now
+        except Exception as e:
+            print('cache generation get failed.', repr(e))
+    return cache_generations['values']
+
+def bump_cache_generation(*tables):
+    if len(tables) == 0:
+        tables = CACHE_GENERATION_TABLES
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        pipe = r.pipeline(transaction=False)
+        for table in tables:
+            pipe.hincrby(settings.CACHEKEY_GENERATION, table, 1)
+        for table, value in zip(tables, pipe.execute()):
+            cache_generations['values'][table] = int(value)
+    except Exception as e:
+        print('cache generation bump failed.', repr(e), tables)
+
+def mysql_select_cache_key(sql:str, obj = None, fetchObject = True, tables = ()):
+    # 值为带逻辑过期时间的包装格式，同一 key 下旧版本写入的值可以解码但不是包装格式，按未命中处理并覆盖
+    return settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject) + sql_cache_generation(tables))
+
+def sql_cache_generation(tables):
+    if len(tables) == 0:
+        return ''
+    generations = get_cache_generations()
+    return '|' + ','.join(f'{table}{generations.get(table, 0)}' for table in sorted(tables))
+
+def delete_mysql_select_cache(sql:str, obj = None, fetchObject = True, tables = ()):
+    return cache_delete(mysql_select_cache_key(sql, obj, fetchObject, tables))
+
+def cache_mysql_select(sql:str, obj = None, fetchObject = True, ttl:int = settings.CACHE_BASE_TTL, tables = ()):
+    key = mysql_select_cache_key(sql, obj, fetchObject, tables)
+    return two_tier_cache_get(key, lambda: mysql_select(sql, obj, fetchObject), ttl)
+
+# 延迟统计数据的存储方式，table 为按时间追加并清理旧数据，ring 为每个城市对固定槽位的环形缓冲
+STATISTICS_TABLE = 'statistics_ring' if settings.STATISTICS_STORAGE == 'ring' else 'statistics'
 
 def get_countrys(cityset:int = 0):
     if cityset != 0:
         # FIND_IN_SET(src_city_id, (SELECT cityids FROM cityset WHERE id = %s)) 无法使用索引，所以先查出cityids再用in
-        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,))
+        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,), ttl=settings.CACHE_LONG_TTL, tables=('cityset',))
         if rows and len(rows) > 0:
             cityids = rows[0]['cityids']
-            return cache_mysql_select('''select code,name from country where code in
+            return cache_mysql_select(f'''select code,name from country where code in
 (
     select country_code from city where id in (
-        select dist_city_id from statistics where src_city_id in (%s) group by dist_city_id
+        select dist_city_id from {STATISTICS_TABLE} where src_city_id in (%s) group by dist_city_id
     ) group by country_code
-)''', (cityids,))
-    return cache_mysql_select('select code,name from country order by code', ttl=settings.CACHE_LONG_TTL)
+)''', (cityids,), ttl=settings.STATISTICS_QUERY_TTL, tables=('country', 'city'))
+    return cache_mysql_select('select code,name from country order by code', ttl=settings.CACHE_LONG_TTL, tables=('country',))
 
 def get_citys_by_country_code(country_code, cityset:int = 0):
     if cityset != 0:
         # FIND_IN_SET(src_city_id, (SELECT cityids FROM cityset WHERE id = %s)) 无法使用索引，所以先查出cityids再用in
-        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,))
+        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,), ttl=settings.CACHE_LONG_TTL, tables=('cityset',))
         if rows and len(rows) > 0:
             cityids = rows[0]['cityids']
-            return cache_mysql_select('''SELECT name as id,name,latitude,longitude FROM city WHERE country_code = %s and id in
+            return cache_mysql_select(f'''SELECT name as id,name,latitude,longitude FROM city WHERE country_code = %s and id in
 (
-    select dist_city_id from statistics where src_city_id in (%s) group by dist_city_id
-) group by name''', (country_code,cityids))
+    select dist_city_id from {STATISTICS_TABLE} where src_city_id in (%s) group by dist_city_id
+) group by name''', (country_code,cityids), ttl=settings.STATISTICS_QUERY_TTL, tables=('city',))
     return cache_mysql_select(
-        'SELECT name as id,name,latitude,longitude FROM city WHERE country_code = %s group by name', (country_code,))
+        'SELECT name as id,name,latitude,longitude FROM city WHERE country_code = %s group by name', (country_code,), ttl=settings.CACHE_LONG_TTL, tables=('city',))
 
-def get_cityobject(filter:str, obj = None, limit:int = 50):
-    return cache_mysql_select('''
+CITYOBJECT_SELECT = '''
 select c.id as cityId,a.asn as asn,c.country_code as country,
 COALESCE(c.friendly_name, c.name) as name,c.region as region,
 a.name as asnName, a.domain as domain,
 c.latitude as latitude, c.longitude as longitude,
 a.type as asnType,a.ipcounts as ipcounts,
 INET_NTOA(i.start_ip) as startIp, INET_NTOA(i.end_ip) as endIp from city as c, asn as a,iprange as i
- where c.id = i.city_id and c.asn=a.asn and ''' + filter + f' limit {limit}', obj)
+ where c.id = i.city_id and c.asn=a.asn and '''
+CITYOBJECT_TABLES = ('city', 'asn', 'iprange')
+
+def get_cityobject(filter:str, obj = None, limit:int = 50, ttl:int = settings.CACHE_LONG_TTL):
+    return cache_mysql_select(CITYOBJECT_SELECT + filter + f' limit {limit}', obj, ttl=ttl, tables=CITYOBJECT_TABLES)
 
 def get_asns_by_country(country_code, cityset:int = 0):
     if cityset != 0:
         # FIND_IN_SET(src_city_id, (SELECT cityids FROM cityset WHERE id = %s)) 无法使用索引，所以先查出cityids再用in
-        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,))
+        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,), ttl=settings.CACHE_LONG_TTL, tables=('cityset',))
         if rows and len(rows) > 0:
             cityids = rows[0]['cityids']
-            return get_cityobject('''c.country_code = %s and c.id in
+            return get_cityobject(f'''c.country_code = %s and c.id in
 (
-    select dist_city_id from statistics where src_city_id in (%s) group by dist_city_id
-) group by c.id,c.asn''',(country_code,cityids)) #这里加了 ,c.asn 为了把多条cidr记录合并
+    select dist_city_id from {STATISTICS_TABLE} where src_city_id in (%s) group by dist_city_id
+) group by c.id,c.asn''',(country_code,cityids),ttl=settings.STATISTICS_QUERY_TTL) #这里加了 ,c.asn 为了把多条cidr记录合并
     return get_cityobject("c.country_code = %s group by c.id,c.asn",(country_code,))
 
 def get_asns_by_country_city(country_code, city_name, cityset:int = 0):
     if cityset != 0:
         # FIND_IN_SET(src_city_id, (SELECT cityids FROM cityset WHERE id = %s)) 无法使用索引，所以先查出cityids再用in
-        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,))
+        rows = cache_mysql_select('SELECT cityids FROM cityset WHERE id = %s', (cityset,), ttl=settings.CACHE_LONG_TTL, tables=('cityset',))
         if rows and len(rows) > 0:
             cityids = rows[0]['cityids']
-            return get_cityobject('''c.country_code = %s and c.name = %s and c.id in
+            return get_cityobject(f'''c.country_code = %s and c.name = %s and c.id in
 (
-    select dist_city_id from statistics where src_city_id in (%s) group by dist_city_id
-) group by c.id,c.asn''',(country_code,city_name,cityids)) #这里加了 ,c.asn 为了把多条cidr记录合并
+    select dist_city_id from {STATISTICS_TABLE} where src_city_id in (%s) group by dist_city_id
+) group by c.id,c.asn''',(country_code,city_name,cityids),ttl=settings.STATISTICS_QUERY_TTL) #这里加了 ,c.asn 为了把多条cidr记录合并
     return get_cityobject("c.country_code = %s and c.name = %s group by c.id,c.asn",(country_code,city_name,))
 
-def get_cityobject_by_ip(ip:str):
+# iprange 进程内索引，容器热启动期间复用
+iprange_index = IPRangeIndex(mysql_connection, settings.IPRANGE_INDEX_REFRESH)
+
+def get_iprange_index():
+    # 索引加载失败时返回 None，调用方退回到 SQL 查询
+    try:
+        iprange_index.ensure_fresh()
+    except Exception as e:
+        print('iprange index refresh failed.', repr(e))
+    if len(iprange_index) == 0:
+        return None
+    return iprange_index
+
+def get_cityobject_by_ip_sql(ip:str):
     ipno = ipaddress.IPv4Address(ip)._ip
     return get_cityobject("i.start_ip<=%s and i.end_ip>=%s group by c.id", (ipno,ipno))
 
+def get_cityobject_by_ip(ip:str):
+    index = get_iprange_index()
+    if index == None:
+        return get_cityobject_by_ip_sql(ip)
+    ipno = ipaddress.IPv4Address(ip)._ip
+    ranges = index.lookup_all(ipno)
+    citys = get_cityobjects_by_ids([city_id for start_ip, end_ip, city_id in ranges]) if ranges else {}
+    cityobjs = []
+    city_ids = set()
+    for start_ip, end_ip, city_id in ranges:
+        if city_id in city_ids:
+            continue
+        city_ids.add(city_id)
+        if city_id in citys:
+            # city 对象按 id 缓存，ip 段需要换成实际命中的范围
+            cityobj = dict(citys[city_id])
+            cityobj['startIp'] = str(ipaddress.IPv4Address(start_ip))
+            cityobj['endIp'] = str(ipaddress.IPv4Address(end_ip))
+            cityobjs.append(cityobj)
+    return cityobjs
+
 def get_cityid_by_ip(ip:str):
-    cityobj = get_cityobject_by_ip(ip)
+    index = get_iprange_index()
+    if index != None:
+        found = index.lookup(ipaddress.IPv4Address(ip)._ip)
+        return found[2] if found else 0
+    cityobj = get_cityobject_by_ip_sql(ip)
     if cityobj == None or len(cityobj) == 0:
         return 0
     return cityobj[0]['cityId']
 
+def get_cityids_by_ips(ips):
+    # 批量查询 {ip: city_id}，找不到时为 0；有 iprange 索引时在进程内完成，否则只执行一条 SQL
+    ips = list(dict.fromkeys(ips))
+    if len(ips) == 0:
+        return {}
+    index = get_iprange_index()
+    if index != None:
+        found = {ip: index.lookup(ipaddress.IPv4Address(ip)._ip) for ip in ips}
+        return {ip: value[2] if value else 0 for ip, value in found.items()}
+    # 与索引的 lookup 一致，嵌套范围时取起始地址最大（最内层）的范围
+    ipnos = [ipaddress.IPv4Address(ip)._ip for ip in ips]
+    rows = mysql_select('select t.ip,(select i.city_id from iprange as i where i.start_ip<=t.ip and i.end_ip>=t.ip order by i.start_ip desc limit 1) from ('
+        + ' union all '.join(['select %s as ip'] * len(ipnos)) + ') as t', ipnos, fetchObject=False)
+    city_ids = {row[0]: row[1] or 0 for row in rows or []}
+    return {ip: city_ids.get(ipno, 0) for ip, ipno in zip(ips, ipnos)}
+
 def get_cityobject_by_id(id:int):
     return get_cityobject("c.id=%s group by c.id",(id,),limit=1)
 
+CITYOBJECT_BY_ID_SQL = CITYOBJECT_SELECT + 'c.id=%s group by c.id limit 1'
+
+# 批量获取 city 对象，返回 {city_id: cityobj}，找不到的 id 不在结果中
+# 与 get_cityobject_by_id 共用缓存 key：先查进程内缓存，再用一个 pipeline 读取 Redis，
+# 剩余的用一条 in 查询从 MySQL 读取并通过一个 pipeline 写回 Redis
+# Valkey Serverless 为集群模式，不同 key 的 MGET 会报 CROSSSLOT，所以这里使用 pipeline 逐个 GET
+def get_cityobjects_by_ids(ids, ttl:int = settings.CACHE_LONG_TTL):
+    keys = {}
+    for city_id in ids:
+        city_id = int(city_id)
+        keys[city_id] = mysql_select_cache_key(CITYOBJECT_BY_ID_SQL, (city_id,), tables=CITYOBJECT_TABLES)
+    cityobjs = {}
+    pending = []
+    for city_id, key in keys.items():
+        val = local_cache.get(key)
+        if val == None:
+            pending.append(city_id)
+        elif len(val) > 0:
+            cityobjs[city_id] = val[0]
+    if len(pending) == 0:
+        return cityobjs
+    r = redis.StrictRedis(connection_pool=redis_binary_pool)
+    raws = [None] * len(pending)
+    try:
+        pipe = r.pipeline(transaction=False)
+        for city_id in pending:
+            pipe.get(keys[city_id])
+        raws = pipe.execute()
+    except Exception as e:
+        print('cache pipeline get failed.', repr(e))
+    missing = []
+    now = time.time()
+    for city_id, raw in zip(pending, raws):
+        val, expire, delta, size = cache_envelope_decode(raw)
+        if val != None and (expire == 0 or now < expire):
+            redis_cache_stats['hit'] += 1
+            local_cache.set(keys[city_id], val, max(int(expire - now), 1) if expire else ttl, size)
+            if len(val) > 0:
+                cityobjs[city_id] = val[0]
+        else:
+            redis_cache_stats['miss'] += 1
+            missing.append(city_id)
+    if len(missing) == 0:
+        return cityobjs
+    holders = ','.join(['%s'] * len(missing))
+    start = time.time()
+    rows = mysql_select(CITYOBJECT_SELECT + f'c.id in ({holders}) group by c.id', tuple(missing))
+    if rows == None:
+        return cityobjs
+    found = {row['cityId']: row for row in rows}
+    delta = time.time() - start
+    try:
+        pipe = r.pipeline(transaction=False)
+        for city_id in missing:
+            # 与单条查询的缓存格式一致，不存在的 id 缓存为空列表
+            val = [found[city_id]] if city_id in found else []
+            raw, size = cache_envelope_encode(val, ttl, delta)
+            pipe.setex(keys[city_id], ttl + settings.CACHE_STALE_TTL, raw)
+            local_cache.set(keys[city_id], val, ttl, size)
+        pipe.execute()
+    except Exception as e:
+        print('cache pipeline set failed.', repr(e))
+    cityobjs.update(found)
+    return cityobjs
+
 def get_cityobject_by_keyword(keyword:str, limit=200):
     if keyword.lower().startswith('as'):
         keyword = keyword.lower().replace('asn','').replace('as','')
@@ -381,58 +718,239 @@ def get_latency_rawdata_cross_city(sourceCityId:str, destCityId:str, limit:int):
     return cache_mysql_select(f'''
 select src_city_id as src, dist_city_id as dist, samples, latency_min as min, latency_max as max,
 latency_avg as avg,latency_p50 as p50,latency_p70 as p70,latency_p90 as p90,latency_p95 as p95,
-UNIX_TIMESTAMP(update_time) as update_time from statistics where src_city_id in ({sourceCityId})
+UNIX_TIMESTAMP(update_time) as update_time from {STATISTICS_TABLE} where src_city_id in ({sourceCityId})
  and dist_city_id in ({destCityId}) order by update_time desc limit {limit}
-''')
+''', ttl=settings.STATISTICS_QUERY_TTL)
+
+# 同一城市对在同一秒内可能写入多条（如合并写入的一批结果），分页游标需要每行唯一的 rid：statistics 为自增 id，statistics_ring 为 slot
+STATISTICS_ROW_KEY = 'slot' if STATISTICS_TABLE == 'statistics_ring' else 'id'
+
+# 按 (update_time, src, dist, rid) 倒序的游标分页，after = (update_time, src, dist, rid) 为上一页最后一条，不使用 OFFSET
+def get_latency_rawdata_page(sourceCityId:str, destCityId:str, after, limit:int):
+    pattern = r'^[\d,]+$'
+    if not bool(re.match(pattern, sourceCityId)) or not bool(re.match(pattern, destCityId)):
+        return None
+    filter = ''
+    obj = ()
+    if after:
+        filter = f''' and (update_time < FROM_UNIXTIME(%s) or (update_time = FROM_UNIXTIME(%s)
+ and (src_city_id < %s or (src_city_id = %s and (dist_city_id < %s or (dist_city_id = %s and {STATISTICS_ROW_KEY} < %s))))))'''
+        obj = (after[0], after[0], after[1], after[1], after[2], after[2], after[3])
+    return cache_mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, samples, latency_min as min, latency_max as max,
+latency_avg as avg,latency_p50 as p50,latency_p70 as p70,latency_p90 as p90,latency_p95 as p95,
+UNIX_TIMESTAMP(update_time) as update_time, {STATISTICS_ROW_KEY} as rid from {STATISTICS_TABLE} where src_city_id in ({sourceCityId})
+ and dist_city_id in ({destCityId}){filter} order by update_time desc, src_city_id desc, dist_city_id desc, {STATISTICS_ROW_KEY} desc limit {int(limit)}
+''', obj, ttl=settings.STATISTICS_QUERY_TTL)
 
 def get_latency_data_cross_city(sourceCityId:str, destCityId:str):
     pattern = r'^[\d,]+$'
     print('query with:', sourceCityId, destCityId)
     if not bool(re.match(pattern, sourceCityId)) or not bool(re.match(pattern, destCityId)):
         return None
+    if settings.STATISTICS_SUMMARY:
+        # 汇总表每个城市对只有一行，由写入流程增量维护
+        return cache_mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, samples, latency_min as min, latency_max as max,
+latency_avg as avg, latency_p50 as p50, latency_p70 as p70, latency_p90 as p90, latency_p95 as p95,
+TO_BASE64(latency_hist) as hist
+from statistics_summary where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId})
+''', ttl=settings.STATISTICS_QUERY_TTL)
     return cache_mysql_select(f'''
 select src_city_id as src, dist_city_id as dist, sum(samples) as samples,
 min(latency_min) as min,max(latency_max) as max,avg(latency_avg) as avg,avg(latency_p50) as p50,
 avg(latency_p70) as p70,avg(latency_p90) as p90,avg(latency_p95) as p95
-from statistics where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId}) group by src_city_id,dist_city_id
-''')
+from {STATISTICS_TABLE} where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId}) group by src_city_id,dist_city_id
+''', ttl=settings.STATISTICS_QUERY_TTL)
 
 CITYSET_DEFAULT_CACHE_SQL = 'select id,name,cityids as cityIds from `cityset` order by length(cityids) desc, name'
 
 def get_citysets():
-    return cache_mysql_select(CITYSET_DEFAULT_CACHE_SQL)
+    return cache_mysql_select(CITYSET_DEFAULT_CACHE_SQL, ttl=settings.CACHE_LONG_TTL, tables=('cityset',))
 
 def add_cityset(name:str, city_ids:list):
     ret = mysql_execute('INSERT into `cityset`(`name`,`cityids`) values(%s,%s)', (name, ','.join(city_ids)))
-    delete_mysql_select_cache(CITYSET_DEFAULT_CACHE_SQL)
+    bump_cache_generation('cityset')
     return ret
 
 def edit_cityset(id:int, name:str, city_ids:list):
     ret = mysql_execute('UPDATE `cityset` set name=%s,cityids=%s where id=' + str(id), (name, ','.join(city_ids)))
-    delete_mysql_select_cache(CITYSET_DEFAULT_CACHE_SQL)
+    bump_cache_generation('cityset')
     return ret
 
 def del_cityset(id:int):
     ret = mysql_execute('delete from `cityset` where id=' + str(id))
-    delete_mysql_select_cache(CITYSET_DEFAULT_CACHE_SQL)
+    bump_cache_generation('cityset')
     return ret
 
 def check_expired_iprange(days, limit):
     return mysql_select('select start_ip,end_ip,city_id from iprange where lastcheck_time < date_sub(now(), interval %s day) order by lastcheck_time limit %s', (days, limit))
 
 def update_pingable_result(city_id, start_ip, end_ip):
-    # 通过 start_ip end_ip city_id 来更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
-    mysql_execute('update pingable set lastresult=lastresult>>1 where city_id=%s and ip>=%s and ip<=%s', (city_id, start_ip, end_ip))
-    # 检查 pingable 表，删除 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
-    mysql_execute('delete from pingable where lastresult=' + settings.DELETE_PINGABLE_IP)
+    return update_pingable_results([(city_id, start_ip, end_ip)])
+
+# 批量老化 ranges = [(city_id, start_ip, end_ip)]，每种操作对所有范围只执行一条语句
+def update_pingable_results(ranges:list):
+    if len(ranges) == 0:
+        return
+    if settings.PINGABLE_STORAGE == 'bitmap':
+        # 位图存储：代数加 1 即完成老化，全部为 0 的范围直接删除
+        deltas, city_deltas = liveness.age_ranges(ranges)
+        incr_ping_counters(deltas, city_deltas)
+    else:
+        age_pingable_table(ranges)
     # 更新 lastcheck_time 时间，避免马上再次检查
-    mysql_execute('update iprange set lastcheck_time = CURRENT_TIMESTAMP where city_id=%s and start_ip=%s', (city_id, start_ip))
+    conds = ' or '.join(['(start_ip=%s and end_ip=%s and city_id=%s)'] * len(ranges))
+    mysql_execute('update iprange set lastcheck_time = CURRENT_TIMESTAMP where ' + conds, [x for city_id, start_ip, end_ip in ranges for x in (start_ip, end_ip, city_id)])
+
+def age_pingable_table(ranges:list):
+    conds = ' or '.join(['(city_id=%s and ip>=%s and ip<=%s)'] * len(ranges))
+    params = [x for r in ranges for x in r]
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            # 老化前统计本批范围内各状态的条目数，得到状态页计数的变化量：
+            # 右移后不再有 stable/new，原来 2~15 的条目变为 loss，原来为 1 的条目被删除
+            cursor.execute(f'''select city_id,sum(lastresult>={settings.STABLE_PINGABLE_IP}),sum(lastresult>={settings.NEW_PINGABLE_IP}),
+sum(lastresult>{settings.DELETE_PINGABLE_IP} and lastresult<={settings.LOSS_PINGABLE_IP}),sum(lastresult>=2),sum(lastresult=1)
+from pingable where ({conds}) group by city_id''', params)
+            deltas = [0, 0, 0]
+            city_deltas = {}
+            for city_id, stable, new, loss, aged, deleted in cursor.fetchall():
+                deltas[0] -= int(stable)
+                deltas[1] -= int(new)
+                deltas[2] += int(aged) - int(loss)
+                city_deltas[city_id] = -int(deleted)
+            # 通过 start_ip end_ip city_id 来更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
+            cursor.execute('update pingable set lastresult=lastresult>>1 where ' + conds, params)
+            # 删除 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
+            # 只有老化会产生全为 0 的条目，所以只需要检查本批范围，不扫描整个表
+            cursor.execute('delete from pingable where lastresult=' + settings.DELETE_PINGABLE_IP + ' and (' + conds + ')', params)
+        conn.commit()
+    incr_ping_counters(deltas, city_deltas)
+    # 老化后这些范围内的 ip 都低于 NEW_PINGABLE_IP，从探测目标中移除
+    remove_pingable_targets(ranges)
 
 def update_pingable_ip(city_id, ips):
-    for ip in ips:
-        ipno = ipaddress.IPv4Address(ip)._ip
-        # 128 = 10000000b
-        mysql_execute('INSERT INTO `pingable`(`ip`,`city_id`,`lastresult`) VALUES(%s, %s, ' + settings.NEW_PINGABLE_IP + ') ON DUPLICATE KEY UPDATE lastresult=lastresult|' + settings.NEW_PINGABLE_IP, (ipno, city_id))
+    return update_pingable_ips({city_id: ips})
+
+# 批量写入可ping ip，jobs = {city_id: [ip, ...]}
+def update_pingable_ips(jobs:dict):
+    if settings.PINGABLE_STORAGE == 'bitmap':
+        return update_liveness_ips(jobs)
+    return update_pingable_table(jobs)
+
+# 同一个 /job 请求中的所有结果使用一个连接、一个事务完成
+# pymysql 的 executemany 在 VALUES 中全部为占位符时才会改写为多行插入，所以 lastresult 也作为参数传入，每批 PINGABLE_BATCH_SIZE 行
+def update_pingable_table(jobs:dict):
+    rows = {}
+    for city_id, ips in jobs.items():
+        for ip in ips:
+            rows[ipaddress.IPv4Address(ip)._ip] = city_id
+    if len(rows) == 0:
+        return 0
+    # 按主键排序，减少批量写入时的锁冲突和页分裂；同一个 ip 只写入一次，状态页计数的变化量才准确
+    rows = sorted(rows.items())
+    deltas = [0, 0, 0]
+    city_deltas = {}
+    sql = 'INSERT INTO `pingable`(`ip`,`city_id`,`lastresult`) VALUES(%s, %s, %s) ON DUPLICATE KEY UPDATE lastresult=lastresult|' + settings.NEW_PINGABLE_IP
+    new = int(settings.NEW_PINGABLE_IP)
+    try:
+        with mysql_connection(True) as conn:
+            with conn.cursor() as cursor:
+                for i in range(0, len(rows), settings.PINGABLE_BATCH_SIZE):
+                    batch = rows[i:i + settings.PINGABLE_BATCH_SIZE]
+                    count_pingable_upsert(cursor, batch, deltas, city_deltas)
+                    cursor.executemany(sql, [(ip, city_id, new) for ip, city_id in batch])
+            conn.commit()
+    except Exception as e:
+        # 出错的连接会被连接池丢弃，未提交的事务随连接关闭回滚
+        print('update pingable ips failed.', repr(e), len(rows))
+        raise
+    update_speed_status('ping', len(rows), False)
+    incr_ping_counters(deltas, city_deltas)
+    add_pingable_targets(jobs)
+    return len(rows)
+
+def count_pingable_upsert(cursor, batch:list, deltas:list, city_deltas:dict):
+    # 写入前读取这批 ip 的 lastresult，累加写入后（lastresult|NEW_PINGABLE_IP）状态页计数的变化量
+    # ip 是主键，已存在的条目保留原来的 city_id
+    cursor.execute('select ip,city_id,lastresult from pingable where ip in (' + ','.join(['%s'] * len(batch)) + ')', [ip for ip, city_id in batch])
+    existing = {ip: (city_id, lastresult) for ip, city_id, lastresult in cursor.fetchall()}
+    stable = int(settings.STABLE_PINGABLE_IP)
+    new = int(settings.NEW_PINGABLE_IP)
+    for ip, city_id in batch:
+        if ip not in existing:
+            deltas[1] += 1
+            city_deltas[city_id] = city_deltas.get(city_id, 0) + 1
+            continue
+        city_id, lastresult = existing[ip]
+        if lastresult < stable and lastresult | new >= stable:
+            deltas[0] += 1
+        if lastresult < new:
+            deltas[1] += 1
+        if lastresult <= int(settings.LOSS_PINGABLE_IP):
+            deltas[2] -= 1
+        if lastresult == int(settings.DELETE_PINGABLE_IP):
+            city_deltas[city_id] = city_deltas.get(city_id, 0) + 1
+
+# pingable 表的位图存储，见 liveness_bitmap.py
+liveness = LivenessBitmap(redis_binary_pool, settings.CACHEKEY_LIVENESS, settings.LIVENESS_GENERATIONS)
+
+def update_liveness_ips(jobs:dict):
+    # 通过 iprange 索引找到每个 ip 所属的范围（与老化时的 city_id,start_ip,end_ip 一致），按范围批量写入位图
+    index = get_iprange_index()
+    if index == None:
+        print('update liveness ips skipped, iprange index not loaded.')
+        return 0
+    ranges = {}
+    for city_id, ips in jobs.items():
+        city_id = int(city_id)
+        for ip in ips:
+            ipno = ipaddress.IPv4Address(ip)._ip
+            for start_ip, end_ip, range_city_id in index.lookup_all(ipno):
+                if range_city_id == city_id:
+                    ranges.setdefault((city_id, start_ip, end_ip), []).append(ipno)
+                    break
+    count, deltas, city_deltas = liveness.mark(ranges)
+    incr_ping_counters(deltas, city_deltas)
+    update_speed_status('ping', count, False)
+    return count
+
+def migrate_pingable_bitmap():
+    # 把 pingable 表的数据按 iprange 转换为位图，迁移后设置 PINGABLE_STORAGE=bitmap
+    index = get_iprange_index()
+    if index == None:
+        return {
+            'status': 500,
+            'msg': 'iprange index not loaded'
+        }
+    ranges = {}
+    skipped = 0
+    with mysql_connection(False) as conn:
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute('select ip,city_id,lastresult from pingable where lastresult>' + settings.DELETE_PINGABLE_IP)
+            for ip, city_id, lastresult in cursor:
+                for start_ip, end_ip, range_city_id in index.lookup_all(ip):
+                    if range_city_id == city_id:
+                        ranges.setdefault((city_id, start_ip, end_ip), []).append((ip, lastresult))
+                        break
+                else:
+                    skipped += 1
+    rows = 0
+    for (city_id, start_ip, end_ip), items in ranges.items():
+        liveness.load(city_id, start_ip, end_ip, items)
+        rows += len(items)
+    cache_delete(settings.CACHEKEY_LIVENESS + ':summary')
+    # 切换存储后 ping 相关计数来自位图，重新对账
+    clear_statistics_counters()
+    return {
+        'status': 200,
+        'msg': f'migrated {rows} ips in {len(ranges)} ranges, {skipped} skipped'
+    }
+
+def get_liveness_summary():
+    # 汇总所有范围的计数需要读取整个 hash，短时间缓存
+    return two_tier_cache_get(settings.CACHEKEY_LIVENESS + ':summary', liveness.summary, settings.STATISTICS_CACHE_TTL)
 
 def update_statistics_data(datas):
     return mysql_execute('''INSERT INTO `statistics`(src_city_id,dist_city_id,samples,latency_min,latency_max,latency_avg,
@@ -449,6 +967,373 @@ AND update_time NOT IN (
         ORDER BY update_time DESC LIMIT %s) t
 );''', (src_city_id, dist_city_id, src_city_id, dist_city_id, limit))
 
+STATISTICS_COLUMNS = ('samples','latency_min','latency_max','latency_avg','latency_p50','latency_p70','latency_p90','latency_p95')
+# 每条记录保存的列，latency_hist 为 latency_sketch 编码的延迟直方图，旧数据为 NULL
+STATISTICS_ROW_COLUMNS = STATISTICS_COLUMNS + ('latency_hist',)
+
+# 批量写入一个 /job 请求中的所有延迟统计数据，在同一个事务中完成
+def update_statistics_datas(datas:list, limit = settings.MAX_RECORDS_PER_CITYID):
+    if len(datas) == 0:
+        return 0
+    pairs = sorted({(data['src_city_id'], data['dist_city_id']) for data in datas})
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            # 写入前已有数据的城市对数，用于增量更新 cityid-pair 计数
+            pair_holders, pair_params = pairs_in_sql(pairs)
+            cursor.execute(f'SELECT count(distinct src_city_id, dist_city_id) FROM `{STATISTICS_TABLE}` WHERE (src_city_id, dist_city_id) IN ({pair_holders})', pair_params)
+            existing = cursor.fetchone()[0]
+            if STATISTICS_TABLE == 'statistics_ring':
+                inserted, deleted = write_statistics_ring(cursor, datas, pairs, limit)
+            else:
+                inserted, deleted = write_statistics_table(cursor, datas, pairs, limit)
+            if settings.STATISTICS_SUMMARY:
+                update_statistics_summary(cursor, pairs)
+        conn.commit()
+    incr_statistics_counters({'cityid-pair': len(pairs) - existing})
+    return inserted
+
+def pairs_in_sql(pairs):
+    return ','.join(['(%s,%s)'] * len(pairs)), [x for pair in pairs for x in pair]
+
+# 追加写入，然后对涉及到的 (src_city_id, dist_city_id) 一次性做保留条数清理
+# 清理规则与 delete_oldest_statistics_data 一致：删除早于每个城市对第 limit 新记录时间的数据
+def write_statistics_table(cursor, datas:list, pairs:list, limit:int):
+    cursor.executemany('''INSERT INTO `statistics`(src_city_id,dist_city_id,samples,latency_min,latency_max,latency_avg,
+latency_p50,latency_p70,latency_p90,latency_p95,latency_hist)
+VALUES(%(src_city_id)s,%(dist_city_id)s,%(samples)s,%(latency_min)s,%(latency_max)s,%(latency_avg)s,
+%(latency_p50)s,%(latency_p70)s,%(latency_p90)s,%(latency_p95)s,%(latency_hist)s)''', datas)
+    inserted = cursor.rowcount
+    pair_holders, pair_params = pairs_in_sql(pairs)
+    cursor.execute(f'''DELETE s FROM `statistics` AS s JOIN (
+    SELECT src_city_id, dist_city_id, update_time AS cutoff FROM (
+        SELECT src_city_id, dist_city_id, update_time,
+        ROW_NUMBER() OVER (PARTITION BY src_city_id, dist_city_id ORDER BY update_time DESC) AS rn
+        FROM `statistics` WHERE (src_city_id, dist_city_id) IN ({pair_holders})
+    ) AS t WHERE rn = %s
+) AS c ON s.src_city_id = c.src_city_id AND s.dist_city_id = c.dist_city_id AND s.update_time < c.cutoff''', pair_params + [limit])
+    return inserted, cursor.rowcount
+
+# 环形缓冲写入：每个城市对在 statistics_counter 中维护递增序号，slot = seq % limit，新数据直接覆盖最旧的槽位，不需要删除
+def write_statistics_ring(cursor, datas:list, pairs:list, limit:int):
+    counts = {}
+    for data in datas:
+        pair = (data['src_city_id'], data['dist_city_id'])
+        counts[pair] = counts.get(pair, 0) + 1
+    # 先占用序号，行锁保证并发写入同一城市对时序号不重复
+    cursor.executemany('''INSERT INTO `statistics_counter`(src_city_id,dist_city_id,seq) VALUES(%s,%s,%s)
+ON DUPLICATE KEY UPDATE seq=seq+VALUES(seq)''', [(pair[0], pair[1], counts[pair]) for pair in pairs])
+    pair_holders, pair_params = pairs_in_sql(pairs)
+    cursor.execute(f'SELECT src_city_id,dist_city_id,seq FROM `statistics_counter` WHERE (src_city_id, dist_city_id) IN ({pair_holders})', pair_params)
+    # 本批次占用的序号为 (seq - count, seq]
+    next_seq = {(row[0], row[1]): row[2] - counts[(row[0], row[1])] for row in cursor.fetchall()}
+    rows = []
+    for data in datas:
+        pair = (data['src_city_id'], data['dist_city_id'])
+        next_seq[pair] += 1
+        rows.append({**data, 'slot': next_seq[pair] % limit})
+    updates = ','.join(f'{col}=VALUES({col})' for col in STATISTICS_ROW_COLUMNS)
+    cursor.executemany(f'''INSERT INTO `statistics_ring`(src_city_id,dist_city_id,slot,samples,latency_min,latency_max,latency_avg,
+latency_p50,latency_p70,latency_p90,latency_p95,latency_hist)
+VALUES(%(src_city_id)s,%(dist_city_id)s,%(slot)s,%(samples)s,%(latency_min)s,%(latency_max)s,%(latency_avg)s,
+%(latency_p50)s,%(latency_p70)s,%(latency_p90)s,%(latency_p95)s,%(latency_hist)s)
+ON DUPLICATE KEY UPDATE {updates},update_time=CURRENT_TIMESTAMP''', rows)
+    return len(rows), 0
+
+# 汇总表的计算方式，与原来按 GROUP BY 实时计算的结果一致
+STATISTICS_SUMMARY_SELECT = '''SELECT src_city_id,dist_city_id,count(1) as records,sum(samples) as samples,
+min(latency_min) as latency_min,max(latency_max) as latency_max,avg(latency_avg) as latency_avg,avg(latency_p50) as latency_p50,
+avg(latency_p70) as latency_p70,avg(latency_p90) as latency_p90,avg(latency_p95) as latency_p95'''
+STATISTICS_SUMMARY_COLUMNS = ('records',) + STATISTICS_COLUMNS
+
+def summary_upsert_sql(where:str):
+    columns = ','.join(STATISTICS_SUMMARY_COLUMNS)
+    updates = ','.join(f'{col}=VALUES({col})' for col in STATISTICS_SUMMARY_COLUMNS)
+    return f'''INSERT INTO `statistics_summary`(src_city_id,dist_city_id,{columns})
+{STATISTICS_SUMMARY_SELECT} FROM `{STATISTICS_TABLE}` WHERE {where} GROUP BY src_city_id,dist_city_id
+ON DUPLICATE KEY UPDATE {updates}'''
+
+# 合并城市对所有记录的直方图写入汇总表，SQL 无法合并直方图，读出后在这里合并
+# 有记录没有直方图（旧数据）时汇总直方图为 NULL，查询时退回到按样本数加权平均
+def update_summary_hist(cursor, where:str, params):
+    cursor.execute(f'''SELECT src_city_id,dist_city_id,latency_hist FROM `{STATISTICS_TABLE}` WHERE {where}
+ORDER BY src_city_id,dist_city_id''', params)
+    merged = {}
+    for src_city_id, dist_city_id, hist in cursor.fetchall():
+        pair = (src_city_id, dist_city_id)
+        if pair not in merged:
+            merged[pair] = latency_sketch.new_counts()
+        if merged[pair] == None or hist == None:
+            merged[pair] = None
+        else:
+            latency_sketch.merge_into(merged[pair], hist)
+    rows = [(latency_sketch.encode(counts) if counts else None, pair[0], pair[1]) for pair, counts in merged.items()]
+    if len(rows) > 0:
+        cursor.executemany('UPDATE `statistics_summary` SET latency_hist=%s WHERE src_city_id=%s AND dist_city_id=%s', rows)
+
+# 增量维护：只重新计算本次写入涉及到的城市对，每个城市对最多 MAX_RECORDS_PER_CITYID 行
+def update_statistics_summary(cursor, pairs:list):
+    pair_holders, pair_params = pairs_in_sql(pairs)
+    cursor.execute(summary_upsert_sql(f'(src_city_id, dist_city_id) IN ({pair_holders})'), pair_params)
+    update_summary_hist(cursor, f'(src_city_id, dist_city_id) IN ({pair_holders})', pair_params)
+
+# 全量重建汇总表，用于回填数据或修复，按 src_city_id 分批在独立事务中执行
+def rebuild_statistics_summary():
+    src_city_ids = [row[0] for row in mysql_select(f'select distinct src_city_id from `{STATISTICS_TABLE}`', fetchObject=False)]
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            for src_city_id in src_city_ids:
+                cursor.execute(summary_upsert_sql('src_city_id = %s'), (src_city_id,))
+                update_summary_hist(cursor, 'src_city_id = %s', (src_city_id,))
+                # 删除原始数据中已经不存在的城市对
+                cursor.execute(f'''DELETE FROM `statistics_summary` WHERE src_city_id = %s AND dist_city_id NOT IN (
+    SELECT dist_city_id FROM `{STATISTICS_TABLE}` WHERE src_city_id = %s)''', (src_city_id, src_city_id))
+                conn.commit()
+            cursor.execute(f'''DELETE FROM `statistics_summary` WHERE src_city_id NOT IN (
+    SELECT src_city_id FROM `{STATISTICS_TABLE}`)''')
+        conn.commit()
+    return {
+        'status': 200,
+        'msg': f'rebuild summary for {len(src_city_ids)} src cities'
+    }
+
+# 检查汇总表与原始数据是否一致，返回不一致的城市对（最多 limit 条）
+def check_statistics_summary(limit:int = 100):
+    columns = ','.join(f's.{col}' for col in STATISTICS_SUMMARY_COLUMNS)
+    diffs = ' OR '.join([f's.{col}<>a.{col}' for col in ('records','samples','latency_min','latency_max')] +
+        [f'ABS(s.{col}-a.{col})>0.5' for col in STATISTICS_COLUMNS[3:]])
+    aggregate = f'{STATISTICS_SUMMARY_SELECT} FROM `{STATISTICS_TABLE}` GROUP BY src_city_id,dist_city_id'
+    mismatch = mysql_select(f'''SELECT a.src_city_id,a.dist_city_id,a.records as raw_records,{columns} FROM ({aggregate}) AS a
+LEFT JOIN `statistics_summary` AS s ON s.src_city_id = a.src_city_id AND s.dist_city_id = a.dist_city_id
+WHERE s.src_city_id IS NULL OR {diffs} LIMIT %s''', (limit,))
+    orphan = mysql_select(f'''SELECT s.src_city_id,s.dist_city_id FROM `statistics_summary` AS s
+LEFT JOIN `{STATISTICS_TABLE}` AS a ON s.src_city_id = a.src_city_id AND s.dist_city_id = a.dist_city_id
+WHERE a.src_city_id IS NULL LIMIT %s''', (limit,))
+    return {
+        'status': 200 if len(mismatch) == 0 and len(orphan) == 0 else 409,
+        'msg': {
+            'mismatch': mismatch,
+            'orphan': orphan
+        }
+    }
+
+# 把 statistics 表的数据迁移到环形缓冲表，每个城市对保留最新的 limit 条，按 src_city_id 分批在独立事务中执行
+# 迁移完成后设置环境变量 STATISTICS_STORAGE=ring 切换存储方式
+def migrate_statistics_ring(limit = settings.MAX_RECORDS_PER_CITYID):
+    columns = ','.join(STATISTICS_ROW_COLUMNS)
+    updates = ','.join(f'{col}=VALUES({col})' for col in STATISTICS_ROW_COLUMNS)
+    src_city_ids = [row[0] for row in mysql_select('select distinct src_city_id from `statistics`', fetchObject=False)]
+    migrated = 0
+    pairs = 0
+    for src_city_id in src_city_ids:
+        with mysql_connection(True) as conn:
+            with conn.cursor() as cursor:
+                # ON DUPLICATE KEY UPDATE 的 rowcount 对更新的行计为 2，迁移的行数和城市对数按来源数据计算
+                cursor.execute('''SELECT COALESCE(SUM(LEAST(cnt, %s)), 0),count(1) FROM (
+    SELECT count(1) AS cnt FROM `statistics` WHERE src_city_id = %s GROUP BY dist_city_id
+) AS t''', (limit, src_city_id))
+                rows, counters = cursor.fetchone()
+                migrated += int(rows)
+                pairs += int(counters)
+                # 最新的一条 rn=1，序号从最旧保留的一条开始为 1，最新一条序号为 LEAST(cnt, limit)
+                cursor.execute(f'''INSERT INTO `statistics_ring`(src_city_id,dist_city_id,slot,{columns},update_time)
+SELECT src_city_id,dist_city_id,MOD(LEAST(cnt, %s) - rn + 1, %s),{columns},update_time FROM (
+    SELECT src_city_id,dist_city_id,{columns},update_time,
+    ROW_NUMBER() OVER (PARTITION BY dist_city_id ORDER BY update_time DESC) AS rn,
+    COUNT(1) OVER (PARTITION BY dist_city_id) AS cnt
+    FROM `statistics` WHERE src_city_id = %s
+) AS t WHERE rn <= %s
+ON DUPLICATE KEY UPDATE {updates},update_time=VALUES(update_time)''', (limit, limit, src_city_id, limit))
+                cursor.execute('''INSERT INTO `statistics_counter`(src_city_id,dist_city_id,seq)
+SELECT src_city_id,dist_city_id,LEAST(count(1), %s) FROM `statistics` WHERE src_city_id = %s GROUP BY src_city_id,dist_city_id
+ON DUPLICATE KEY UPDATE seq=VALUES(seq)''', (limit, src_city_id))
+            conn.commit()
+    return {
+        'status': 200,
+        'msg': f'migrated {len(src_city_ids)} src cities, {pairs} pairs, {migrated} ring rows'
+    }
+
+# 解析 /job POST 的任务结果，返回 (可ping ip {city_id: [ip]}, 统计数据列表, 样本总数)
+def parse_job_results(city_id, jobResult:list):
+    pingable_ips = {}
+    statistics = []
+    statistics_samples = 0
+    for obj in jobResult:
+        jobtype = obj['jobid'][:4]
+        jobid = int(obj['jobid'][4:])
+        if jobtype == 'ping':
+            # obj['status'] = 0 success 256 partial success or not found any pingable ip
+            # obj['stderr'] -> 1.6.81.7 : duplicate for [0], 64 bytes, 468 ms
+            ips = fping_parser.parse_ping_output(obj['stdout'])
+            #print(f"pingjob: {jobid} status: {obj['status']} ips: {len(ips)}")
+            # print(ips)
+            if len(ips) > 0:
+                pingable_ips.setdefault(jobid, []).extend(ips)
+        elif jobtype == 'data':
+            #print(f"datajob: {jobid} status: {obj['status']}")
+            #print(obj['stdout'])
+            #print(obj['stderr'])
+            # stdout:
+            # [DEBUG] CPU time used: 0.083289 sec
+            # stderr:
+            # 2.17.168.71 : 370 370 370 370 373 370 370 370 370 370 370
+            # 2.17.168.93 : 358 358 358 358 363 358 358 358 358 358 358
+            # 2.17.168.76 : 358 358 358 358 358 359 358 358 358 358 358
+            # 38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
+            # 按目标 ip 解析出各自的样本，城市对的统计数据使用所有目标的样本
+            sorted_data = fping_parser.merge_samples(fping_parser.parse_data_output(obj['stderr']))
+            n = len(sorted_data)
+            if n > 0:
+                # numpy 库太大了，这里简单实现一下
+                # arr = np.array(samples)
+                datas = {
+                    'src_city_id': city_id,
+                    'dist_city_id': jobid,
+                    'samples': n,
+                    'latency_min': int(sorted_data[0] * 1000), #min(samples), #np.min(arr),
+                    'latency_max': int(sorted_data[n-1] * 1000), #max(samples), #np.max(arr),
+                    'latency_avg': int(sum(sorted_data) * 1000 / n), #np.mean(arr),
+                    'latency_p50': int(np_percentile(sorted_data, 50) * 1000), #np.percentile(arr, 50),
+                    'latency_p70': int(np_percentile(sorted_data, 70) * 1000), #np.percentile(arr, 70),
+                    'latency_p90': int(np_percentile(sorted_data, 90) * 1000), #np.percentile(arr, 90),
+                    'latency_p95': int(np_percentile(sorted_data, 95) * 1000), #np.percentile(arr, 95),
+                    'latency_hist': latency_sketch.encode(latency_sketch.from_samples(sorted_data)),
+                }
+                statistics.append(datas)
+                statistics_samples += n
+    return pingable_ips, statistics, statistics_samples
+
+# 所有 ping/data 任务结果汇总后一次批量写入
+def write_job_results(pingable_ips:dict, statistics:list, statistics_samples:int):
+    if len(pingable_ips) > 0:
+        update_pingable_ips(pingable_ips)
+    if len(statistics) > 0:
+        update_statistics_datas(statistics)
+        update_speed_status('data', statistics_samples, False)
+        record_pair_measurements(statistics)
+
+# 异步写入：/job POST 只把原始结果追加到 Redis stream，由 ingest 函数通过消费组批量读取后写入数据库
+# 每条消息 c=来源 city_id，b=原始 POST 内容；写入数据库成功后 XACK，失败的消息超过 INGEST_CLAIM_IDLE_MS 后被重新认领
+def enqueue_job_results(city_id, body:str):
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        return r.xadd(settings.CACHEKEY_INGEST, {'c': city_id, 'b': body}, maxlen=settings.INGEST_STREAM_MAXLEN, approximate=True)
+    except Exception as e:
+        # Redis 不可用时退回到同步写入，避免丢失数据
+        print('ingest enqueue failed, write directly.', repr(e))
+        write_job_results(*parse_job_results(city_id, json.loads(body)))
+        return None
+
+def ensure_ingest_group(r):
+    try:
+        r.xgroup_create(settings.CACHEKEY_INGEST, settings.INGEST_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def merge_job_results(results:list):
+    pingable_ips = {}
+    statistics = []
+    samples = 0
+    for ips, datas, n in results:
+        for city_id, city_ips in ips.items():
+            pingable_ips.setdefault(city_id, []).extend(city_ips)
+        statistics.extend(datas)
+        samples += n
+    return pingable_ips, statistics, samples
+
+def ingest_job_messages(r, messages:list):
+    # 合并一批消息的结果后一次写入，成功后确认所有消息；无法解析的消息直接确认丢弃，避免反复投递
+    # 合并写入失败时逐条重试，单独写入也失败的消息保持未确认，等待重新认领
+    ids = []
+    parsed = []
+    for message_id, fields in messages:
+        try:
+            parsed.append((message_id, parse_job_results(int(fields['c']), json.loads(fields['b']))))
+        except Exception as e:
+            print('ingest drop invalid message.', message_id, repr(e))
+            ids.append(message_id)
+    written = []
+    try:
+        write_job_results(*merge_job_results([result for message_id, result in parsed]))
+        written = parsed
+    except Exception as e:
+        print(f'ingest batch write failed for {len(parsed)} messages.', repr(e))
+        if len(parsed) > 1:
+            for message_id, result in parsed:
+                try:
+                    write_job_results(*result)
+                    written.append((message_id, result))
+                except Exception as e:
+                    print('ingest message write failed.', message_id, repr(e))
+    ids.extend(message_id for message_id, result in written)
+    if len(ids) > 0:
+        r.xack(settings.CACHEKEY_INGEST, settings.INGEST_GROUP, *ids)
+    return len(ids), sum(len(result[1]) for message_id, result in written)
+
+def dead_letter_job_messages(r, consumer:str, messages:list):
+    # 重新认领的消息中投递次数超过 INGEST_MAX_DELIVERIES 的移到死信 stream 并确认，返回其余需要处理的消息
+    # 认领后消息属于当前消费者，逐条查询各自的投递次数，范围查询会混入其他消费者的消息而漏掉部分消息
+    # 查询不到的消息（已被确认或删除）按仍待处理返回，写入后的 XACK 不会产生影响
+    pipe = r.pipeline(transaction=False)
+    for message_id, fields in messages:
+        pipe.xpending_range(settings.CACHEKEY_INGEST, settings.INGEST_GROUP, min=message_id, max=message_id, count=1, consumername=consumer)
+    deliveries = {item['message_id']: item['times_delivered'] for items in pipe.execute() for item in items}
+    dead = [(message_id, fields) for message_id, fields in messages
+        if message_id in deliveries and deliveries[message_id] > settings.INGEST_MAX_DELIVERIES]
+    if len(dead) == 0:
+        return messages
+    pipe = r.pipeline(transaction=False)
+    for message_id, fields in dead:
+        pipe.xadd(settings.CACHEKEY_INGEST_DEAD, {'id': message_id, **fields}, maxlen=settings.INGEST_DEAD_MAXLEN, approximate=True)
+    pipe.execute()
+    r.xack(settings.CACHEKEY_INGEST, settings.INGEST_GROUP, *[message_id for message_id, fields in dead])
+    print(f'ingest moved {len(dead)} messages to dead letter stream')
+    dead_ids = {message_id for message_id, fields in dead}
+    return [message for message in messages if message[0] not in dead_ids]
+
+def consume_job_results(consumer:str, deadline:float, block_ms:int = 1000):
+    # 持续读取直到 stream 为空或到达 deadline（time.time()），返回处理的消息数和统计数据条数
+    r = redis.StrictRedis(connection_pool=redis_pool)
+    ensure_ingest_group(r)
+    total_messages = 0
+    total_statistics = 0
+    # 先认领其他消费者读取后长时间未确认的消息（如写入失败或函数超时），认领失败不影响读取新消息
+    try:
+        claimed = r.xautoclaim(settings.CACHEKEY_INGEST, settings.INGEST_GROUP, consumer,
+            settings.INGEST_CLAIM_IDLE_MS, start_id='0-0', count=settings.INGEST_BATCH_SIZE)
+        claimed = [m for m in claimed[1] if m[1]]
+        if claimed:
+            print(f'ingest reclaimed {len(claimed)} messages')
+            messages, statistics = ingest_job_messages(r, dead_letter_job_messages(r, consumer, claimed))
+            total_messages += messages
+            total_statistics += statistics
+    except Exception as e:
+        print('ingest reclaim failed.', repr(e))
+    while time.time() < deadline:
+        streams = r.xreadgroup(settings.INGEST_GROUP, consumer, {settings.CACHEKEY_INGEST: '>'},
+            count=settings.INGEST_BATCH_SIZE, block=block_ms)
+        if not streams or len(streams[0][1]) == 0:
+            break
+        start = time.time()
+        messages, statistics = ingest_job_messages(r, streams[0][1])
+        total_messages += messages
+        total_statistics += statistics
+        print(f'ingest {messages} messages, {statistics} statistics in {time.time() - start:.3f}s')
+    return total_messages, total_statistics
+
+def get_ingest_status():
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        groups = r.xinfo_groups(settings.CACHEKEY_INGEST)
+        return {
+            'length': r.xlen(settings.CACHEKEY_INGEST),
+            'dead': r.xlen(settings.CACHEKEY_INGEST_DEAD),
+            'groups': [{k: group[k] for k in ('name', 'consumers', 'pending', 'lag') if k in group} for group in groups]
+        }
+    except Exception as e:
+        print('ingest status failed.', repr(e))
+        return None
+
 def friendly_intval(sec:int):
     if sec > 86400:
         msg = f"{int(sec / 86400)} days ago"
@@ -501,54 +1386,152 @@ def friendly_cityasn(city):
     return f"{city['asnName']} (ASN{city['asn']})"
 
 # 已知国家数量，已知city数量，已知asn数量
+# 状态页计数的数据库查询，用于对账和 Redis 不可用时的回退
+STATISTICS_COUNTER_SQL = {
+    'all-country':'select count(1) from country',
+    'all-city':'select count(1) from (select country_code,name from city group by country_code,name) as a',
+    'all-asn':'select count(1) from asn',
+    'ping-stable':'select count(1) from pingable where lastresult>=' + settings.STABLE_PINGABLE_IP,
+    'ping-new':'select count(1) from pingable where lastresult>=' + settings.NEW_PINGABLE_IP,
+    'ping-loss':'select count(1) from pingable where lastresult<=' + settings.LOSS_PINGABLE_IP,
+
+    'cidr-ready':'select count(1) from iprange where lastcheck_time >= date_sub(now(), interval 14 day)',
+    'cidr-outdated':'select count(1) from iprange where lastcheck_time < date_sub(now(), interval 14 day)',
+
+    'cityid-all':'select count(1) from city',
+    'cityid-ping':'select count(distinct city_id) from pingable where lastresult>' + settings.DELETE_PINGABLE_IP,
+    'cityid-pair':f'select count(distinct src_city_id, dist_city_id) from {STATISTICS_TABLE}',
+    # 'select count(1) from (select 1 from statistics group by src_city_id, dist_city_id) as a'
+}
+# 位图存储时可ping ip的计数来自位图的 popcount 汇总
+LIVENESS_COUNTERS = {
+    'ping-stable': 'stable',
+    'ping-new': 'new',
+    'ping-loss': 'loss',
+    'cityid-ping': 'pingcities',
+}
+
+# 状态页计数，由写入路径增量更新，见 stat_counters.py
+stat_counters = StatCounters(redis_pool, settings.CACHEKEY_STATISTICS)
+
+def incr_ping_counters(deltas:list, city_deltas:dict):
+    # deltas = [stable, new, loss] 的变化量，city_deltas = {city_id: 可ping条目数的变化量}
+    try:
+        stat_counters.incr(dict(zip(('ping-stable', 'ping-new', 'ping-loss'), deltas)), city_deltas)
+    except Exception as e:
+        print('incr ping counters failed.', repr(e))
+
+def incr_statistics_counters(deltas:dict):
+    try:
+        stat_counters.incr(deltas)
+    except Exception as e:
+        print('incr statistics counters failed.', repr(e))
+
+def clear_statistics_counters():
+    try:
+        stat_counters.clear()
+    except Exception as e:
+        print('clear statistics counters failed.', repr(e))
+
+def reconcile_statistics_counters():
+    # 从数据库（位图存储时 ping 相关计数来自位图）重新计算所有计数，修正增量更新的偏差和随时间变化的 cidr 计数
+    start = time.time()
+    values = {}
+    for name, sql in STATISTICS_COUNTER_SQL.items():
+        if settings.PINGABLE_STORAGE == 'bitmap' and name in LIVENESS_COUNTERS:
+            continue
+        values[name] = mysql_select_onevalue(sql)
+    if settings.PINGABLE_STORAGE == 'bitmap':
+        summary = liveness.summary()
+        for name, key in LIVENESS_COUNTERS.items():
+            values[name] = summary[key]
+        city_counts = liveness.city_counts()
+    else:
+        city_counts = {row[0]: row[1] for row in mysql_select('select city_id,count(1) from pingable where lastresult>' + settings.DELETE_PINGABLE_IP + ' group by city_id', fetchObject=False)}
+    stat_counters.reset(values, city_counts)
+    print(f'reconcile statistics counters in {time.time() - start:.3f}s', values)
+    return values
+
+def maybe_reconcile_statistics_counters():
+    # 每 STATISTICS_RECONCILE_INTERVAL 秒最多对账一次，返回是否执行了对账
+    try:
+        if not stat_counters.acquire_reconcile(settings.STATISTICS_RECONCILE_INTERVAL):
+            return False
+        reconcile_statistics_counters()
+        return True
+    except Exception as e:
+        print('reconcile statistics counters failed.', repr(e))
+        return False
+
+def get_statistics_counters(names:list):
+    # 一次 MGET 读取计数，缺少的计数（首次使用或导入数据后）在租约内对账，否则回退到带缓存的数据库查询
+    if len(names) == 0:
+        return {}
+    try:
+        values = stat_counters.get(names)
+    except Exception as e:
+        print('get statistics counters failed.', repr(e))
+        values = {name: None for name in names}
+    if None in values.values() and maybe_reconcile_statistics_counters():
+        values = stat_counters.get(names)
+    for name, value in values.items():
+        if value == None:
+            if settings.PINGABLE_STORAGE == 'bitmap' and name in LIVENESS_COUNTERS:
+                summary = get_liveness_summary()
+                values[name] = summary[LIVENESS_COUNTERS[name]] if summary else 0
+            else:
+                # 计数查询较慢，短时间缓存，同时避免多个页面同时刷新时重复查询
+                values[name] = cache_mysql_get_onevalue(STATISTICS_COUNTER_SQL[name], ttl=settings.STATISTICS_CACHE_TTL)
+    return values
+
 # 稳定可ping数量，新增可ping数量，最近不可ping数量
 # 可用cidr数量，过期cidr数量，cidr队列长度
 # 已知cityid数量，可ping的cityid数量，有数据的cityid pair数量
 def query_statistics_data(datas = ''):
     if datas == '':
         datas = 'all-country,all-city,all-asn,ping-stable,ping-new,ping-loss,cidr-ready,cidr-outdated,cidr-queue,cityid-all,cityid-ping,cityid-pair,ping-clients,data-clients,speed-ping-get,speed-ping-set,speed-data-get,speed-data-set'
-    supports = {
-        'all-country':'select count(1) from country',
-        'all-city':'select count(1) from (select country_code,name from city group by country_code,name) as a',
-        'all-asn':'select count(1) from asn',
-        'ping-stable':'select count(1) from pingable where lastresult>=' + settings.STABLE_PINGABLE_IP,
-        'ping-new':'select count(1) from pingable where lastresult>=' + settings.NEW_PINGABLE_IP,
-        'ping-loss':'select count(1) from pingable where lastresult<=' + settings.LOSS_PINGABLE_IP,
-
-        'cidr-ready':'select count(1) from iprange where lastcheck_time >= date_sub(now(), interval 14 day)',
-        'cidr-outdated':'select count(1) from iprange where lastcheck_time < date_sub(now(), interval 14 day)',
-
-        'cityid-all':'select count(1) from city',
-        'cityid-ping':'select count(distinct city_id) from pingable where lastresult>' + settings.DELETE_PINGABLE_IP,
-        'cityid-pair':'select count(distinct src_city_id, dist_city_id) from statistics',
-        # 'select count(1) from (select 1 from statistics group by src_city_id, dist_city_id) as a'
-    }
+    datas = datas.split(',')
+    counters = get_statistics_counters([data for data in datas if data in STATISTICS_COUNTER_SQL])
+    # 最近一小时的任务数，所有速度计数一次读取
+    speeds = get_speed_metrics([data for data in datas if data in SPEED_COUNTERS])
     outs = {}
-    for data in datas.split(','):
-        if data == 'cidr-queue':
+    for data in datas:
+        if data in counters:
+            outs[data] = counters[data]
+        elif data == 'cidr-queue':
             outs[data] = cache_listlen(settings.CACHEKEY_PINGABLE)
-        elif data in {'speed-ping-get','speed-ping-set','speed-data-get','speed-data-set'}:
-            speed_counter = SpeedCounter(redis_pool, settings.CACHEKEY_RECENT_TASKS + data)
-            outs[data] = speed_counter.get_count()
+        elif data in speeds:
+            outs[data] = speeds[data]['hour']
         elif data in {'ping-clients','data-clients'}:
-            ping_tracker = OnlineIPTracker(redis_pool, settings.CACHEKEY_ONLINE_SERVERS + data[:4])
-            ping_clients = []
-            for ip, timestamp in ping_tracker.get_online_ips():
-                city = get_cityobject_by_ip(ip)
-                if city and len(city) > 0:
-                    msg = friendly_intval(time.time() - timestamp)
-                    if data == 'data-clients':
-                        msg += ', Queue: ' + str(cache_listlen(settings.CACHEKEY_CITYJOB + str(city[0]['cityId'])))
-                    ping_clients.append({
-                        'ip': ip,
-                        'region': friendly_cityandasnno(city[0]),
-                        'status': msg
-                    })
-            outs[data] = ping_clients
-        else:
-            outs[data] = mysql_select_onevalue(supports[data])
+            outs[data] = get_online_clients(data[:4])
     return outs
 
+def get_online_clients(kind:str):
+    # kind 为 ping 或 data，返回在线客户端列表
+    ping_tracker = OnlineIPTracker(redis_pool, settings.CACHEKEY_ONLINE_SERVERS + kind)
+    return enrich_online_clients(ping_tracker.get_online_ips(), kind == 'data')
+
+def enrich_online_clients(online_ips:list, with_pairs:bool):
+    # online_ips = [(ip, timestamp)]，批量补充客户端的城市和状态，往返次数与客户端数量无关：
+    # city_id 通过 iprange 索引批量查询，city 对象批量读取缓存，data 客户端的城市对数量在一个 pipeline 中读取
+    client_city_ids = get_cityids_by_ips([ip for ip, timestamp in online_ips])
+    citys = get_cityobjects_by_ids(set(client_city_ids.values()) - {0})
+    pairs = pair_scheduler.sizes(sorted(citys)) if with_pairs else {}
+    now = time.time()
+    clients = []
+    for ip, timestamp in online_ips:
+        city = citys.get(client_city_ids[ip])
+        if city:
+            msg = friendly_intval(now - timestamp)
+            if with_pairs:
+                msg += ', Pairs: ' + str(pairs.get(city['cityId'], 0))
+            clients.append({
+                'ip': ip,
+                'region': friendly_cityandasnno(city),
+                'status': msg
+            })
+    return clients
+
 def send_sqs_messages_batch(queue_url: str, messages: List[Dict[str, Any]]) -> Dict:
     """
     批量发送 JSON 消息到 SQS 队列
@@ -656,7 +1639,25 @@ def split_ip_range(start_ip, end_ip, step = 16384):
     return subnets
 
 # 由于 lambda 中 运行 fping 权限不够，所以不使用cron运行了，改为本地运行，因此使用redis队列来传递任务，通过api获取任务
+# 每个 ping 客户端请求都会调用，通过 Redis 租约保证每 IPRANGE_REFRESH_INTERVAL 秒最多只有一个请求补充队列，其他请求只有一次 SET NX 的开销
 def refresh_iprange_check(queue_url = ''):
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        if not r.set(settings.CACHEKEY_PINGABLE + ':lease', os.getpid(), nx=True, ex=settings.IPRANGE_REFRESH_INTERVAL):
+            return {
+                'status': 200,
+                'msg': 'Refresh lease is held, skip this round check'
+            }
+    except Exception as e:
+        print('refresh lease failed.', repr(e))
+        return {
+            'status': 500,
+            'msg': 'Refresh lease failed'
+        }
+    start = time.time()
+    if queue_url == '':
+        # 租约到期未确认的任务放回队列头部
+        reap_ping_jobs()
     max_buffer_cidr = 100
     if queue_url != '':
         # 获取队列大小
@@ -667,25 +1668,27 @@ def refresh_iprange_check(queue_url = ''):
                 'status': result['statusCode'],
                 'msg': result['error']
             }
-        len = result['queue_size']['visible_messages']
+        queue_size = result['queue_size']['visible_messages']
     else:
         # 检查 redis 队列长度
-        len = cache_listlen(settings.CACHEKEY_PINGABLE)
-    if len >= max_buffer_cidr:
+        queue_size = cache_listlen(settings.CACHEKEY_PINGABLE)
+    if queue_size >= max_buffer_cidr:
+        update_refill_metrics(r, start, 0, 0)
         return {
             'status': 200,
             'msg': 'Queue is full, skip this round check'
         }
 
     # 检查 iprange 表，根据 lastcheck_time 排序，找出 lastcheck_time < now - 7days 的数据，准备进行更新
-    datas = check_expired_iprange(days=14, limit=20)
+    datas = check_expired_iprange(days=14, limit=settings.IPRANGE_REFRESH_BATCH)
     # print(datas)
-    # 通过 start_ip end_ip city_id 来更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
-    # 检查 pingable 表，删除 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
+    # 通过 start_ip end_ip city_id 来批量更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
+    # 删除本批范围内 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
+    update_pingable_results([(data['city_id'], data['start_ip'], data['end_ip']) for data in datas])
+    # 本批范围都是过期的 cidr，检查后变为可用；超过 14 天变为过期的 cidr 由对账修正
+    incr_statistics_counters({'cidr-ready': len(datas), 'cidr-outdated': -len(datas)})
     messages = []
     for data in datas:
-        # print(data)
-        update_pingable_result(data['city_id'], data['start_ip'], data['end_ip'])
         subnets = split_ip_range(data['start_ip'], data['end_ip'])
         for subnet in subnets:
             messages.append({"type": "pingable", "start_ip": subnet[0], "end_ip": subnet[1], "city_id": data['city_id']})
@@ -694,64 +1697,287 @@ def refresh_iprange_check(queue_url = ''):
         result = send_sqs_messages_batch(queue_url, messages)
         # print(result)
     else:
-        for message in messages:
-            result = cache_push(settings.CACHEKEY_PINGABLE, message)
+        result = ping_job_queue.push(messages)
+    update_refill_metrics(r, start, len(datas), len(messages))
     return {
         'status': 200,
         'msg': result
     }
 
-# 根据不同的source city，获取需要ping的任务
-def get_pingjob_by_cityid(src_city_id:int):
-    last_city_id = 0
-    return_city_id = 0
-    if src_city_id == 0:
-        return None
-    # 在redis中先查找有没有已经缓存的数据
-    data = cache_pop(settings.CACHEKEY_CITYJOB + str(src_city_id))
-    if data:
-        # 先判断 data 是否为 int，如果是，表示需要从数据库找到下一批城市id，然后再次缓存到redis中
-        if not isinstance(data, int):
-            return_city_id = data['city_id']
-        else:
-            # 如果是 int，说明缓存中已经没有数据了，需要从数据库中查询，然后再缓存到redis中
-            last_city_id = data
-    # 如果没有数据了，从数据库中查询，然后缓存到redis中
-    if return_city_id == 0:
-        sql = 'SELECT city_id FROM pingable where city_id>%s and lastresult>=' + settings.NEW_PINGABLE_IP + ' GROUP BY city_id limit 50'
-        ipdatas = mysql_select(sql, (last_city_id,))
-        if ipdatas == None or len(ipdatas) == 0:
-            # 如果没有数据了，从头开始查询
-            if last_city_id != 0:
-                ipdatas = mysql_select(sql, (0,))
-        # 如果都没有数据，则返回 None
-        if ipdatas != None and len(ipdatas)>0:
-            for ipdata in ipdatas:
-                if return_city_id == 0:
-                    return_city_id = ipdata['city_id']
-                else:
-                    cache_push(settings.CACHEKEY_CITYJOB + str(src_city_id), ipdata)
-                last_city_id = ipdata['city_id']
-            # 缓存最后一个 city_id，用于缓存取光后，继续下次的查询
-            cache_push(settings.CACHEKEY_CITYJOB + str(src_city_id), last_city_id)
-            # print(f'got {len(ipdatas)} cityids with {src_city_id} last_id {last_city_id}')
-    if return_city_id == 0:
-        return None
-    # 查找该city_id的可用ip列表
-    iplists = mysql_select('SELECT ip FROM pingable where city_id=%s and lastresult>=' + settings.NEW_PINGABLE_IP + ' order by RAND() LIMIT 100;', (return_city_id,), False)
-    if iplists == None or len(iplists) == 0:
+# ping 任务的批量派发和租约，见 job_lease.py
+ping_job_queue = JobLeaseQueue(redis_pool, settings.CACHEKEY_PINGABLE, settings.PING_JOB_LEASE_SECONDS, settings.PING_JOB_MAX_ATTEMPTS)
+
+def dispatch_ping_jobs(count:int = 20):
+    # 一次往返取出 count 个任务，返回 (租约 id, 任务列表)
+    try:
+        return ping_job_queue.dispatch(count)
+    except Exception as e:
+        print('dispatch ping jobs failed.', repr(e))
+        return None, []
+
+def ack_ping_jobs(lease_id:str):
+    try:
+        return ping_job_queue.ack(lease_id)
+    except Exception as e:
+        print('ack ping jobs failed.', repr(e), lease_id)
+        return False
+
+def reap_ping_jobs():
+    try:
+        leases, requeued, dropped = ping_job_queue.reap()
+        if leases > 0:
+            print(f'reap ping jobs: {leases} leases expired, {requeued} jobs requeued, {dropped} dropped')
+        return requeued
+    except Exception as e:
+        print('reap ping jobs failed.', repr(e))
+        return 0
+
+def update_refill_metrics(r, start:float, ranges:int, jobs:int):
+    # 累计补充次数、范围数、任务数和耗时，用于观察补充延迟和吞吐量
+    elapsed_ms = int((time.time() - start) * 1000)
+    key = settings.CACHEKEY_PINGABLE + ':refill'
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hsetnx(key, 'since', int(start))
+        pipe.hincrby(key, 'runs', 1)
+        pipe.hincrby(key, 'ranges', ranges)
+        pipe.hincrby(key, 'jobs', jobs)
+        pipe.hincrby(key, 'elapsed_ms', elapsed_ms)
+        pipe.hset(key, mapping={'last_time': int(start), 'last_ms': elapsed_ms, 'last_ranges': ranges, 'last_jobs': jobs})
+        pipe.execute()
+    except Exception as e:
+        print('update refill metrics failed.', repr(e))
+
+def get_refill_metrics():
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        metrics = {k: int(v) for k, v in r.hgetall(settings.CACHEKEY_PINGABLE + ':refill').items()}
+    except Exception as e:
+        print('get refill metrics failed.', repr(e))
         return None
+    if not metrics:
+        return {}
+    runs = max(metrics.get('runs', 0), 1)
+    duration = max(time.time() - metrics.get('since', time.time()), 1)
     return {
-        'city_id': return_city_id,
-        'ips': [x[0] for x in iplists]
+        **metrics,
+        'avg_ms': round(metrics.get('elapsed_ms', 0) / runs, 1),
+        'ranges_per_hour': round(metrics.get('ranges', 0) * 3600 / duration, 1),
+        'jobs_per_hour': round(metrics.get('jobs', 0) * 3600 / duration, 1),
+        'queue': ping_job_queue.get_metrics(),
     }
 
+# 数据任务的探测目标保存在 Redis 中（见 pingable_targets.py），派发任务时不查询数据库
+# 集合的版本使用 pingable 表的缓存代数，exec_sql/exec_sqlfile 批量修改数据后全部重新加载
+pingable_targets = PingableTargets(redis_pool, settings.CACHEKEY_TARGETS, settings.PINGABLE_TARGETS_TTL,
+    lambda: get_cache_generations().get('pingable', 0))
+PINGABLE_TARGETS_SQL = 'SELECT ip FROM pingable where city_id=%s and lastresult>=' + settings.NEW_PINGABLE_IP
+PINGABLE_CITIES_SQL = 'SELECT city_id FROM pingable where lastresult>=' + settings.NEW_PINGABLE_IP + ' GROUP BY city_id'
+
+def get_pingable_targets(city_id:int, count:int = settings.PINGJOB_TARGETS):
+    if settings.PINGABLE_STORAGE == 'bitmap':
+        return liveness.sample(city_id, count)
+    try:
+        ips = pingable_targets.sample(city_id, count)
+        if ips != None:
+            if len(ips) == 0:
+                pingable_targets.remove_city(city_id)
+            return ips
+        # 未加载时只有一个请求从数据库加载该城市的全部目标，其他请求仍使用原来的随机查询
+        key = pingable_targets.city_key(city_id)
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        token = cache_lock(r, key)
+        if token:
+            try:
+                rows = mysql_select(PINGABLE_TARGETS_SQL, (city_id,), False) or []
+                ips = [x[0] for x in rows]
+                pingable_targets.load(city_id, ips)
+            finally:
+                cache_unlock(r, key, token)
+            if len(ips) == 0:
+                pingable_targets.remove_city(city_id)
+            return random.sample(ips, min(count, len(ips)))
+    except Exception as e:
+        print('get pingable targets failed.', repr(e), city_id)
+    iplists = mysql_select(PINGABLE_TARGETS_SQL + ' order by RAND() LIMIT %s', (city_id, count), False)
+    return [x[0] for x in iplists or []]
+
+def get_pingable_cities(last_city_id:int, limit:int = 50):
+    # 返回 city_id 大于 last_city_id 的有可ping ip的城市
+    if settings.PINGABLE_STORAGE == 'bitmap':
+        summary = get_liveness_summary()
+        return [x for x in (summary['cities'] if summary else []) if x > last_city_id][:limit]
+    try:
+        city_ids = pingable_targets.cities_after(last_city_id, limit)
+        if city_ids != None:
+            return city_ids
+        key = pingable_targets.cities_key()
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        token = cache_lock(r, key)
+        if token:
+            try:
+                rows = mysql_select(PINGABLE_CITIES_SQL, None, False) or []
+                city_ids = [x[0] for x in rows]
+                pingable_targets.load_cities(city_ids)
+            finally:
+                cache_unlock(r, key, token)
+            return [x for x in city_ids if x > last_city_id][:limit]
+    except Exception as e:
+        print('get pingable cities failed.', repr(e))
+    rows = mysql_select('SELECT city_id FROM pingable where city_id>%s and lastresult>=' + settings.NEW_PINGABLE_IP + ' GROUP BY city_id limit %s', (last_city_id, limit), False)
+    return [x[0] for x in rows or []]
+
+def add_pingable_targets(jobs:dict):
+    # jobs = {city_id: [ip, ...]}，只更新已加载的集合
+    targets = {}
+    for city_id, ips in jobs.items():
+        if len(ips) > 0:
+            targets[city_id] = [ipaddress.IPv4Address(ip)._ip for ip in ips]
+    if len(targets) == 0:
+        return
+    try:
+        pingable_targets.add(targets)
+        pingable_targets.add_cities(list(targets.keys()))
+    except Exception as e:
+        print('add pingable targets failed.', repr(e))
+
+def remove_pingable_targets(ranges:list):
+    try:
+        for city_id, remaining in pingable_targets.remove_ranges(ranges).items():
+            if remaining == 0:
+                pingable_targets.remove_city(city_id)
+    except Exception as e:
+        print('remove pingable targets failed.', repr(e), len(ranges))
+
+def get_all_pingable_cities():
+    city_ids = []
+    while True:
+        page = get_pingable_cities(city_ids[-1] if city_ids else 0, 1000)
+        city_ids.extend(page)
+        if len(page) < 1000:
+            return city_ids
+
+def get_priority_city_ids():
+    # cityset 中的城市是页面上常用的城市，测量频率更高
+    rows = cache_mysql_select('SELECT cityids FROM cityset', fetchObject=False, ttl=settings.CACHE_LONG_TTL, tables=('cityset',)) or []
+    return {int(x) for row in rows for x in (row[0] or '').split(',') if x.strip().isdigit()}
+
+def pair_priority(dist_city_id:int, priority_ids:set):
+    return settings.PAIR_SCHEDULE_CITYSET_PRIORITY if dist_city_id in priority_ids else 0
+
+# 数据任务的城市对调度，见 pair_scheduler.py
+pair_scheduler = PairScheduler(redis_pool, settings.CACHEKEY_SCHEDULE)
+
+def sync_pair_schedule(src_city_id:int):
+    # 每 PAIR_SCHEDULE_SYNC 秒同步一次目标城市（新的可ping城市加入，不再可ping的城市移除），只有一个请求执行
+    # 首次建立时按各城市对的最后更新时间计算分数（有汇总表时读取 statistics_summary，否则按统计表聚合），之后新加入的城市分数为 0，最先派发
+    key = pair_scheduler.src_key(src_city_id)
+    try:
+        r = redis.StrictRedis(connection_pool=redis_pool)
+        if not r.set(key + ':sync', 1, nx=True, ex=settings.PAIR_SCHEDULE_SYNC):
+            return
+        dist_city_ids = set(get_all_pingable_cities())
+        current = pair_scheduler.get_scores(src_city_id)
+        last_times = {}
+        # 测量时间的 hash 不存在时（首次建立或升级前建立的调度）同样从数据库读取
+        if len(current) == 0 or not pair_scheduler.has_measured(src_city_id):
+            if settings.STATISTICS_SUMMARY:
+                sql = 'SELECT dist_city_id,UNIX_TIMESTAMP(update_time) FROM statistics_summary WHERE src_city_id=%s'
+            else:
+                sql = f'SELECT dist_city_id,UNIX_TIMESTAMP(max(update_time)) FROM `{STATISTICS_TABLE}` WHERE src_city_id=%s GROUP BY dist_city_id'
+            rows = mysql_select(sql, (src_city_id,), False) or []
+            last_times = {row[0]: int(row[1]) for row in rows}
+        priority_ids = get_priority_city_ids()
+        scores = {x: max(last_times.get(x, 0) - pair_priority(x, priority_ids), 0) for x in dist_city_ids if x not in current}
+        measured = {x: t for x, t in last_times.items() if x in dist_city_ids and t > 0}
+        pair_scheduler.update(src_city_id, scores, [x for x in current if x not in dist_city_ids], measured)
+    except Exception as e:
+        print('sync pair schedule failed.', repr(e), src_city_id)
+
+def record_pair_measurements(statistics:list):
+    # 写入测量结果后把城市对的分数设为测量时间减去优先级
+    if len(statistics) == 0:
+        return
+    now = int(time.time())
+    priority_ids = get_priority_city_ids()
+    measured = {}
+    for data in statistics:
+        dist_city_id = data['dist_city_id']
+        measured.setdefault(data['src_city_id'], {})[dist_city_id] = now - pair_priority(dist_city_id, priority_ids)
+    try:
+        pair_scheduler.record(measured, now)
+    except Exception as e:
+        print('record pair measurements failed.', repr(e))
+
+# 根据不同的source city，获取需要ping的任务，优先派发最久没有测量的城市对
+def get_pingjobs_by_cityid(src_city_id:int, count:int = 10):
+    if src_city_id == 0:
+        return []
+    sync_pair_schedule(src_city_id)
+    try:
+        dist_city_ids = pair_scheduler.dispatch(src_city_id, count)
+    except Exception as e:
+        print('dispatch pair schedule failed.', repr(e), src_city_id)
+        return []
+    jobs = []
+    for dist_city_id in dist_city_ids:
+        # 从 Redis 中随机取样该city_id的可用ip列表
+        ips = get_pingable_targets(dist_city_id)
+        if len(ips) > 0:
+            jobs.append({
+                'city_id': dist_city_id,
+                'ips': ips
+            })
+    return jobs
+
+def get_pingjob_by_cityid(src_city_id:int):
+    jobs = get_pingjobs_by_cityid(src_city_id, 1)
+    return jobs[0] if jobs else None
+
+def get_schedule_metrics():
+    # 各源城市的城市对覆盖时间（距最后测量的小时数）分位数，从未测量的城市对单独计数
+    # 使用单独保存的测量时间，已派发但还没有写入结果的城市对仍按上次测量时间计算
+    now = time.time()
+    all_ages = []
+    never = 0
+    sources = {}
+    for src_city_id, items in pair_scheduler.all_measured().items():
+        ages = []
+        for dist_city_id, measured in items:
+            if measured == None:
+                never += 1
+                continue
+            ages.append(max(now - measured, 0) / 3600)
+        ages.sort()
+        all_ages.extend(ages)
+        sources[src_city_id] = {
+            'pairs': len(items),
+            'p50_hours': round(np_percentile(ages, 50) or 0, 2),
+            'p90_hours': round(np_percentile(ages, 90) or 0, 2),
+        }
+    all_ages.sort()
+    return {
+        'pairs': len(all_ages) + never,
+        'never_measured': never,
+        **{f'p{p}_hours': round(np_percentile(all_ages, p) or 0, 2) for p in (50, 90, 99)},
+        'max_hours': round(all_ages[-1], 2) if all_ages else 0,
+        'sources': sources,
+    }
+
+SPEED_COUNTERS = ('speed-ping-get','speed-ping-set','speed-data-get','speed-data-set')
+
 def update_speed_status(job:str, count:int, isread:bool):
     # 'speed-ping-get','speed-ping-set','speed-data-get','speed-data-set'
     key = 'speed-' + job + ('-get' if isread else '-set')
     speed_counter = SpeedCounter(redis_pool, settings.CACHEKEY_RECENT_TASKS + key)
     speed_counter.update_count(count)
 
+def get_speed_metrics(names = SPEED_COUNTERS):
+    # 一次往返读取多个速度计数，返回 {name: {'minute','hour','day' 合计及对应的 _rate 每秒速率}}
+    counters = [SpeedCounter(redis_pool, settings.CACHEKEY_RECENT_TASKS + name) for name in names]
+    stats = read_speed_counters(counters)
+    return {name: stats[counter.key] for name, counter in zip(names, counters)}
+
 # agent=ping or data, return str(int) for sleep intval, pause the system
 def update_client_status(ip:str, agent:str):
     tracker = OnlineIPTracker(redis_pool, settings.CACHEKEY_ONLINE_SERVERS + agent)
@@ -0,0 +1,55 @@
+import re
+from array import array
+from itertools import chain
+
+# fping 任务输出的解析，每个 /job POST 只遍历一次输出文本
+# data 任务（fping -C）的 stderr，每个目标一行，丢包为 -，重复包和调试信息单独一行：
+#   2.17.168.71 : 370 370 370 370 373 370 370 370 370 370 370
+#   2.17.168.72 : 358 - 358 358
+#   38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
+#   [DEBUG] CPU time used: 0.083289 sec
+# ping 任务（fping -a）的 stdout，每行一个可 ping 的 ip
+
+IPV4_PATTERN = re.compile(r'^(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)$')
+
+def parse_data_output(text:str):
+    # 返回 {目标ip: array('d') 延迟样本（毫秒）}，同一个 ip 出现多行时合并，没有有效样本的 ip 不在结果中
+    results = {}
+    for line in text.split('\n'):
+        target, sep, rest = line.partition(' : ')
+        if not sep or rest.startswith('duplicate') or line.startswith('['):
+            continue
+        tokens = rest.split()
+        if '-' in tokens:
+            tokens = [token for token in tokens if token != '-']
+        try:
+            # 整行一次转换，只有格式异常的行才逐个处理
+            samples = array('d', map(float, tokens))
+        except ValueError:
+            samples = array('d')
+            for token in tokens:
+                try:
+                    samples.append(float(token))
+                except ValueError:
+                    pass
+        if len(samples) == 0:
+            continue
+        target = target.strip()
+        if target in results:
+            results[target].extend(samples)
+        else:
+            results[target] = samples
+    return results
+
+def parse_ping_output(text:str):
+    # 返回可 ping 的 ipv4 地址列表，忽略调试信息和无效行（pingable 表只保存 ipv4）
+    ips = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line and line[0] != '[' and IPV4_PATTERN.match(line):
+            ips.append(line)
+    return ips
+
+def merge_samples(results:dict):
+    # 把所有目标的样本合并成一个已排序的列表，用于计算城市对的统计数据
+    return sorted(chain.from_iterable(results.values()))
@@ -0,0 +1,59 @@
+import gzip
+import base64
+
+# brotli 不在默认的 pythonlib 层中，安装后自动启用
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 服务端支持的压缩方式，按优先级排列
+SUPPORTED_ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+def parse_accept_encoding(header:str):
+    # 解析 Accept-Encoding，返回客户端接受的编码及权重 {'gzip': 1.0, 'br': 0.8}
+    encodings = {}
+    for part in (header or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+def choose_encoding(header:str):
+    encodings = parse_accept_encoding(header)
+    best = None
+    best_q = 0.0
+    for name in SUPPORTED_ENCODINGS:
+        q = encodings.get(name, encodings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def compress(data:bytes, encoding:str, level:int = None):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if level == None else level)
+    return gzip.compress(data, compresslevel=6 if level == None else level, mtime=0)
+
+# 按 Accept-Encoding 压缩响应体，返回 (base64 编码后的响应体, 编码方式)，不需要压缩时返回 (None, None)
+# alb 和 API Gateway 都要求二进制响应体使用 base64 编码并设置 isBase64Encoded
+def compress_body(body, accept_encoding:str, min_size:int):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if len(body) < min_size:
+        return None, None
+    encoding = choose_encoding(accept_encoding)
+    if encoding == None:
+        return None, None
+    data = compress(body, encoding)
+    if len(data) >= len(body):
+        return None, None
+    return base64.b64encode(data).decode('ascii'), encoding
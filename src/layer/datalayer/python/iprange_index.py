@@ -0,0 +1,132 @@
+import time
+import pymysql
+from array import array
+from bisect import bisect_right
+
+# iprange 表的进程内索引，按 start_ip,end_ip 排序后保存在三个定长数组中，通过二分查找定位 ip 所在范围
+# Lambda 容器热启动期间只加载一次，之后按 update_time 增量刷新，查询时不再访问 MySQL 和 Redis
+# 内存占用约为 每条记录 16 字节（start/end/city_id/前缀最大end 各4字节）
+class IPRangeIndex:
+    # get_connect 返回连接的上下文管理器，如 data_layer.mysql_connection
+    def __init__(self, get_connect, refresh_interval:int = 300, reload_interval:int = 86400):
+        self.get_connect = get_connect
+        self.refresh_interval = refresh_interval # 增量刷新间隔
+        self.reload_interval = reload_interval # 全量重建间隔，用于处理被删除的记录
+        self.max_incremental = 10000 # 单次增量变更超过该条数时直接全量重建
+        self.starts = array('I')
+        self.ends = array('I')
+        self.city_ids = array('I')
+        # max_ends[i] = max(ends[0..i])，用于处理嵌套范围时向前回溯的终止条件
+        self.max_ends = array('I')
+        self.last_update = 0 # 已加载数据中最大的 update_time
+        self.loaded_time = 0 # 最后一次全量加载时间
+        self.checked_time = 0 # 最后一次增量检查时间
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _rebuild_max_ends(self, begin:int = 0):
+        ends = self.ends
+        max_ends = self.max_ends
+        del max_ends[begin:]
+        current = max_ends[begin - 1] if begin > 0 else 0
+        for i in range(begin, len(ends)):
+            if ends[i] > current:
+                current = ends[i]
+            max_ends.append(current)
+
+    def load(self):
+        # 使用 SSCursor 流式读取，避免百万级结果集一次性物化成 tuple 列表
+        starts = array('I')
+        ends = array('I')
+        city_ids = array('I')
+        last_update = 0
+        with self.get_connect() as conn:
+            with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute('select start_ip,end_ip,city_id,UNIX_TIMESTAMP(update_time) from iprange order by start_ip,end_ip')
+                for row in cursor:
+                    starts.append(row[0])
+                    ends.append(row[1])
+                    city_ids.append(row[2])
+                    if row[3] > last_update:
+                        last_update = row[3]
+        self.starts = starts
+        self.ends = ends
+        self.city_ids = city_ids
+        self._rebuild_max_ends()
+        self.last_update = int(last_update)
+        self.loaded_time = self.checked_time = time.time()
+        return len(starts)
+
+    def _find(self, start_ip:int, end_ip:int):
+        # 查找 (start_ip,end_ip) 精确位置，不存在时返回插入位置和 False
+        i = bisect_right(self.starts, start_ip)
+        j = i
+        while j > 0 and self.starts[j - 1] == start_ip:
+            if self.ends[j - 1] == end_ip:
+                return j - 1, True
+            if self.ends[j - 1] < end_ip:
+                break
+            j -= 1
+        return j, False
+
+    def refresh(self):
+        # 增量刷新：只读取 update_time 之后变更的记录，新增的插入，已有的更新 city_id
+        self.checked_time = time.time()
+        with self.get_connect() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('select start_ip,end_ip,city_id,UNIX_TIMESTAMP(update_time) from iprange where update_time>=FROM_UNIXTIME(%s) order by start_ip,end_ip limit %s',
+                    (self.last_update, self.max_incremental + 1))
+                rows = cursor.fetchall()
+        if len(rows) > self.max_incremental:
+            return self.load()
+        first_changed = len(self.starts)
+        for start_ip, end_ip, city_id, update_time in rows:
+            pos, found = self._find(start_ip, end_ip)
+            if found:
+                self.city_ids[pos] = city_id
+            else:
+                self.starts.insert(pos, start_ip)
+                self.ends.insert(pos, end_ip)
+                self.city_ids.insert(pos, city_id)
+                first_changed = min(first_changed, pos)
+            if update_time > self.last_update:
+                self.last_update = int(update_time)
+        if first_changed < len(self.starts):
+            self._rebuild_max_ends(first_changed)
+        return len(rows)
+
+    def ensure_fresh(self):
+        now = time.time()
+        if len(self.starts) == 0 or now - self.loaded_time >= self.reload_interval:
+            self.load()
+        elif now - self.checked_time >= self.refresh_interval:
+            self.refresh()
+
+    def lookup_all(self, ip:int):
+        # 返回所有包含该 ip 的范围 [(start_ip, end_ip, city_id)]，嵌套范围时由内到外
+        results = []
+        i = bisect_right(self.starts, ip) - 1
+        while i >= 0 and self.max_ends[i] >= ip:
+            if self.ends[i] >= ip:
+                results.append((self.starts[i], self.ends[i], self.city_ids[i]))
+            i -= 1
+        return results
+
+    def lookup(self, ip:int):
+        # 返回 (start_ip, end_ip, city_id)，找不到时返回 None
+        i = bisect_right(self.starts, ip) - 1
+        while i >= 0 and self.max_ends[i] >= ip:
+            if self.ends[i] >= ip:
+                return (self.starts[i], self.ends[i], self.city_ids[i])
+            i -= 1
+        return None
+
+    def get_metrics(self):
+        return {
+            'ranges': len(self.starts),
+            'bytes': self.starts.itemsize * 4 * len(self.starts),
+            'last_update': self.last_update,
+            'loaded_time': self.loaded_time,
+            'checked_time': self.checked_time,
+        }
@@ -0,0 +1,101 @@
+import os
+import time
+import json
+import redis
+
+# ping 任务队列的批量派发和租约
+# 派发时一次往返从队列取出多个任务，同时把它们作为一个租约保存，并记录租约到期时间
+# 客户端提交结果时通过 next 参数带回租约 id 进行确认；客户端崩溃等原因未确认的租约到期后由回收函数放回队列头部
+# 队列 key 不带 hash tag，租约相关的 key 使用队列名作为 hash tag，在 Redis 集群中与队列位于同一个 slot：
+#   {queue}:leases 租约 id -> 到期时间，{queue}:jobs 租约 id -> 任务列表，{queue}:stats 派发、确认、回收的计数
+
+# 取出最多 ARGV[1] 个任务，保存为租约 ARGV[2]，到期时间 ARGV[3]
+DISPATCH_SCRIPT = """
+local items = redis.call('lpop', KEYS[1], ARGV[1])
+if not items then return {} end
+redis.call('hset', KEYS[3], ARGV[2], cjson.encode(items))
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[2])
+redis.call('hincrby', KEYS[4], 'dispatched', #items)
+return items
+"""
+# 确认租约，返回是否存在（已到期被回收的租约返回 0）
+ACK_SCRIPT = """
+redis.call('zrem', KEYS[2], ARGV[1])
+local acked = redis.call('hdel', KEYS[3], ARGV[1])
+redis.call('hincrby', KEYS[4], acked == 1 and 'acked' or 'late_acks', 1)
+return acked
+"""
+# 回收到期时间早于 ARGV[1] 的租约（每次最多 ARGV[3] 个），任务的尝试次数达到 ARGV[2] 时丢弃，返回 [回收的租约数, 放回的任务数, 丢弃的任务数]
+REAP_SCRIPT = """
+local ids = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local requeued, dropped = 0, 0
+for _, id in ipairs(ids) do
+    local data = redis.call('hget', KEYS[3], id)
+    if data then
+        local items = cjson.decode(data)
+        for i = #items, 1, -1 do
+            local job = cjson.decode(items[i])
+            local attempts = (tonumber(job['a']) or 1) + 1
+            if attempts <= tonumber(ARGV[2]) then
+                job['a'] = attempts
+                redis.call('lpush', KEYS[1], cjson.encode(job))
+                requeued = requeued + 1
+            else
+                dropped = dropped + 1
+            end
+        end
+    end
+    redis.call('zrem', KEYS[2], id)
+    redis.call('hdel', KEYS[3], id)
+end
+redis.call('hincrby', KEYS[4], 'requeued', requeued)
+redis.call('hincrby', KEYS[4], 'dropped', dropped)
+return {#ids, requeued, dropped}
+"""
+
+class JobLeaseQueue:
+    def __init__(self, redis_pool, queue_key:str, lease_seconds:int = 600, max_attempts:int = 3):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.queue_key = queue_key
+        self.lease_seconds = lease_seconds # 客户端完成一批任务并提交结果的最长时间
+        self.max_attempts = max_attempts # 每个任务最多派发的次数，避免不会确认的客户端使任务无限循环
+        self.reap_limit = 100 # 每次最多回收的租约数
+        tag = '{' + queue_key + '}:'
+        self.keys = [queue_key, tag + 'leases', tag + 'jobs', tag + 'stats']
+
+    def dispatch(self, count:int):
+        # 返回 (租约 id, 任务列表)，队列为空时返回 (None, [])
+        lease_id = os.urandom(6).hex()
+        items = self.redis.eval(DISPATCH_SCRIPT, 4, *self.keys, count, lease_id, int(time.time()) + self.lease_seconds)
+        if not items:
+            return None, []
+        return lease_id, [json.loads(item) for item in items]
+
+    def ack(self, lease_id:str):
+        return self.redis.eval(ACK_SCRIPT, 4, *self.keys, lease_id) == 1
+
+    def reap(self, now:float = None):
+        # 返回 [回收的租约数, 放回的任务数, 丢弃的任务数]
+        return self.redis.eval(REAP_SCRIPT, 4, *self.keys, int(time.time() if now == None else now), self.max_attempts, self.reap_limit)
+
+    def push(self, jobs:list):
+        if len(jobs) == 0:
+            return 0
+        return self.redis.rpush(self.queue_key, *[json.dumps(job) for job in jobs])
+
+    def clear(self):
+        self.redis.delete(*self.keys)
+
+    def get_metrics(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.keys[0])
+        pipe.zcard(self.keys[1])
+        pipe.zrange(self.keys[1], 0, 0, withscores=True)
+        pipe.hgetall(self.keys[3])
+        queued, leases, oldest, stats = pipe.execute()
+        return {
+            'queued': queued,
+            'leases': leases,
+            'oldest_deadline': int(oldest[0][1]) if oldest else None,
+            **{k if isinstance(k, str) else k.decode(): int(v) for k, v in stats.items()},
+        }
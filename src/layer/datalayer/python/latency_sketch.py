@@ -0,0 +1,94 @@
+import sys
+import math
+from array import array
+
+# 可合并的延迟直方图，按对数划分固定的桶，任意多条记录的直方图直接按桶相加即可得到整体分布
+# 与按样本数加权平均各条记录的分位数不同，合并后计算出的分位数是真实分位数（桶的代表值取几何中点，相对误差不超过 sqrt(GAMMA)-1，GAMMA=1.1 时约 4.9%）
+# 桶 0 为 <= MIN_MS 的延迟，桶 i 为 (MIN_MS * GAMMA^(i-1), MIN_MS * GAMMA^i]，最后一个桶包含所有更大的值
+MIN_MS = 0.1
+GAMMA = 1.1
+BUCKETS = 160
+LOG_GAMMA = math.log(GAMMA)
+
+# 稀疏编码：版本(1字节) + 非空桶数 n(1字节) + n 个桶序号(uint8) + n 个计数(uint32 小端)
+VERSION = 1
+
+def bucket_index(ms:float):
+    if ms <= MIN_MS:
+        return 0
+    return min(int(math.ceil(math.log(ms / MIN_MS) / LOG_GAMMA)), BUCKETS - 1)
+
+def bucket_value(index:int):
+    # 桶的代表值，取桶上下界的几何中点
+    if index == 0:
+        return MIN_MS
+    return MIN_MS * GAMMA ** (index - 0.5)
+
+def new_counts():
+    return array('L', bytes(array('L').itemsize * BUCKETS))
+
+def from_samples(samples):
+    counts = new_counts()
+    for ms in samples:
+        counts[bucket_index(ms)] += 1
+    return counts
+
+def encode(counts):
+    indices = array('B')
+    values = array('I')
+    for i, c in enumerate(counts):
+        if c:
+            indices.append(i)
+            values.append(c)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return bytes((VERSION, len(indices))) + indices.tobytes() + values.tobytes()
+
+def decode(blob):
+    # 返回 (桶序号数组, 计数数组)，无效数据返回空数组
+    if not blob or blob[0] != VERSION:
+        return array('B'), array('I')
+    n = blob[1]
+    indices = array('B', blob[2:2 + n])
+    values = array('I')
+    values.frombytes(blob[2 + n:2 + 5 * n])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return indices, values
+
+def add(counts, indices, values):
+    for i, c in zip(indices, values):
+        counts[i] += c
+
+def merge_into(counts, blob):
+    # 把一条编码后的直方图累加到 counts 中，返回本条的样本数
+    # 解码由 array 一次完成，每条只遍历非空桶（通常 10~30 个）
+    indices, values = decode(blob)
+    add(counts, indices, values)
+    return sum(values)
+
+def merge(blobs):
+    counts = new_counts()
+    for blob in blobs:
+        merge_into(counts, blob)
+    return counts
+
+def percentiles(counts, ps = (50, 70, 90, 95)):
+    # 最近秩法计算分位数，返回 {p: 毫秒}，没有数据时返回空字典
+    total = sum(counts)
+    if total == 0:
+        return {}
+    targets = sorted((max(int(math.ceil(p / 100 * total)), 1), p) for p in ps)
+    result = {}
+    cumulative = 0
+    t = 0
+    for i, c in enumerate(counts):
+        if c == 0:
+            continue
+        cumulative += c
+        while t < len(targets) and cumulative >= targets[t][0]:
+            result[targets[t][1]] = bucket_value(i)
+            t += 1
+        if t == len(targets):
+            break
+    return result
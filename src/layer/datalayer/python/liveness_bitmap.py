@@ -0,0 +1,261 @@
+import redis
+import random
+
+# pingable 表的替代存储（PINGABLE_STORAGE=bitmap）：每个 iprange 保存最近 N 次扫描的位图，ip 相对 start_ip 的偏移为位序号
+# 对应关系：第 g 次扫描写入槽位 g % N，lastresult 的最高位是最新槽位，低位依次是更早的槽位
+#   老化（lastresult>>1）= 代数加 1 并清空新的最新槽位，被清空的正好是最老的一代
+#   stable（lastresult>=1111b）= N 个槽位的 AND，new（>=1000b）= 最新槽位，loss（1~0111b）= 最新槽位为空、其他槽位的 OR
+#   lastresult 为 0 的行删除 = 所有槽位都为空时删除该范围的全部 key
+# 每个范围的 key 使用同一个 hash tag，脚本在 Redis 集群中只访问一个 slot：
+#   {tag}:g 代数，{tag}:0 ~ {tag}:N-1 位图，{tag}:n 该范围的 stable/new/loss 计数，{tag}:t 计算用临时 key
+# 另外 {key}:counts 保存所有范围的计数（状态页一次读取），{key}:city:<city_id> 保存城市下有数据的范围，用于选取探测目标
+#   两者使用同一个 hash tag，由 COUNTS_SCRIPT 原子累加各范围脚本返回的变化量，并发写入的先后顺序不影响结果
+
+# 写入最新槽位，只对新置位的 ip 检查其他槽位并增量更新计数，返回 [stable, new, loss, 以及三者的变化量]
+MARK_SCRIPT = """
+local n = tonumber(ARGV[1])
+local g = tonumber(redis.call('get', KEYS[1]) or '0')
+local newest = KEYS[2 + g % n]
+local added, stable, loss = 0, 0, 0
+for i = 2, #ARGV do
+    local off = tonumber(ARGV[i])
+    if redis.call('setbit', newest, off, 1) == 0 then
+        added = added + 1
+        local older = 0
+        for j = 1, n - 1 do
+            older = older + redis.call('getbit', KEYS[2 + (g - j) % n], off)
+        end
+        if older == n - 1 then stable = stable + 1 end
+        if older > 0 then loss = loss + 1 end
+    end
+end
+redis.call('hincrby', KEYS[n + 2], 's', stable)
+redis.call('hincrby', KEYS[n + 2], 'n', added)
+redis.call('hincrby', KEYS[n + 2], 'l', -loss)
+local counts = redis.call('hmget', KEYS[n + 2], 's', 'n', 'l')
+return {counts[1], counts[2], counts[3], stable, added, -loss}
+"""
+# 老化一代，返回 [stable, new, loss, 以及三者的变化量]，全部为 0 时已删除该范围
+AGE_SCRIPT = """
+local n = tonumber(ARGV[1])
+local old = redis.call('hmget', KEYS[n + 2], 's', 'n', 'l')
+local s0, n0, l0 = tonumber(old[1] or '0'), tonumber(old[2] or '0'), tonumber(old[3] or '0')
+local g = redis.call('incr', KEYS[1])
+redis.call('del', KEYS[2 + g % n])
+local others = {}
+for j = 1, n - 1 do others[j] = KEYS[2 + (g - j) % n] end
+redis.call('bitop', 'or', KEYS[n + 3], unpack(others))
+local loss = redis.call('bitcount', KEYS[n + 3])
+redis.call('del', KEYS[n + 3])
+if loss == 0 then
+    redis.call('del', unpack(KEYS, 1, n + 2))
+    return {0, 0, 0, -s0, -n0, -l0}
+end
+redis.call('hset', KEYS[n + 2], 's', 0, 'n', 0, 'l', loss)
+return {0, 0, loss, -s0, -n0, loss - l0}
+"""
+# 累加范围计数的变化量，计数全部不大于 0 时删除该范围；KEYS[1] 汇总 hash，KEYS[i + 1] 第 i 个范围所属城市的范围集合
+# ARGV 每 5 个为 范围 field, 城市集合成员, stable/new/loss 的变化量；返回每个范围在城市集合中的变化（1 加入，-1 移除，0 不变）
+COUNTS_SCRIPT = """
+local changed = {}
+for i = 1, #KEYS - 1 do
+    local a = (i - 1) * 5
+    local s, n, l = 0, 0, 0
+    local old = redis.call('hget', KEYS[1], ARGV[a + 1])
+    if old then
+        s, n, l = string.match(old, '(-?%d+),(-?%d+),(-?%d+)')
+    end
+    s, n, l = tonumber(s) + tonumber(ARGV[a + 3]), tonumber(n) + tonumber(ARGV[a + 4]), tonumber(l) + tonumber(ARGV[a + 5])
+    if s > 0 or n > 0 or l > 0 then
+        redis.call('hset', KEYS[1], ARGV[a + 1], s .. ',' .. n .. ',' .. l)
+        changed[i] = redis.call('sadd', KEYS[i + 1], ARGV[a + 2])
+    else
+        redis.call('hdel', KEYS[1], ARGV[a + 1])
+        changed[i] = -redis.call('srem', KEYS[i + 1], ARGV[a + 2])
+    end
+end
+return changed
+"""
+# 读取最新槽位中从随机字节偏移开始的一段，返回 [字节偏移, 位图片段]
+SAMPLE_SCRIPT = """
+local n = tonumber(ARGV[1])
+local g = tonumber(redis.call('get', KEYS[1]) or '0')
+local key = KEYS[2 + g % n]
+local size = redis.call('strlen', key)
+local window = tonumber(ARGV[2])
+if size <= window then return {0, redis.call('get', key)} end
+local off = tonumber(ARGV[3]) % (size - window + 1)
+return {off, redis.call('getrange', key, off, off + window - 1)}
+"""
+
+def range_field(city_id:int, start_ip:int, end_ip:int):
+    return f'{city_id}:{start_ip}-{end_ip}'
+
+def parse_range_field(field):
+    if isinstance(field, bytes):
+        field = field.decode()
+    city_id, _, ips = field.partition(':')
+    start_ip, _, end_ip = ips.partition('-')
+    return int(city_id), int(start_ip), int(end_ip)
+
+def bitmap_offsets(data:bytes, base:int = 0):
+    # 返回位图中所有置位的位序号（Redis 位图每个字节的最高位是序号最小的位）
+    offsets = []
+    for i, b in enumerate(data):
+        if b:
+            for bit in range(8):
+                if b & (0x80 >> bit):
+                    offsets.append((base + i) * 8 + bit)
+    return offsets
+
+class LivenessBitmap:
+    # redis_pool 需要是不解码响应的连接池，位图是二进制数据
+    def __init__(self, redis_pool, cache_key:str, generations:int = 4):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        self.generations = generations
+        self.chunk = 1000 # 每次脚本调用最多写入的 ip 数
+        self.sample_window = 8192 # 选取目标时每个范围最多读取的字节数（65536 个 ip）
+        self.sample_ranges = 8 # 选取目标时每次最多读取的范围数
+
+    def range_keys(self, city_id:int, start_ip:int, end_ip:int):
+        tag = self.key + ':{' + range_field(city_id, start_ip, end_ip) + '}:'
+        return [tag + 'g'] + [tag + str(i) for i in range(self.generations)] + [tag + 'n', tag + 't']
+
+    def counts_key(self):
+        return '{' + self.key + '}:counts'
+
+    def city_key(self, city_id:int):
+        return '{' + self.key + '}:city:' + str(city_id)
+
+    def _save_counts(self, changes):
+        # changes = [((city_id, start_ip, end_ip), [stable, new, loss] 的变化量)]，一次往返累加到汇总 hash 和城市的范围集合
+        # 返回 ([stable, new, loss] 的变化量合计, {city_id: 有数据的范围数的变化量})
+        changes = [(r, [int(x or 0) for x in delta]) for r, delta in changes if any(delta)]
+        deltas = [0, 0, 0]
+        city_deltas = {}
+        if len(changes) == 0:
+            return deltas, city_deltas
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(changes), self.chunk):
+            chunk = changes[i:i + self.chunk]
+            pipe.eval(COUNTS_SCRIPT, len(chunk) + 1, self.counts_key(), *[self.city_key(r[0]) for r, delta in chunk],
+                *[x for (city_id, start_ip, end_ip), delta in chunk for x in (range_field(city_id, start_ip, end_ip), f'{start_ip}-{end_ip}', *delta)])
+        changed = [x for result in pipe.execute() for x in result]
+        for ((city_id, start_ip, end_ip), delta), value in zip(changes, changed):
+            for i in range(3):
+                deltas[i] += delta[i]
+            if value:
+                city_deltas[city_id] = city_deltas.get(city_id, 0) + int(value)
+        return deltas, city_deltas
+
+    def mark(self, jobs:dict):
+        # jobs = {(city_id, start_ip, end_ip): [ip, ...]}，两次往返完成
+        # 返回 (写入的 ip 数, [stable, new, loss] 的变化量, {city_id: 有数据的范围数的变化量})
+        pipe = self.redis.pipeline(transaction=False)
+        ranges = []
+        count = 0
+        for (city_id, start_ip, end_ip), ips in jobs.items():
+            offsets = [ip - start_ip for ip in ips if start_ip <= ip <= end_ip]
+            for i in range(0, len(offsets), self.chunk):
+                pipe.eval(MARK_SCRIPT, self.generations + 3, *self.range_keys(city_id, start_ip, end_ip),
+                    self.generations, *offsets[i:i + self.chunk])
+                ranges.append((city_id, start_ip, end_ip))
+            count += len(offsets)
+        if len(ranges) == 0:
+            return 0, [0, 0, 0], {}
+        deltas, city_deltas = self._save_counts([(r, counts[3:]) for r, counts in zip(ranges, pipe.execute())])
+        return count, deltas, city_deltas
+
+    def age_ranges(self, ranges:list):
+        # ranges = [(city_id, start_ip, end_ip)]，两次往返完成，返回值与 mark 的后两项相同
+        pipe = self.redis.pipeline(transaction=False)
+        for city_id, start_ip, end_ip in ranges:
+            pipe.eval(AGE_SCRIPT, self.generations + 3, *self.range_keys(city_id, start_ip, end_ip), self.generations)
+        return self._save_counts([(r, counts[3:]) for r, counts in zip(ranges, pipe.execute())])
+
+    def summary(self):
+        # 所有范围的计数合计，一次往返；cities 为有 new ip 的城市，pingcities 为 lastresult>0 的城市数
+        stable = new = loss = 0
+        cities = set()
+        pingcities = set()
+        for field, value in self.redis.hgetall(self.counts_key()).items():
+            s, n, l = [int(x) for x in value.split(b',')]
+            city_id = parse_range_field(field)[0]
+            stable += s
+            new += n
+            loss += l
+            pingcities.add(city_id)
+            if n > 0:
+                cities.add(city_id)
+        return {
+            'stable': stable,
+            'new': new,
+            'loss': loss,
+            'cities': sorted(cities),
+            'pingcities': len(pingcities),
+        }
+
+    def city_counts(self):
+        # 每个城市有数据的范围数 {city_id: count}
+        counts = {}
+        for field in self.redis.hkeys(self.counts_key()):
+            city_id = parse_range_field(field)[0]
+            counts[city_id] = counts.get(city_id, 0) + 1
+        return counts
+
+    def sample(self, city_id:int, count:int):
+        # 从城市的随机几个范围的最新槽位中随机选取 count 个 ip
+        members = self.redis.srandmember(self.city_key(city_id), self.sample_ranges)
+        if not members:
+            return []
+        ranges = []
+        pipe = self.redis.pipeline(transaction=False)
+        for member in members:
+            start_ip, _, end_ip = member.decode().partition('-')
+            start_ip, end_ip = int(start_ip), int(end_ip)
+            pipe.eval(SAMPLE_SCRIPT, self.generations + 3, *self.range_keys(city_id, start_ip, end_ip),
+                self.generations, self.sample_window, random.getrandbits(31))
+            ranges.append((start_ip, end_ip))
+        ips = []
+        for (start_ip, end_ip), ret in zip(ranges, pipe.execute()):
+            if ret and ret[1]:
+                ips.extend(start_ip + off for off in bitmap_offsets(ret[1], int(ret[0])) if start_ip + off <= end_ip)
+        return random.sample(ips, min(count, len(ips)))
+
+    def load(self, city_id:int, start_ip:int, end_ip:int, rows):
+        # 从 pingable 表迁移，rows = [(ip, lastresult)]，lastresult 的最高位写入当前代（代数为 0）的槽位
+        n = self.generations
+        top = 1 << (n - 1)
+        bitmaps = [bytearray((end_ip - start_ip) // 8 + 1) for i in range(n)]
+        stable = new = loss = 0
+        for ip, lastresult in rows:
+            off = ip - start_ip
+            lastresult &= (1 << n) - 1
+            for j in range(n):
+                if lastresult & (top >> j):
+                    bitmaps[(-j) % n][off >> 3] |= 0x80 >> (off & 7)
+            stable += lastresult == (1 << n) - 1
+            new += lastresult >= top
+            loss += 0 < lastresult < top
+        keys = self.range_keys(city_id, start_ip, end_ip)
+        # 覆盖前读取原有计数，汇总 hash 累加两者的差
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hmget(keys[n + 1], 's', 'n', 'l')
+        pipe.delete(*keys)
+        pipe.set(keys[0], 0)
+        for i in range(n):
+            if any(bitmaps[i]):
+                pipe.set(keys[1 + i], bytes(bitmaps[i]))
+        pipe.hset(keys[n + 1], mapping={'s': stable, 'n': new, 'l': loss})
+        old = [int(x or 0) for x in pipe.execute()[0]]
+        self._save_counts([((city_id, start_ip, end_ip), [stable - old[0], new - old[1], loss - old[2]])])
+        return [stable, new, loss]
+
+    def delete(self, city_id:int, start_ip:int, end_ip:int):
+        keys = self.range_keys(city_id, start_ip, end_ip)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hmget(keys[self.generations + 1], 's', 'n', 'l')
+        pipe.delete(*keys)
+        old = [int(x or 0) for x in pipe.execute()[0]]
+        self._save_counts([((city_id, start_ip, end_ip), [-x for x in old])])
@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import OrderedDict
+
+# 进程内 LRU 缓存，放在 Redis 前面，保存已经反序列化的 python 对象
+# Lambda 容器热启动期间，目录类数据（国家、城市、cityset 等）可以不经过网络直接返回
+# 按占用字节数（以序列化后的 json 长度估算）淘汰最久未使用的条目，每个条目有独立的过期时间
+# 注意：返回的是共享对象，调用方不能修改
+class LocalCache:
+    def __init__(self, max_bytes:int = 16 * 1024 * 1024, max_ttl:int = 60):
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl # 本地条目最长存活时间，限制其他容器删除缓存后本容器读到旧数据的时间
+        self.entries = OrderedDict() # key -> (value, expire, size)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hit': 0, 'miss': 0, 'expired': 0, 'evicted': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key:str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                self.stats['miss'] += 1
+                return None
+            if entry[1] <= time.time():
+                self._remove(key)
+                self.stats['expired'] += 1
+                self.stats['miss'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hit'] += 1
+            return entry[0]
+
+    def set(self, key:str, value, ttl:int, size:int):
+        ttl = min(ttl, self.max_ttl) if ttl > 0 else self.max_ttl
+        # 单个条目超过总容量的 1/4 时不缓存，避免把其他条目全部挤出
+        if value == None or ttl <= 0 or size > self.max_bytes // 4:
+            return False
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.time() + ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.stats['evicted'] += 1
+        return True
+
+    def _remove(self, key:str):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.bytes -= entry[2]
+
+    def delete(self, key:str):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get_metrics(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            **self.stats
+        }
@@ -0,0 +1,110 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# MySQL 连接池，模块级实例在 Lambda 容器热启动期间（或常驻进程中）一直复用，避免每次查询都重新建立 TLS/认证握手
+# 空闲超过 max_idle 的连接会被关闭；空闲超过 check_interval 的连接在借出前会 ping 一次，断开时自动重连
+class MySQLPool:
+    def __init__(self, creator, max_size:int = 4, max_idle:int = 300, check_interval:int = 30, wait_timeout:int = 10):
+        self.creator = creator
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.idle = [] # [(conn, last_used)]，后进先出，优先复用最近使用的连接
+        self.size = 0 # 已创建（含借出）的连接数
+        self.cond = threading.Condition()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'discarded': 0}
+
+    def _evict_idle(self, now:float):
+        keep = []
+        for conn, last_used in self.idle:
+            if now - last_used > self.max_idle:
+                self._close(conn)
+                self.size -= 1
+                self.stats['evicted'] += 1
+            else:
+                keep.append((conn, last_used))
+        self.idle = keep
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        deadline = time.time() + self.wait_timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                self._evict_idle(now)
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    conn = None
+                    break
+                if now >= deadline:
+                    raise TimeoutError(f'mysql pool exhausted, size {self.max_size}')
+                self.cond.wait(deadline - now)
+        if conn == None:
+            try:
+                conn = self.creator()
+            except Exception:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                raise
+            self.stats['created'] += 1
+            return conn
+        # 健康检查，长时间未使用的连接可能已被服务端或 NAT 断开
+        if now - last_used > self.check_interval:
+            try:
+                if not conn.open:
+                    raise ConnectionError('connection closed')
+                conn.ping(reconnect=True)
+            except Exception:
+                self.release(conn, discard=True)
+                return self.acquire()
+        self.stats['reused'] += 1
+        return conn
+
+    def release(self, conn, discard:bool = False):
+        with self.cond:
+            if discard or not conn.open:
+                self._close(conn)
+                self.size -= 1
+                self.stats['discarded'] += 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        # 出现异常时连接状态未知（可能有未提交事务或已断开），直接丢弃
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close_all(self):
+        with self.cond:
+            for conn, last_used in self.idle:
+                self._close(conn)
+                self.size -= 1
+            self.idle = []
+            self.cond.notify_all()
+
+    def get_metrics(self):
+        return {
+            'size': self.size,
+            'idle': len(self.idle),
+            'max_size': self.max_size,
+            **self.stats
+        }
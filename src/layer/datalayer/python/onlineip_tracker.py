@@ -24,9 +24,11 @@ class OnlineIPTracker:
         self.redis.zremrangebyscore(self.key, 0, cutoff_time)
 
     def get_online_ips(self):
-        # 获取所有在线IP，按最后更新时间排序
-        self.cleanup_expired()
-        return self.redis.zrange(self.key, 0, -1, withscores=True)
+        # 获取所有在线IP，按最后更新时间排序，清理和读取在一次往返中完成
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zremrangebyscore(self.key, 0, time.time() - self.expire_seconds)
+        pipe.zrange(self.key, 0, -1, withscores=True)
+        return pipe.execute()[1]
 
     def get_online_ips_count(self):
         # 获取在线IP数量
@@ -0,0 +1,80 @@
+import redis
+import time
+
+# 数据任务的城市对调度，代替按 city_id 顺序循环的游标
+# 每个源城市一个有序集合，成员为目标城市，分数为最后测量时间减去优先级（秒），分数越小越优先
+# 从未测量过的目标城市分数为 0，最先派发；派发时把分数设为当前时间，测量结果写入后再设为测量时间
+# 派发会覆盖分数，最后测量时间另外保存在每个源城市的 hash {key}:<src_city_id>:measured 中（目标城市 -> 测量时间），用于统计覆盖时间
+# 所有源城市保存在 {key}:srcs 中
+
+# 取出分数最小的 count 个目标城市，并把分数设为派发时间，避免同时派发给同一城市的多个客户端
+DISPATCH_SCRIPT = """
+local items = redis.call('zrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for i = 1, #items do redis.call('zadd', KEYS[1], ARGV[2], items[i]) end
+return items
+"""
+
+class PairScheduler:
+    def __init__(self, redis_pool, cache_key:str):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+
+    def src_key(self, src_city_id:int):
+        return f'{self.key}:{src_city_id}'
+
+    def measured_key(self, src_city_id:int):
+        return f'{self.key}:{src_city_id}:measured'
+
+    def has_measured(self, src_city_id:int):
+        return self.redis.exists(self.measured_key(src_city_id)) > 0
+
+    def srcs_key(self):
+        return self.key + ':srcs'
+
+    def get_scores(self, src_city_id:int):
+        return {int(k): v for k, v in self.redis.zrange(self.src_key(src_city_id), 0, -1, withscores=True)}
+
+    def update(self, src_city_id:int, scores:dict, removes:list, measured:dict = None):
+        # scores = {dist_city_id: 分数}，只加入不存在的目标城市；removes 为不再可ping的目标城市
+        # measured = {dist_city_id: 最后测量时间}，首次建立时从数据库读取
+        key = self.src_key(src_city_id)
+        pipe = self.redis.pipeline(transaction=False)
+        if len(scores) > 0:
+            pipe.zadd(key, scores, nx=True)
+        if measured:
+            pipe.hset(self.measured_key(src_city_id), mapping=measured)
+        if len(removes) > 0:
+            pipe.zrem(key, *removes)
+            pipe.hdel(self.measured_key(src_city_id), *removes)
+        pipe.sadd(self.srcs_key(), src_city_id)
+        pipe.execute()
+
+    def dispatch(self, src_city_id:int, count:int):
+        return [int(x) for x in self.redis.eval(DISPATCH_SCRIPT, 1, self.src_key(src_city_id), count, int(time.time()))]
+
+    def record(self, measured:dict, now:int):
+        # measured = {src_city_id: {dist_city_id: 分数}}，一次往返，只更新已调度的城市对的分数，并记录测量时间
+        pipe = self.redis.pipeline(transaction=False)
+        for src_city_id, scores in measured.items():
+            pipe.zadd(self.src_key(src_city_id), scores, xx=True)
+            pipe.hset(self.measured_key(src_city_id), mapping={dist_city_id: now for dist_city_id in scores})
+        pipe.execute()
+
+    def sizes(self, src_city_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for src_city_id in src_city_ids:
+            pipe.zcard(self.src_key(src_city_id))
+        return dict(zip(src_city_ids, pipe.execute()))
+
+    def all_measured(self):
+        # 返回所有源城市的 {src_city_id: [(dist_city_id, 最后测量时间，从未测量为 None)]}，两次往返
+        srcs = [int(x) for x in self.redis.smembers(self.srcs_key())]
+        pipe = self.redis.pipeline(transaction=False)
+        for src_city_id in srcs:
+            pipe.zrange(self.src_key(src_city_id), 0, -1)
+            pipe.hgetall(self.measured_key(src_city_id))
+        results = pipe.execute()
+        measured = {}
+        for src_city_id, items, times in zip(srcs, results[0::2], results[1::2]):
+            measured[src_city_id] = [(int(k), int(times[k]) if k in times else None) for k in items]
+        return measured
@@ -0,0 +1,103 @@
+import redis
+
+# 数据任务的探测目标缓存，代替每次派发任务时 pingable 表的 ORDER BY RAND() 查询
+# 每个城市一个有序集合，成员和分数都是 lastresult >= NEW_PINGABLE_IP 的 ip（整数），派发任务时用 ZRANDMEMBER 随机取样
+# 分数为 ip，老化一个 iprange 时可以用 ZREMRANGEBYSCORE 按范围删除，与 pingable 表的 update ... where ip>=%s and ip<=%s 对应
+# 另有一个有可ping ip的城市索引（成员和分数都是 city_id），用于按 city_id 顺序遍历目标城市
+# 每个集合都有一个分数为 -1 的标记成员，表示已经从数据库完整加载，写入路径只更新已加载的集合，未加载的集合在读取时从数据库加载
+LOADED_MEMBER = 'loaded'
+
+# 集合存在时才写入，避免写入路径创建不完整的集合；返回写入的成员数，集合不存在时返回 -1
+ADD_IF_LOADED_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then return -1 end
+for i = 1, #ARGV do redis.call('zadd', KEYS[1], ARGV[i], ARGV[i]) end
+return #ARGV
+"""
+# 按范围删除，返回剩余的目标数，集合不存在时返回 -1
+REMOVE_RANGE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then return -1 end
+redis.call('zremrangebyscore', KEYS[1], ARGV[1], ARGV[2])
+return redis.call('zcard', KEYS[1]) - 1
+"""
+
+class PingableTargets:
+    def __init__(self, redis_pool, cache_key:str, expire:int, generation = None):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        self.expire = expire # 过期后从数据库重新加载，修正写入路径遗漏的变化
+        self.generation = generation # 返回数据版本的函数，批量导入数据后版本变化，所有集合重新加载
+        self.chunk = 1000 # 每条命令最多包含的成员数
+
+    def prefix(self):
+        return self.key + (str(self.generation()) if self.generation else '') + ':'
+
+    def city_key(self, city_id:int):
+        return self.prefix() + str(city_id)
+
+    def cities_key(self):
+        return self.prefix() + 'cities'
+
+    def _sample(self, key:str, count:int):
+        # 返回 None 表示集合未加载
+        members = self.redis.zrandmember(key, count + 1)
+        if not members:
+            return None
+        return [int(x) for x in members if x != LOADED_MEMBER][:count]
+
+    def _load(self, key:str, members):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.zadd(key, {LOADED_MEMBER: -1})
+        for i in range(0, len(members), self.chunk):
+            pipe.zadd(key, {x: x for x in members[i:i + self.chunk]})
+        pipe.expire(key, self.expire)
+        pipe.execute()
+
+    def sample(self, city_id:int, count:int):
+        # 随机取样 count 个目标 ip，不足时返回全部；集合未加载时返回 None
+        return self._sample(self.city_key(city_id), count)
+
+    def load(self, city_id:int, ips):
+        self._load(self.city_key(city_id), ips)
+
+    def add(self, jobs:dict):
+        # jobs = {city_id: [ip, ...]}，一次往返更新所有城市，返回各城市是否已加载 {city_id: bool}
+        pipe = self.redis.pipeline(transaction=False)
+        cities = []
+        for city_id, ips in jobs.items():
+            for i in range(0, len(ips), self.chunk):
+                pipe.eval(ADD_IF_LOADED_SCRIPT, 1, self.city_key(city_id), *ips[i:i + self.chunk])
+                cities.append(city_id)
+        loaded = {}
+        for city_id, ret in zip(cities, pipe.execute()):
+            loaded[city_id] = loaded.get(city_id, True) and ret >= 0
+        return loaded
+
+    def remove_ranges(self, ranges:list):
+        # ranges = [(city_id, start_ip, end_ip)]，一次往返，返回各城市剩余的目标数 {city_id: count}，集合未加载时为 -1
+        pipe = self.redis.pipeline(transaction=False)
+        for city_id, start_ip, end_ip in ranges:
+            pipe.eval(REMOVE_RANGE_SCRIPT, 1, self.city_key(city_id), start_ip, end_ip)
+        # 同一城市的多个范围按顺序执行，最后一个返回值是该城市最终剩余的目标数
+        return {city_id: remaining for (city_id, start_ip, end_ip), remaining in zip(ranges, pipe.execute())}
+
+    def cities_after(self, last_city_id:int, limit:int):
+        # 返回 city_id 大于 last_city_id 的前 limit 个城市，索引未加载时返回 None
+        key = self.cities_key()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.zrangebyscore(key, f'({last_city_id}', '+inf', start=0, num=limit)
+        exists, cities = pipe.execute()
+        if not exists:
+            return None
+        return [int(x) for x in cities]
+
+    def load_cities(self, city_ids):
+        self._load(self.cities_key(), city_ids)
+
+    def add_cities(self, city_ids):
+        if len(city_ids) > 0:
+            self.redis.eval(ADD_IF_LOADED_SCRIPT, 1, self.cities_key(), *city_ids)
+
+    def remove_city(self, city_id:int):
+        self.redis.zrem(self.cities_key(), city_id)
@@ -7,10 +7,22 @@ CACHE_LONG_TTL=86400
 
 # 用于sql查询的缓存
 CACHEKEY_SQL = 'sql'
+# 用于查询缓存的各表代数
+CACHEKEY_GENERATION = 'gen'
 # 用于可ping ip任务的缓存
 CACHEKEY_PINGABLE = 'ping'
-# 用于测试延迟任务的缓存
-CACHEKEY_CITYJOB = 'job'
+# 用于测试延迟任务的城市对调度
+CACHEKEY_SCHEDULE = 'sched'
+# 用于数据任务的探测目标（每个城市的可ping ip集合和有可ping ip的城市索引）
+CACHEKEY_TARGETS = 'targets'
+# 用于可ping ip的位图存储
+CACHEKEY_LIVENESS = 'live'
+# 用于异步写入任务结果的 stream
+CACHEKEY_INGEST = 'ingest'
+# 用于多次写入失败的任务结果（死信）
+CACHEKEY_INGEST_DEAD = 'ingest:dead'
+# 用于状态页计数
+CACHEKEY_STATISTICS = 'stat'
 # 用于报告在线客户端
 CACHEKEY_ONLINE_SERVERS = 'online'
 # 用于报告最近处理任务数
@@ -22,6 +34,90 @@ CACHEKEY_PAUSE = 'pause'
 
 # 每个cityid对保存的最新记录条数，默认7次
 MAX_RECORDS_PER_CITYID = 7
+# 延迟统计数据存储方式：table 追加写入后删除旧数据；ring 每个城市对固定 MAX_RECORDS_PER_CITYID 个槽位循环覆盖，不需要删除
+# 切换到 ring 前需要先执行 admin 的 migrate_statistics_ring 迁移数据
+STATISTICS_STORAGE = os.environ.get('STATISTICS_STORAGE', 'table')
+# 写入统计数据时同步维护 statistics_summary 汇总表，/api/performance 直接读取汇总表
+# 已有部署需要先建表并执行 admin 的 rebuild_statistics_summary，完成前可以设置 STATISTICS_SUMMARY=0
+STATISTICS_SUMMARY = os.environ.get('STATISTICS_SUMMARY', '1') == '1'
+
+# Redis 缓存值编码：安装 msgpack 后默认使用 msgpack（CACHE_CODEC_MSGPACK=0 时始终使用 json），超过 CACHE_COMPRESS_MIN_SIZE 字节的值使用 zlib 压缩
+CACHE_CODEC_MSGPACK = os.environ.get('CACHE_CODEC_MSGPACK', '1') == '1'
+CACHE_COMPRESS_MIN_SIZE = 1024
+
+# 缓存逻辑过期后在 Redis 中继续保留的秒数，期间只有一个请求刷新，其他请求返回旧值
+CACHE_STALE_TTL = 300
+# 缓存未命中时的单飞锁有效期、没有旧值时等待结果的最长时间和轮询间隔（毫秒）
+CACHE_LOCK_MS = 5000
+CACHE_LOCK_WAIT_MS = 300
+CACHE_LOCK_POLL_MS = 50
+# 概率提前刷新系数，越大越早刷新，0 为不提前刷新
+CACHE_EARLY_REFRESH_BETA = 1.0
+# 各表缓存代数在进程内的缓存时间，其他容器写入后最多延迟该秒数读到新数据
+CACHE_GENERATION_TTL = 10
+# 状态页计数查询的缓存时间
+STATISTICS_CACHE_TTL = 60
+# 读取统计表的查询（延迟数据、按 cityset 过滤的目录）的缓存时间，统计数据持续写入，不使用缓存代数
+STATISTICS_QUERY_TTL = 300
+# 状态页计数与数据库对账的间隔（秒），修正增量更新的偏差和超过 14 天变为过期的 cidr
+STATISTICS_RECONCILE_INTERVAL = 600
+
+# 进程内缓存（位于 Redis 之前）的最大占用字节数和最长存活时间（秒）
+# 其他容器删除缓存后，本容器最多会在 LOCAL_CACHE_MAX_TTL 秒内读到旧数据
+LOCAL_CACHE_MAX_BYTES = int(os.environ.get('LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+LOCAL_CACHE_MAX_TTL = 60
+
+# iprange 进程内索引增量刷新间隔（秒）
+IPRANGE_INDEX_REFRESH = 300
+
+# 探测目标集合的有效期，过期后从 pingable 表重新加载；每个数据任务的目标 ip 数
+PINGABLE_TARGETS_TTL = CACHE_LONG_TTL
+PINGJOB_TARGETS = 100
+
+# ping 任务租约的有效期（秒），客户端需要在此时间内提交结果，否则任务被放回队列；每个任务最多派发的次数
+PING_JOB_LEASE_SECONDS = 900
+PING_JOB_MAX_ATTEMPTS = 3
+
+# 城市对调度同步可ping目标城市的间隔（秒）；cityset 中的目标城市优先级（秒），相当于比实际更早测量了这么久
+PAIR_SCHEDULE_SYNC = 600
+PAIR_SCHEDULE_CITYSET_PRIORITY = 21600
+
+# ping 任务队列的补充间隔（秒），租约期间其他请求不检查队列；每次补充最多老化并提交的 iprange 数
+IPRANGE_REFRESH_INTERVAL = 5
+IPRANGE_REFRESH_BATCH = 20
+
+# 可ping ip批量写入时，每条 INSERT 语句包含的行数
+PINGABLE_BATCH_SIZE = 500
+
+# /api/performance rawData 分页时每页的最大序列化字节数，alb 调用 Lambda 的响应体限制为 1MB
+RAWDATA_PAGE_BYTES = 700000
+# 客户端接受压缩时的每页最大序列化字节数（压缩前），json 数据通常可以压缩到 1/6 以下
+# 压缩并 base64 编码后超过 RESPONSE_MAX_BYTES 时按 RAWDATA_PAGE_BYTES 重新分页
+RAWDATA_PAGE_BYTES_COMPRESSED = 3000000
+# 响应体的最大字节数（base64 编码后），alb 调用 Lambda 的响应限制为 1MB，预留响应头的空间
+RESPONSE_MAX_BYTES = 1000000 - 16384
+# rawData 分页时每次从数据库读取的行数
+RAWDATA_FETCH_ROWS = 1000
+
+# 响应体超过该字节数时按 Accept-Encoding 进行压缩
+COMPRESS_MIN_SIZE = 1024
+
+# /job 任务结果的写入方式：sync 在请求中直接写入数据库；stream 写入 Redis stream 后立即返回，由 ingest 函数批量写入
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync')
+# ingest 消费组名称、每次读取的消息数、stream 最大长度（近似裁剪）
+INGEST_GROUP = 'writer'
+INGEST_BATCH_SIZE = 200
+INGEST_STREAM_MAXLEN = 100000
+# 消息被读取后超过该毫秒数未确认，会被其他消费者重新认领处理
+INGEST_CLAIM_IDLE_MS = 120000
+# 消息投递超过该次数仍未写入成功时移到死信 stream 并确认，不再重新认领；死信 stream 最大长度
+INGEST_MAX_DELIVERIES = 5
+INGEST_DEAD_MAXLEN = 10000
+
+# 可ping ip的存储方式：table 保存在 pingable 表中；bitmap 每个 iprange 在 Redis 中保存最近 LIVENESS_GENERATIONS 次扫描的位图
+# 切换到 bitmap 前先执行 admin 的 migrate_pingable_bitmap 迁移现有数据
+PINGABLE_STORAGE = os.environ.get('PINGABLE_STORAGE', 'table')
+LIVENESS_GENERATIONS = 4
 
 # 可ping ip的存活时间，只用最近4次就可以了
 STABLE_PINGABLE_IP = '15' # 1111b
@@ -51,6 +147,13 @@ DB_READ_HOST = os.environ.get('DB_READ_HOST', 'rds-r.cloudperf.vpc')
 DB_WRITE_HOST = os.environ.get('DB_WRITE_HOST', 'rds.cloudperf.vpc')
 DB_PORT = int(os.environ.get('DB_PORT', '3306'))
 DB_DATABASE='cloudperf'
+# 连接池大小，Lambda 单并发时一般只用到一个连接，常驻进程多线程时可以调大
+DB_POOL_READ_SIZE = int(os.environ.get('DB_POOL_READ_SIZE', '4'))
+DB_POOL_WRITE_SIZE = int(os.environ.get('DB_POOL_WRITE_SIZE', '2'))
+# 空闲连接超过该时间关闭
+DB_POOL_MAX_IDLE = 300
+# 空闲超过该时间的连接借出前先 ping 检查
+DB_POOL_CHECK_INTERVAL = 30
 DB_SECRET = os.environ.get('DB_SECRET', '')
 if DB_SECRET != '':
     secrets_manager = boto3.client('secretsmanager')
@@ -1,36 +1,82 @@
 import redis
 import time
 
-# 这里想实现最近一个小时的速度统计，实现方法通过每分钟一个key，更新数值直接在key上增加，key在新建时设置了过期时间，下一周期自动失效
-# 获取时直接读取60个分钟的总值，进行显示
+# 最近处理任务数的多精度统计，每个计数一个 hash：
+#   最近一分钟按秒（60 个单元），最近一小时按分钟（60 个单元），最近一天按小时（24 个单元）
+# 每个单元两个字段：<前缀><序号> 为计数，<前缀><序号>:t 为该单元的时间序号（时间 / 精度），单元被复用时按时间序号判断是否需要清零
+# 更新通过一次脚本调用原子完成，读取时只统计时间序号仍在窗口内的单元，多个计数可以在一个 pipeline 中一次读取
+
+# 前缀，精度（秒），单元数
+RESOLUTIONS = (('s', 1, 60), ('m', 60, 60), ('h', 3600, 24))
+# 各精度的统计窗口名称
+WINDOWS = {'s': 'minute', 'm': 'hour', 'h': 'day'}
+
+# KEYS[1] 计数 hash；ARGV[1] 增加值，ARGV[2] 当前时间（秒），ARGV[3] 过期时间，之后每 3 个为 前缀, 精度, 单元数
+UPDATE_SCRIPT = """
+local count, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+for i = 4, #ARGV, 3 do
+    local unit = math.floor(now / tonumber(ARGV[i + 1]))
+    local field = ARGV[i] .. (unit % tonumber(ARGV[i + 2]))
+    if redis.call('hget', KEYS[1], field .. ':t') == tostring(unit) then
+        redis.call('hincrby', KEYS[1], field, count)
+    else
+        redis.call('hset', KEYS[1], field, count, field .. ':t', unit)
+    end
+end
+redis.call('expire', KEYS[1], ARGV[3])
+return count
+"""
+
 class SpeedCounter:
     def __init__(self, redis_pool, cache_key:str):
         self.redis = redis.StrictRedis(connection_pool=redis_pool)
-        self.key = "{" + cache_key + "}:"
-        # 进行最近一小时统计，一分钟精度
-        self.accuracy = 60 # 多少秒可并都一个计数单元，这里表示一分钟精度使用一个计数单元
-        self.bucket = 60 # 分为多少个单元
-        self.expire = self.accuracy * self.bucket # 每个单元过期时间
-        # 如果想进行最近一分钟统计，一秒精度
-        # accuracy = 1, bucket = 60, expire = 60
-
-    def update_count(self, count:int):
-        key = self.key + str(int(time.time() / self.accuracy) % self.bucket)
+        self.key = cache_key
+        # 最长的统计窗口过期，没有更新时自动删除
+        self.expire = max(accuracy * bucket for prefix, accuracy, bucket in RESOLUTIONS)
+
+    def update_count(self, count:int, now:float = None):
         try:
-            ret = self.redis.incr(key, count)
-            if ret == count:
-                # 如果key不存在，设置过期时间
-                self.redis.expire(key, self.expire)
+            args = [x for resolution in RESOLUTIONS for x in resolution]
+            self.redis.eval(UPDATE_SCRIPT, 1, self.key, count, int(time.time() if now == None else now), self.expire, *args)
         except Exception as e:
-            print('update_count failed.', repr(e), key)
+            print('update_count failed.', repr(e), self.key)
+
+    def parse(self, fields:dict, now:float = None):
+        # 返回各窗口的合计和每秒速率，如 {'minute': 合计, 'minute_rate': 每秒, 'hour': ..., 'day': ...}
+        now = time.time() if now == None else now
+        stats = {}
+        for prefix, accuracy, bucket in RESOLUTIONS:
+            unit = int(now // accuracy)
+            total = 0
+            for i in range(bucket):
+                stamp = fields.get(f'{prefix}{i}:t')
+                if stamp != None and unit - bucket < int(stamp) <= unit:
+                    total += int(fields.get(f'{prefix}{i}', 0))
+            # 当前单元只经过了一部分，窗口按实际覆盖的秒数计算
+            seconds = (bucket - 1) * accuracy + (now - unit * accuracy)
+            window = WINDOWS[prefix]
+            stats[window] = total
+            stats[window + '_rate'] = round(total / max(seconds, 1), 3)
+        return stats
+
+    def get_stats(self):
+        return read_speed_counters([self])[self.key]
 
     def get_count(self):
-        keys = [f"{self.key}{i:d}" for i in range(self.bucket)]
-        try:
-            # 以下逻辑可以避免每次incr都刷新ttl
-            # 如果key不存在，直接设置并设置过期时间和本次增加值
-            ret = self.redis.mget(keys)
-            return sum(int(x) for x in ret if x is not None)
-        except Exception as e:
-            print('update_count failed.', repr(e), keys)
-        return 0
+        # 最近一小时的合计
+        return self.get_stats()['hour']
+
+def read_speed_counters(counters:list):
+    # 一次往返读取多个计数，返回 {key: 统计}
+    if len(counters) == 0:
+        return {}
+    now = time.time()
+    try:
+        pipe = counters[0].redis.pipeline(transaction=False)
+        for counter in counters:
+            pipe.hgetall(counter.key)
+        results = pipe.execute()
+    except Exception as e:
+        print('read speed counters failed.', repr(e))
+        results = [{}] * len(counters)
+    return {counter.key: counter.parse(fields, now) for counter, fields in zip(counters, results)}
@@ -0,0 +1,79 @@
+import redis
+
+# 状态页的计数，代替每次请求执行的 count(1) 查询
+# 写入路径（可ping ip写入和老化、iprange 检查、统计数据写入）增量更新，定期与数据库对账后整体重置
+# 所有 key 使用同一个 hash tag，在 Redis 集群中位于同一个 slot，状态页一次 MGET 读取全部计数：
+#   {tag}:<计数名> 计数值，{tag}:pingcity 每个城市可ping的条目数（pingable 表的行数或位图存储的范围数），用于计算 cityid-ping
+
+# 只更新已存在的计数，不存在的计数（未对账或已过期）由对账计算，避免从 0 开始得到不完整的值
+INCR_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call('exists', KEYS[i]) == 1 then redis.call('incrby', KEYS[i], ARGV[i]) end
+end
+return #KEYS
+"""
+# 更新每个城市的条目数，删除减到 0 的城市，把城市数写入 cityid-ping；ARGV 为 city_id, 变化量, ...
+# 与 INCR_SCRIPT 相同，cityid-ping 不存在时不更新，返回 -1
+CITY_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 then return -1 end
+for i = 1, #ARGV, 2 do
+    if redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1]) <= 0 then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+local count = redis.call('hlen', KEYS[1])
+redis.call('set', KEYS[2], count)
+return count
+"""
+
+# 增量维护的计数名，与 query_statistics_data 的参数一致
+STAT_COUNTER_NAMES = ('all-country', 'all-city', 'all-asn', 'ping-stable', 'ping-new', 'ping-loss',
+    'cidr-ready', 'cidr-outdated', 'cityid-all', 'cityid-ping', 'cityid-pair')
+
+class StatCounters:
+    def __init__(self, redis_pool, cache_key:str):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.tag = '{' + cache_key + '}:'
+
+    def counter_key(self, name:str):
+        return self.tag + name
+
+    def city_key(self):
+        return self.tag + 'pingcity'
+
+    def get(self, names:list):
+        # 一次往返，返回 {计数名: 值}，不存在的计数为 None
+        values = self.redis.mget([self.counter_key(name) for name in names])
+        return {name: (int(value) if value != None else None) for name, value in zip(names, values)}
+
+    def incr(self, deltas:dict, city_deltas:dict = None):
+        # deltas = {计数名: 变化量}，city_deltas = {city_id: 条目数变化量}，一次往返
+        names = [name for name, delta in deltas.items() if delta != 0]
+        args = [x for city_id, delta in (city_deltas or {}).items() if delta != 0 for x in (city_id, delta)]
+        pipe = self.redis.pipeline(transaction=False)
+        if len(names) > 0:
+            pipe.eval(INCR_SCRIPT, len(names), *[self.counter_key(name) for name in names], *[deltas[name] for name in names])
+        if len(args) > 0:
+            pipe.eval(CITY_SCRIPT, 2, self.city_key(), self.counter_key('cityid-ping'), *args)
+        if len(pipe) > 0:
+            pipe.execute()
+
+    def reset(self, values:dict, city_counts:dict = None):
+        # 对账：values = {计数名: 值}，city_counts = {city_id: 条目数}，为 None 时不修改城市条目数
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.mset({self.counter_key(name): value for name, value in values.items()})
+        if city_counts != None:
+            pipe.delete(self.city_key())
+            items = {city_id: count for city_id, count in city_counts.items() if count > 0}
+            if len(items) > 0:
+                pipe.hset(self.city_key(), mapping=items)
+            pipe.set(self.counter_key('cityid-ping'), len(items))
+        pipe.execute()
+
+    def acquire_reconcile(self, ttl:int):
+        # 对账租约，ttl 秒内只有一个调用者对账
+        return bool(self.redis.set(self.counter_key('reconcile'), 1, nx=True, ex=ttl))
+
+    def clear(self):
+        # 删除所有计数和对账租约，下次读取时重新对账
+        self.redis.delete(*[self.counter_key(name) for name in STAT_COUNTER_NAMES], self.city_key(), self.counter_key('reconcile'))